@@ -0,0 +1,87 @@
+import os
+import uuid
+from urllib3.fields import format_multipart_header_param
+
+# Size of the buffer used to read the knowledge object from disk while it is being sent
+CHUNK_SIZE = 64 * 1024
+
+
+class MultipartFileStream:
+    """
+    A multipart/form-data request body holding a single file, which is read from disk while it is sent.
+    Only the multipart headers are kept in memory, so memory use per upload does not depend on the file size.
+    The body can be passed to requests as data=..., together with the content_type as 'Content-Type' header.
+    It supports tell() and seek(), which urllib3 uses to rewind the body when a request is retried.
+    With a bandwidth TokenBucket (see auth/flow_control.py) in bytes per second, every chunk waits for its bytes
+    before it is sent, so all uploads sharing the bucket together stay under its rate.
+    """
+
+    def __init__(self, field_name: str, file_name: str, file_path: str, chunk_size: int = CHUNK_SIZE,
+                 bandwidth=None):
+        self.boundary = uuid.uuid4().hex
+        self.bandwidth = bandwidth
+        self.content_type = f"multipart/form-data; boundary={self.boundary}"
+        self.chunk_size = chunk_size
+        self._head = (f"--{self.boundary}\r\n"
+                      f"Content-Disposition: form-data; {format_multipart_header_param('name', field_name)}; "
+                      f"{format_multipart_header_param('filename', file_name)}\r\n"
+                      f"\r\n").encode('utf-8')
+        self._tail = f"\r\n--{self.boundary}--\r\n".encode('utf-8')
+        self._file = open(file_path, 'rb')
+        self._file_size = os.fstat(self._file.fileno()).st_size
+        self.len = len(self._head) + self._file_size + len(self._tail)
+        self._position = 0
+
+    def read(self, size: int = -1):
+        """Reads up to size bytes of the body, or up to chunk_size bytes if no size is given."""
+        if size is None or size < 0:
+            size = self.chunk_size
+        data = b''
+        while len(data) < size and self._position < self.len:
+            wanted = size - len(data)
+            file_start = len(self._head)
+            tail_start = file_start + self._file_size
+            if self._position < file_start:
+                part = self._head[self._position:self._position + wanted]
+            elif self._position < tail_start:
+                self._file.seek(self._position - file_start)
+                part = self._file.read(min(wanted, tail_start - self._position))
+                if not part:
+                    raise IOError(f"{self._file.name} changed size while it was being uploaded")
+            else:
+                part = self._tail[self._position - tail_start:self._position - tail_start + wanted]
+            data += part
+            self._position += len(part)
+        if data and self.bandwidth is not None:
+            self.bandwidth.acquire(len(data))
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(self.chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def __len__(self):
+        return self.len
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self.len
+        self._position = max(0, min(offset, self.len))
+        return self._position
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
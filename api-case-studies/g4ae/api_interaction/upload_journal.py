@@ -0,0 +1,242 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+
+# Size of the buffer used to hash the knowledge objects
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(file_path: str):
+    """Returns the SHA-256 hash of a file, reading it in chunks so large files are never fully in memory."""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def hash_record(record: dict, file_hashes: list):
+    """
+    Returns a SHA-256 hash of a metadata record and the content of the knowledge objects it refers to.
+    The hash does not depend on the order of the keys, so it only changes when the record or its files change.
+    """
+    state = json.dumps({'metadata': record, 'files': file_hashes}, sort_keys=True, separators=(',', ':'),
+                       ensure_ascii=False, default=str)
+    return hashlib.sha256(state.encode('utf-8')).hexdigest()
+
+
+def get_database_ids(knowledge_objects: str):
+    """
+    Returns the sorted database IDs of the knowledge objects of a stored metadata record, kept as a JSON list of
+    strings or of {"database_id": ..., "language": ...}
+    """
+    database_ids = (ko['database_id'] if isinstance(ko, dict) else ko for ko in json.loads(knowledge_objects))
+    return sorted(database_ids, key=str)
+
+
+class UploadJournal:
+    """
+    Keeps track of the knowledge objects and metadata records that have been uploaded in a local SQLite database.
+    Every upload is written to the journal as soon as the API confirms it, so a run that stops halfway can be
+    resumed without uploading anything twice.
+    The journal also keeps the hash of every submitted metadata record (see hash_record) and of every knowledge
+    object file by size and modification time, so a sync only submits what is new since the last run.
+    A stored record that is submitted again is kept in replaced_metadata_records, so every record the API created
+    can still be traced.
+    A single UploadJournal can be shared between threads.
+    """
+
+    def __init__(self, journal_path: str):
+        self.journal_path = journal_path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS knowledge_objects (
+                project_id TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                database_id TEXT NOT NULL,
+                uploaded_at REAL NOT NULL,
+                PRIMARY KEY (project_id, file_name)
+            )""")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS knowledge_objects_sha256 ON knowledge_objects (project_id, sha256)")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS metadata_records (
+                project_id TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                knowledge_objects TEXT NOT NULL,
+                status_code INTEGER NOT NULL,
+                response TEXT,
+                submitted_at REAL NOT NULL,
+                record_hash TEXT,
+                stable_key INTEGER,
+                PRIMARY KEY (project_id, record_key)
+            )""")
+        # Journals written before record hashes were kept, or before records were keyed on their knowledge objects
+        # instead of their position (stable_key), get the columns added, see get_record_state
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(metadata_records)")]
+        if 'record_hash' not in columns:
+            self._connection.execute("ALTER TABLE metadata_records ADD COLUMN record_hash TEXT")
+        if 'stable_key' not in columns:
+            self._connection.execute("ALTER TABLE metadata_records ADD COLUMN stable_key INTEGER")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS metadata_records_hash ON metadata_records (project_id, record_hash)")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS replaced_metadata_records (
+                project_id TEXT NOT NULL,
+                record_key TEXT NOT NULL,
+                knowledge_objects TEXT NOT NULL,
+                status_code INTEGER NOT NULL,
+                response TEXT,
+                submitted_at REAL NOT NULL,
+                record_hash TEXT,
+                replaced_at REAL NOT NULL
+            )""")
+        self._connection.execute("""
+            CREATE TABLE IF NOT EXISTS file_hashes (
+                file_path TEXT NOT NULL PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL
+            )""")
+        self._connection.commit()
+        # Records keyed on their position, by the database IDs of their knowledge objects, see get_record_state
+        self._positional_records = None
+
+    def get_database_id(self, project_id: str, sha256: str):
+        """
+        Returns the database ID of a knowledge object that was already uploaded with exactly the same content,
+        under any file name, or None if it still has to be uploaded
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT database_id FROM knowledge_objects WHERE project_id = ? AND sha256 = ? "
+                "ORDER BY uploaded_at DESC",
+                (project_id, sha256)).fetchone()
+        return row[0] if row else None
+
+    def record_knowledge_object(self, project_id: str, file_name: str, size: int, sha256: str, database_id: str):
+        """Records a knowledge object file that was uploaded successfully"""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO knowledge_objects VALUES (?, ?, ?, ?, ?, ?)",
+                (project_id, file_name, size, sha256, database_id, time.time()))
+            self._connection.commit()
+
+    def is_metadata_submitted(self, project_id: str, record_key: str):
+        """Returns True if the metadata record was already stored by the API"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT status_code FROM metadata_records WHERE project_id = ? AND record_key = ?",
+                (project_id, record_key)).fetchone()
+        return row is not None and row[0] == 200
+
+    def get_record_state(self, project_id: str, record_key: str, record_hash: str, file_hashes: list):
+        """
+        Compares a metadata record with the records already stored by the API, given the SHA-256 hashes of its
+        knowledge objects. Returns the state of the record and the API response for the record stored before
+        under record_key, if any. The state is
+        'unchanged' if a record with exactly the same content and knowledge objects was stored, under any key,
+        'new' if no record was stored under record_key,
+        'changed' if a record with other content or knowledge objects was stored under record_key.
+        Records stored before they were keyed on their knowledge objects are found by the database IDs of their
+        knowledge objects instead, and get record_key.
+        A record stored before record hashes were kept cannot be compared on its content, only on the database IDs
+        of its knowledge objects. If these differ it is 'changed'. If they are the same it is 'unverified', and it
+        gets the hash of the record, so the next sync compares it like any other record.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM metadata_records WHERE project_id = ? AND record_hash = ? AND status_code = 200",
+                (project_id, record_hash)).fetchone()
+            if row is not None:
+                return 'unchanged', None
+
+            database_ids = []
+            for sha256 in file_hashes:
+                row = self._connection.execute(
+                    "SELECT database_id FROM knowledge_objects WHERE project_id = ? AND sha256 = ?",
+                    (project_id, sha256)).fetchone()
+                database_ids.append(row[0] if row else None)
+            database_ids = None if None in database_ids else sorted(database_ids)
+
+            previous = self._connection.execute(
+                "SELECT rowid, record_hash, knowledge_objects, response FROM metadata_records "
+                "WHERE project_id = ? AND record_key = ? AND status_code = 200",
+                (project_id, record_key)).fetchone()
+            if previous is None and database_ids is not None:
+                previous = self.find_positional_record(project_id, database_ids)
+                if previous is not None:
+                    self._connection.execute(
+                        "UPDATE OR REPLACE metadata_records SET record_key = ?, stable_key = 1 WHERE rowid = ?",
+                        (record_key, previous[0]))
+                    self._connection.commit()
+            if previous is None:
+                return 'new', None
+
+            rowid, previous_hash, knowledge_objects, response = previous
+            if previous_hash is not None or database_ids != get_database_ids(knowledge_objects):
+                return 'changed', json.loads(response)
+            self._connection.execute(
+                "UPDATE metadata_records SET record_hash = ? WHERE rowid = ?", (record_hash, rowid))
+            self._connection.commit()
+        return 'unverified', json.loads(response)
+
+    def find_positional_record(self, project_id: str, database_ids: list):
+        """
+        Returns the stored record, keyed on its position, of the knowledge objects with the given sorted database IDs,
+        or None. The records are indexed on the first call, and a record is only returned once.
+        Must be called with the lock held.
+        """
+        if self._positional_records is None:
+            self._positional_records = {}
+            for record in self._connection.execute(
+                    "SELECT rowid, record_hash, knowledge_objects, response, project_id FROM metadata_records "
+                    "WHERE status_code = 200 AND stable_key IS NULL"):
+                key = (record[4], tuple(get_database_ids(record[2])))
+                self._positional_records.setdefault(key, record[:4])
+        return self._positional_records.pop((project_id, tuple(database_ids)), None)
+
+    def record_metadata(self, project_id: str, record_key: str, knowledge_objects: list, status_code: int,
+                        response, record_hash: str = None):
+        """
+        Records the result of submitting a metadata record. A record the API stored before under the same
+        record_key is moved to replaced_metadata_records.
+        """
+        with self._lock:
+            self._connection.execute(
+                "INSERT INTO replaced_metadata_records (project_id, record_key, knowledge_objects, status_code, "
+                "response, submitted_at, record_hash, replaced_at) "
+                "SELECT project_id, record_key, knowledge_objects, status_code, response, submitted_at, record_hash, ? "
+                "FROM metadata_records WHERE project_id = ? AND record_key = ? AND status_code = 200",
+                (time.time(), project_id, record_key))
+            self._connection.execute(
+                "INSERT OR REPLACE INTO metadata_records (project_id, record_key, knowledge_objects, status_code, "
+                "response, submitted_at, record_hash, stable_key) VALUES (?, ?, ?, ?, ?, ?, ?, 1)",
+                (project_id, record_key, json.dumps(knowledge_objects), status_code, json.dumps(response),
+                 time.time(), record_hash))
+            self._connection.commit()
+
+    def get_file_hash(self, file_path: str, size: int, mtime_ns: int):
+        """Returns the SHA-256 hash of a file hashed before, or None if it was not hashed or has changed since"""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT sha256 FROM file_hashes WHERE file_path = ? AND size = ? AND mtime_ns = ?",
+                (file_path, size, mtime_ns)).fetchone()
+        return row[0] if row else None
+
+    def record_file_hash(self, file_path: str, size: int, mtime_ns: int, sha256: str):
+        """Keeps the hash of a file, so it is not hashed again while its size and modification time stay the same"""
+        with self._lock:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)", (file_path, size, mtime_ns, sha256))
+            self._connection.commit()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -1,17 +1,98 @@
 import json
 import os
-import requests
-from metadata_processing.process_metadata import ExcelDataProcessor
-from auth.token_management import get_token
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from metadata_processing.metadata_cache import load_processed_metadata
+from metadata_processing.process_metadata import ExcelDataProcessor, dataframe_to_records, read_metadata_record, \
+    PIPELINE_VERSION
+from metadata_processing.validate_metadata import MetadataValidator, load_vocabularies
+from api_interaction.streaming_upload import MultipartFileStream
+from api_interaction.deduplication import KnowledgeObjectUploader
+from api_interaction.instrumentation import metrics
+from api_interaction.knowledge_object_index import KnowledgeObjectIndex
+from api_interaction.pipeline import Pipeline, Stage, StageError, interleave
+from api_interaction.upload_budget import ByteBudget, mix_sizes
+from api_interaction.upload_journal import UploadJournal, hash_record
+from auth import http_client
+from auth.flow_control import TokenBucket
+from auth.token_management import get_token, renew_rejected_token
 from dotenv import load_dotenv
 
 # get environment variables
 load_dotenv()
-API_ADDRESS = os.environ.get("API_ADDRESS")
 project_id = os.environ.get("PROJECT_ID")
+# Maximum number of metadata files uploaded at the same time, 1 keeps the original sequential behaviour
+max_workers = int(os.environ.get("MAX_WORKERS", 1))
+# With MAX_WORKERS above 1, the upload runs as a pipeline and each stage can have its own number of workers:
+# processing the metadata files, reading and hashing the knowledge objects, uploading them, and submitting the metadata
+parse_workers = int(os.environ.get("PARSE_WORKERS", 2))
+read_workers = int(os.environ.get("READ_WORKERS", 2))
+# The upload and metadata workers default to the max_workers of the run
+upload_workers = int(os.environ.get("UPLOAD_WORKERS", 0))
+metadata_workers = int(os.environ.get("METADATA_WORKERS", 0))
+# Most MB of knowledge objects uploaded at the same time and most MB per second sent by all uploads together,
+# on top of the number of upload workers. 0 means no limit.
+upload_budget_mb = float(os.environ.get("UPLOAD_BUDGET_MB", 0))
+upload_bandwidth_mb = float(os.environ.get("UPLOAD_BANDWIDTH_MB", 0))
+upload_budget = ByteBudget(int(upload_budget_mb * 1e6) or None)
+upload_bandwidth = TokenBucket(upload_bandwidth_mb * 1e6) if upload_bandwidth_mb else None
+# Read the metadata files without pandas, see read_metadata_record. With MAX_WORKERS above 1 they are read in
+# PARSE_WORKERS separate processes. Set to false to process them with the ExcelDataProcessor instead.
+fast_parser = os.environ.get("FAST_PARSER", "true").lower() in ['true', 't', 'yes', 'y']
+# Database ID sent in place of the real one on a metadata-only dry run, when the knowledge objects are not uploaded
+placeholder_database_id = os.environ.get("PLACEHOLDER_DATABASE_ID", "metadata-only-dry-run")
 
 metadata_folder_path = "data"
 ko_folder_path = "data/kos/"
+# Local record of everything that was uploaded, used to resume a run that stopped halfway
+journal_path = os.environ.get("UPLOAD_JOURNAL", os.path.join(metadata_folder_path, "upload_journal.sqlite"))
+# Processed metadata is kept here, so unchanged metadata files are not processed again on the next run
+metadata_cache_dir = os.environ.get("METADATA_CACHE_DIR", os.path.join(metadata_folder_path, "cache"))
+# Controlled vocabularies used to validate the metadata locally on a dry run, see validate_metadata.py
+vocabulary_file = os.environ.get("VOCABULARY_FILE", os.path.join(metadata_folder_path, "vocabularies.json"))
+validation_report_path = os.path.join(metadata_folder_path, "validation_report.json")
+# Durations, bytes and status codes of every step of the last run, see instrumentation.py
+run_report_path = os.environ.get("RUN_REPORT", os.path.join(metadata_folder_path, "run_report.json"))
+
+
+def get_default_target():
+    """
+    Returns what a run uploads without a manifest: the .xlsm metadata files in metadata_folder_path, with their
+    knowledge objects in ko_folder_path, uploaded to the PROJECT_ID project
+    """
+    return {'project_id': project_id, 'metadata_folder_path': metadata_folder_path, 'ko_folder_path': ko_folder_path,
+            'name': None}
+
+
+def load_manifest(manifest_path: str):
+    """
+    Reads a run manifest: a JSON list of the folders of .xlsm metadata files to upload in one run, each to its own
+    project and optionally with its own knowledge object folder (the kos folder in the metadata folder by default),
+    e.g.
+        [{"project_id": "...", "metadata_folder": "data/project_a"},
+         {"project_id": "...", "metadata_folder": "data/project_b", "ko_folder": "data/project_b_kos/"}]
+    Returns the upload targets, like get_default_target does for the data folder.
+    """
+    with open(manifest_path, encoding='utf-8') as f:
+        entries = json.load(f)
+    targets = []
+    for number, entry in enumerate(entries, start=1):
+        if not entry.get('project_id') or not entry.get('metadata_folder'):
+            raise Exception(f"Entry {number} of {manifest_path} needs a project_id and a metadata_folder")
+        targets.append({'project_id': entry['project_id'],
+                        'metadata_folder_path': entry['metadata_folder'],
+                        'ko_folder_path': entry.get('ko_folder', os.path.join(entry['metadata_folder'], 'kos')),
+                        'name': entry['metadata_folder']})
+    return targets
+
+
+def get_file_name(target: dict, metadata_file_path: str):
+    """
+    Returns the name of a metadata file in messages and reports: its file name, or its folder and file name for
+    a metadata folder from a manifest
+    """
+    file_name = os.path.basename(metadata_file_path)
+    return os.path.join(target['name'], file_name) if target['name'] else file_name
 
 
 def process_metadata(metadata_file_path: str):
@@ -19,54 +100,79 @@ def process_metadata(metadata_file_path: str):
     Processes the metadata from the metadata_file_path variable set on the top of the script
     See process_metadata.py for more details
     """
-    processor = ExcelDataProcessor(metadata_file_path)
-    processor.pivot_table()
-    processor.rename_columns()
-    processor.remove_columns()
-    processor.convert_creators_columns()
-    processor.convert_list_properties()
+    with metrics.measure('process_metadata.load_excel_to_pandas', os.path.getsize(metadata_file_path)):
+        processor = ExcelDataProcessor(metadata_file_path)
+    for step in [processor.pivot_table,
+                 processor.rename_columns,
+                 processor.remove_columns,
+                 processor.convert_creators_columns,
+                 processor.convert_list_properties]:
+        with metrics.measure(f"process_metadata.{step.__name__}"):
+            step()
     df = processor.df
     return df
 
 
-def get_knowledge_object(knowledge_object_file_name):
+def get_knowledge_object(knowledge_object_file_name, ko_index: KnowledgeObjectIndex = None):
     """
-    Imports the physical knowledge object from the data directory and returns the file name and content (Binary)
+    Finds the physical knowledge object in the data directory and returns the file name and path.
+    With a ko_index, the file is looked up in the index of its folder instead of on disk.
+    The file itself is read while it is uploaded, see upload_ko_to_eufarmbook
     """
 
-    file_path = f"{ko_folder_path}{knowledge_object_file_name}"
+    folder_path = ko_index.folder_path if ko_index is not None else ko_folder_path
+    file_path = os.path.join(folder_path, knowledge_object_file_name)
 
-    with open(file_path, 'rb') as file:
-        ko_content = file.read()
+    with metrics.measure('get_knowledge_object') as event:
+        if ko_index is not None:
+            ko_file = ko_index.get(knowledge_object_file_name)
+            if ko_file is None:
+                raise FileNotFoundError(f"No knowledge object found at the specified path: {file_path}")
+            file_path = ko_file['path']
+            event['bytes'] = ko_file['size']
+        else:
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(f"No knowledge object found at the specified path: {file_path}")
+            event['bytes'] = os.path.getsize(file_path)
 
-    return knowledge_object_file_name, ko_content
+    return knowledge_object_file_name, file_path
 
 
-def upload_ko_to_eufarmbook(ko_file_name, ko_content):
+def upload_ko_to_eufarmbook(ko_file_name, ko_file_path, project: str = None):
     """
-    Uploads the knowledge object to the EU-FarmBook (file only, not metadata)
+    Uploads the knowledge object to the EU-FarmBook (file only, not metadata),
+    to the given project ID or PROJECT_ID by default.
+    The file is streamed from disk in small chunks, so it is never loaded into memory as a whole.
+    The upload waits until the file fits in the upload_budget, and is sent no faster than the upload_bandwidth
+    allows, both shared by all uploads.
     """
-
-    url = f"{API_ADDRESS}/api/upload/knowledge_object_file"
-    token = get_token()
-
-    headers = {
-        'accept': 'application/json'
-    }
+    with metrics.measure('get_token'):
+        token = get_token()
 
     # Set the query parameters
     query_params = {
         'user_tokens': json.dumps(token),
-        'project_id': project_id
-    }
-
-    # Set the file to upload
-    files = {
-        'ufile': (ko_file_name, ko_content)
+        'project_id': project or project_id
     }
 
     try:
-        response = requests.post(url, headers=headers, params=query_params, files=files)
+        # Set the file to upload
+        with upload_budget.reserve(os.path.getsize(ko_file_path)), \
+                MultipartFileStream('ufile', ko_file_name, ko_file_path, bandwidth=upload_bandwidth) as body, \
+                metrics.measure('upload_ko_to_eufarmbook', body.len) as event:
+            headers = {
+                'accept': 'application/json',
+                'Content-Type': body.content_type
+            }
+            response = http_client.post("/api/upload/knowledge_object_file",
+                                        headers=headers, params=query_params, data=body)
+            if response.status_code == 401:
+                # The access token was revoked before it expired, send the file once more with a new one
+                query_params['user_tokens'] = json.dumps(renew_rejected_token(token))
+                body.seek(0)
+                response = http_client.post("/api/upload/knowledge_object_file",
+                                            headers=headers, params=query_params, data=body)
+            event['status_code'] = response.status_code
     except Exception as e:
         print('error')
         print(e)
@@ -76,26 +182,27 @@ def upload_ko_to_eufarmbook(ko_file_name, ko_content):
     else:
         return response
 
-def upload_metadata_to_eufarmbook(database_id: str, metadata: dict, dry_run: bool):
+def upload_metadata_to_eufarmbook(database_id: str, metadata: dict, dry_run: bool, project: str = None):
     """
-    Uploads the knowledge object metadata.
+    Uploads the knowledge object metadata, to the given project ID or PROJECT_ID by default.
     If dry_run is set to True, it will only validate the metadata and not actually upload it.
     It is suggested you run this with dry_run set to True first to ensure the metadata is correct.
     """
     if dry_run:
         print("Dry run in progress...")
-        url = f"{API_ADDRESS}/api/upload/validate_knowledge_object_metadata"
+        endpoint = "/api/upload/validate_knowledge_object_metadata"
     else:
-        url = f"{API_ADDRESS}/api/upload/knowledge_object_metadata"
+        endpoint = "/api/upload/knowledge_object_metadata"
 
-    token = get_token()
+    with metrics.measure('get_token'):
+        token = get_token()
 
     headers = {
         'accept': 'application/json'
     }
 
     query_params = {
-        'project_id': project_id
+        'project_id': project or project_id
     }
 
     language = metadata['language']
@@ -108,45 +215,502 @@ def upload_metadata_to_eufarmbook(database_id: str, metadata: dict, dry_run: boo
         'metadata': metadata
     }
 
-    response = requests.post(url, headers=headers, params=query_params, json=json)
+    with metrics.measure('upload_metadata_to_eufarmbook') as event:
+        response = http_client.post(endpoint, headers=headers, params=query_params, json=json)
+        if response.status_code == 401:
+            # The access token was revoked before it expired, send the metadata once more with a new one
+            json['user_tokens'] = renew_rejected_token(token)
+            response = http_client.post(endpoint, headers=headers, params=query_params, json=json)
+        event['status_code'] = response.status_code
+        event['bytes'] = len(response.request.body or b'')
 
     return response
 
 
-def upload_knowledge_objects_and_metadata(dry_run: bool = False):
+def upload_ko_file(ko_file_name, ko_file_path, project: str = None):
+    """
+    Uploads the knowledge object file and returns the database ID given to it by the EU-FarmBook
+    """
+    upload_ko = upload_ko_to_eufarmbook(ko_file_name, ko_file_path, project)
+    return upload_ko.json()['database_id']
+
+
+def parse_metadata_file(job: dict, parse_pool: ProcessPoolExecutor = None):
+    """
+    First step of uploading a metadata file: processes the .xlsm file into the metadata record.
+    With fast_parser the 'Fill Me' sheet is read straight into the record, in one of the processes of parse_pool
+    if one is given, so many metadata files are read in parallel.
+    Otherwise the processed metadata is loaded from the cache if the metadata file has not changed since the last
+    run. pivot_table() turns the 'Fill Me' sheet into a single row, so every metadata file holds one record.
+    """
+    metadata_file_path = job['metadata_file_path']
+    if fast_parser:
+        with metrics.measure('read_metadata_record'):
+            if parse_pool is None:
+                record = read_metadata_record(metadata_file_path)
+            else:
+                record = parse_pool.submit(read_metadata_record, metadata_file_path).result()
+    else:
+        with metrics.measure('load_processed_metadata'):
+            df = load_processed_metadata(metadata_file_path,
+                                         lambda: process_metadata(metadata_file_path=metadata_file_path),
+                                         PIPELINE_VERSION, metadata_cache_dir)
+        record = dataframe_to_records(df)[0]
+    # remove unnecessary columns
+    job['ko_file_name'] = record.pop('file name (*)')
+    job['record'] = record
+    return job
+
+
+def list_metadata_files(folder_path: str = None):
+    """
+    Returns the paths of the .xlsm metadata files in the given folder, the data folder by default
+    """
+    folder_path = folder_path or metadata_folder_path
+    return [os.path.join(folder_path, file) for file in os.listdir(folder_path) if file.endswith(".xlsm")]
+
+
+def parse_metadata_files(parse_pool: ProcessPoolExecutor = None, targets: list = None):
+    """
+    Processes all metadata files in the metadata folders of the targets (the data folder by default), in parallel
+    if a parse_pool is given, and returns a job for every metadata file in the order of the targets and the order
+    the files are listed in. A metadata file that cannot be processed is returned as a StageError of the 'parse'
+    step, so it is reported with the upload results.
+    """
+    def parse(job):
+        try:
+            return parse_metadata_file(job, parse_pool)
+        except Exception as e:
+            return StageError('parse', job, e)
+
+    jobs = [{'metadata_file_path': path, 'name': get_file_name(target, path), 'target': target, 'errors': []}
+            for target in targets or [get_default_target()]
+            for path in list_metadata_files(target['metadata_folder_path'])]
+    for position, job in enumerate(jobs):
+        job['position'] = position
+    with ThreadPoolExecutor(max_workers=parse_workers if parse_pool is not None else 1) as executor:
+        return list(executor.map(parse, jobs))
+
+
+def validate_metadata(parse_pool: ProcessPoolExecutor = None, jobs: list = None, targets: list = None):
+    """
+    Validates the metadata of all metadata files locally, without calling the EU-FarmBook API, see MetadataValidator.
+    Prints a summary, saves the full error report to validation_report_path and returns the report.
+    The errors are listed per metadata file. The metadata files are read in parallel if a parse_pool is given,
+    unless the jobs from parse_metadata_files are given. With targets from a manifest, the metadata files of all
+    their folders are validated.
+    """
+    vocabularies = load_vocabularies(vocabulary_file)
+    validator = MetadataValidator(vocabularies)
+    if not vocabularies:
+        print(f"No vocabulary tables found at {vocabulary_file}, only the license is checked against a controlled "
+              f"vocabulary")
+
+    if jobs is None:
+        jobs = parse_metadata_files(parse_pool, targets)
+    for job in jobs:
+        if isinstance(job, StageError):
+            print(f"An error occurred processing {job.item['metadata_file_path']}: {job.exception}")
+
+    report = validator.validate_records((job['name'], job['record']) for job in jobs if not isinstance(job, StageError))
+
+    with open(validation_report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    for file, errors in report['errors'].items():
+        print(f"{file}: {'; '.join(errors)}")
+    print(f"Validated {report['records']} metadata files locally, {report['invalid_records']} invalid. "
+          f"Full report saved to {validation_report_path}")
+    return report
+
+
+def get_record_key(target: dict, ko_file_names: list):
+    """
+    Returns the key of a metadata record in the upload journal: the full paths of the knowledge objects it describes.
+    Unlike the position of the record, it stays the same when records are added, removed or moved in the metadata,
+    and it differs for metadata with the same file name in different folders.
+    """
+    folder_path = os.path.abspath(target['ko_folder_path'])
+    return ";".join(sorted(os.path.join(folder_path, name) for name in ko_file_names))
+
+
+def check_knowledge_objects(jobs: list, target: dict):
+    """
+    Checks that the knowledge object of every metadata file of a target is in its knowledge object folder before
+    anything is uploaded, and keeps its size. A missing file is added to the errors of the metadata file, so it is
+    reported without uploading anything.
+    """
+    ko_index = target['ko_index']
+    missing = 0
+    for job in jobs:
+        ko_file = ko_index.get(job['ko_file_name'])
+        job['size'] = ko_file['size'] if ko_file is not None else 0
+        if ko_file is None:
+            error = ("No knowledge object found at the specified path: "
+                     f"{os.path.join(ko_index.folder_path, job['ko_file_name'])}")
+            job['errors'] = job['errors'] + [error]
+            print(f"{job['name']}: {error}")
+            missing += 1
+    size = sum(job['size'] for job in jobs)
+    print(f"Found {len(ko_index)} knowledge objects in {ko_index.folder_path}, {size / 1e6:.1f} MB to upload for "
+          f"{len(jobs)} metadata files. {missing} knowledge objects are missing, their metadata is not uploaded.")
+
+
+def get_file_result(job: dict, database_id: str = None, status_code: int = None, response=None,
+                    skipped: bool = False):
+    """Returns the result of a metadata file, as it is reported once all files are processed"""
+    return {'project_id': job['target']['project_id'], 'metadata_file': job['name'],
+            'file': job.get('ko_file_name'), 'database_id': database_id, 'status_code': status_code,
+            'response': response, 'skipped': skipped, 'unchanged': job.get('sync_state') == 'unchanged',
+            'changed': job.get('sync_state') == 'changed', 'unverified': job.get('sync_state') == 'unverified',
+            'previous_response': job.get('previous_response')}
+
+
+def failed_result(error: StageError):
+    """Prints the error of a metadata file that failed in one of the steps, and returns its result"""
+    print(f"An error occurred processing {error.item['metadata_file_path']}: {error.exception}")
+    return get_file_result(error.item, response=str(error.exception))
+
+
+def prepare_metadata_file(job: dict, journal: UploadJournal, resume: bool, sync: bool = False,
+                          metadata_only: bool = False, allow_changed: bool = False):
+    """
+    Second step of uploading a metadata file: finds its knowledge object on disk and hashes it.
+    When resuming, metadata files whose metadata was already uploaded are marked as skipped.
+    When syncing, metadata files whose metadata and knowledge object are the same as a record already uploaded
+    are marked as skipped and unchanged. The API has no way to update a record, so a metadata file that changed
+    since it was uploaded would create a second record next to the first one: it fails, with the response the API
+    gave for the first record, unless allow_changed is set, in which case it is submitted as a new record.
+    See UploadJournal.get_record_state.
+    On a metadata-only dry run the knowledge object is not uploaded, so it is only hashed when syncing.
+    """
+    target = job['target']
+    ko_file_name = job['ko_file_name']
+    job['record_key'] = get_record_key(target, [ko_file_name])
+    job['skipped'] = resume and journal.is_metadata_submitted(target['project_id'], job['record_key'])
+    if job['skipped']:
+        print(f"Skipping {ko_file_name}, metadata already uploaded")
+        return job
+    if job['errors']:
+        print(f"Skipping {ko_file_name}: {'; '.join(job['errors'])}")
+        return job
+
+    print(f"Attempting upload for {ko_file_name}")
+    job['ko_file_name'], job['ko_file_path'] = get_knowledge_object(knowledge_object_file_name=ko_file_name,
+                                                                        ko_index=target['ko_index'])
+    if metadata_only and not sync:
+        # Nothing is uploaded or recorded in the journal, so the knowledge object is not read
+        return job
+
+    with metrics.measure('hash_knowledge_object') as event:
+        event['bytes'], sha256 = target['uploader'].get_file_hash(job['ko_file_path'])
+
+    job['record_hash'] = hash_record(job['record'], [{'sha256': sha256}])
+    if not sync:
+        return job
+    job['sync_state'], job['previous_response'] = journal.get_record_state(
+        target['project_id'], job['record_key'], job['record_hash'], [sha256])
+    if job['sync_state'] == 'unchanged':
+        print(f"Skipping {ko_file_name}, unchanged since it was uploaded")
+    elif job['sync_state'] == 'changed' and allow_changed:
+        print(f"Warning: {job['name']} changed since it was uploaded as {job['previous_response']}. "
+              f"It is submitted again as a new record")
+    elif job['sync_state'] == 'changed':
+        job['errors'] = job['errors'] + [
+            f"changed since it was uploaded as {job['previous_response']}; not submitted again as that would create "
+            f"a second record, sync with --allow-changed to submit it as a new record"]
+        print(f"Skipping {ko_file_name}: {job['errors'][-1]}")
+    elif job['sync_state'] == 'unverified':
+        print(f"Warning: {job['name']} was uploaded as {job['previous_response']} before the journal "
+              f"kept record hashes. Its knowledge object is the same, its metadata could not be compared")
+    job['skipped'] = job['sync_state'] in ('unchanged', 'unverified')
+    return job
+
+
+def upload_metadata_file_ko(job: dict):
+    """
+    Third step of uploading a metadata file: uploads its knowledge object and keeps the database ID
+    """
+    job['database_id'] = None
+    job['error'] = None
+    if job['skipped'] or job['errors']:
+        return job
+
+    try:
+        job['database_id'] = job['target']['uploader'].upload(job['ko_file_name'], job['ko_file_path'])
+    except Exception as e:
+        job['error'] = str(e)
+        print(f"An error occurred uploading knowledge object {e}")
+    return job
+
+
+def check_knowledge_object(file_path: str):
+    """
+    Checks that a knowledge object can be opened and read, without reading the whole file.
+    Raises an OSError if it cannot.
+    """
+    with open(file_path, 'rb') as f:
+        f.read(1)
+
+
+def check_metadata_file_ko(job: dict):
+    """
+    Third step of a metadata-only dry run, instead of upload_metadata_file_ko: checks that the knowledge object can
+    be read and gives it the placeholder_database_id, so only the metadata is sent to the validation endpoint.
+    A knowledge object that cannot be read is added to the errors of the metadata file.
+    """
+    job['database_id'] = None
+    job['error'] = None
+    if job['skipped'] or job['errors']:
+        return job
+
+    try:
+        with metrics.measure('check_knowledge_object'):
+            check_knowledge_object(job['ko_file_path'])
+        job['database_id'] = placeholder_database_id
+    except OSError as e:
+        job['errors'] = job['errors'] + [f"Cannot read knowledge object {job['ko_file_path']}: {e}"]
+        print(f"{job['name']}: cannot read knowledge object {job['ko_file_path']}: {e}")
+    return job
+
+
+def submit_metadata_file_metadata(job: dict, dry_run: bool, journal: UploadJournal):
+    """
+    Last step of uploading a metadata file: submits the metadata with the database ID of its knowledge object
+    to the project of its target.
+    Returns a dictionary with the result for the metadata file so it can be reported once all files are processed.
+    """
+    ko_file_name = job['ko_file_name']
+    database_id = job['database_id']
+    project = job['target']['project_id']
+    result = get_file_result(job, database_id, response=job['errors'] or job['error'], skipped=job['skipped'])
+    if job['errors']:
+        return result
+    if job['skipped'] or job['error'] is not None:
+        return result
+
+    try:
+        response = upload_metadata_to_eufarmbook(database_id, metadata=job['record'], dry_run=dry_run,
+                                                 project=project)
+        result['status_code'] = response.status_code
+        result['response'] = response.json()
+
+        if response.status_code != 200:
+            print(f"An error occured {response.status_code} - {response.json()}")
+        else:
+            print(f"Success: Uploaded metadata for {ko_file_name} and knowledge object {database_id}. "
+                  f"EU-FarmBook ID: {response.json()}")
+
+        if not dry_run:
+            journal.record_metadata(project, job['record_key'], [database_id], response.status_code,
+                                    response.json(), job['record_hash'])
+    except Exception as e:
+        result['response'] = str(e)
+        print(f"An error occurred uploading knowledge object {e}")
+    return result
+
+
+def upload_metadata_file(job: dict, dry_run: bool, journal: UploadJournal, resume: bool = False, sync: bool = False,
+                         metadata_only: bool = False, allow_changed: bool = False):
+    """
+    Uploads the knowledge object described by a single processed .xlsm metadata file followed by its metadata,
+    one step after the other. An error in any of the steps fails the metadata file only, like it does in the pipeline.
+    """
+    try:
+        job = prepare_metadata_file(job, journal, resume, sync, metadata_only, allow_changed)
+        job = check_metadata_file_ko(job) if metadata_only else upload_metadata_file_ko(job)
+        return submit_metadata_file_metadata(job, dry_run, journal)
+    except Exception as e:
+        print(f"An error occurred processing {job['metadata_file_path']}: {e}")
+        return get_file_result(job, response=str(e))
+
+
+def upload_knowledge_objects_and_metadata(dry_run: bool = False, max_workers: int = max_workers,
+                                          resume: bool = False, sync: bool = False, targets: list = None,
+                                          metadata_only: bool = False, allow_changed: bool = False):
     """
     This is the main runner for the script
+    All metadata files are processed first. With fast_parser and max_workers above 1, they are read in
+    parse_workers separate processes. The knowledge object folder is then listed once and the knowledge object of
+    every metadata file is looked up in it, so missing files are reported before anything is uploaded, see
+    check_knowledge_objects.
+    With max_workers above 1, the metadata files go through a pipeline: the knowledge objects of the next metadata
+    files are read and hashed while earlier ones are uploaded, and metadata is submitted while later files are still
+    uploading. Each stage has its own number of workers (read_workers, upload_workers and metadata_workers) and the
+    stages are connected by bounded queues. The largest knowledge objects are uploaded first, so a few big files do
+    not hold up the end of the run. Each file still uploads its knowledge object before submitting its metadata,
+    so the database ID always ends up on the right record.
+    Knowledge objects are uploaded once per distinct file content, also across runs, see KnowledgeObjectUploader.
+    Besides the number of upload workers, the uploads are limited by the MB in flight and MB per second set with
+    UPLOAD_BUDGET_MB and UPLOAD_BANDWIDTH_MB, see upload_ko_to_eufarmbook.
+    With resume set to True, metadata files whose metadata is recorded in the upload journal are not uploaded again.
+    With sync set to True, only new metadata files are submitted: a file is skipped if a record with the same
+    metadata and knowledge object content was already uploaded. Unchanged knowledge objects are not hashed again.
+    A metadata file that changed since it was uploaded fails, unless allow_changed is set to submit it as a new
+    record, see prepare_metadata_file.
+    With targets from a manifest (see load_manifest), the metadata files of several folders are uploaded in the
+    same run, each folder to its own project. They share the login, the connection pool, the journal and the
+    workers, and take turns: one metadata file of each folder goes into the pipeline in turn, largest first, so a
+    large folder does not keep the others waiting. Without targets, the data folder is uploaded, see
+    get_default_target.
+    On a dry run, the metadata is first validated locally, see validate_metadata. Metadata files with errors are
+    reported without uploading their knowledge object or sending their metadata to the validation endpoint, so the
+    API only checks them on a dry run after their errors are fixed.
+    With metadata_only set to True on a dry run, the knowledge objects are not uploaded at all: they are only checked
+    to be readable and the metadata is validated with the placeholder_database_id, see check_metadata_file_ko.
+    Checking the metadata files then sends kilobytes of metadata instead of all of their knowledge objects.
+    The duration, bytes and status code of every step are written to run_report_path, see write_run_report.
+    If the API stays down for longer than CIRCUIT_BREAKER_MAX_WAIT, no further metadata files are started and, once the
+    run report is written, an exception is raised, see http_client.circuit_breaker.
+    Returns the results of all metadata files, in the order of the targets and the order the files are listed in.
+    """
+    if metadata_only and not dry_run:
+        raise Exception("Only a dry run can skip uploading the knowledge objects")
+    metrics.reset()
+    http_client.circuit_breaker.reset()
+    # The metadata files are read in separate processes, as reading them takes CPU rather than waiting on the API
+    parse_pool = ProcessPoolExecutor(max_workers=parse_workers) if max_workers > 1 and fast_parser else None
+    journal = UploadJournal(journal_path)
+    ko_indexes = {}
+    uploaders = []
+    try:
+        run_targets = []
+        for number, target in enumerate(targets or [get_default_target()]):
+            folder_path = target['ko_folder_path']
+            if folder_path not in ko_indexes:
+                with metrics.measure('index_knowledge_objects'):
+                    ko_indexes[folder_path] = KnowledgeObjectIndex(folder_path)
+            uploader = KnowledgeObjectUploader(partial(upload_ko_file, project=target['project_id']), journal,
+                                               target['project_id'])
+            uploaders.append(uploader)
+            run_targets.append(dict(target, number=number, ko_index=ko_indexes[folder_path], uploader=uploader))
+
+        jobs = parse_metadata_files(parse_pool, run_targets)
+        errors = validate_metadata(jobs=jobs)['errors'] if dry_run else {}
+        if errors:
+            print(f"{len(errors)} metadata files with errors are not sent to the validation endpoint. Fix them and run "
+                  f"the dry run again to have the EU-FarmBook API check them as well")
+        target_jobs = [[] for _ in run_targets]
+        for job in jobs:
+            item = job.item if isinstance(job, StageError) else job
+            target_jobs[item['target']['number']].append(job)
+        for target, jobs_of_target in zip(run_targets, target_jobs):
+            parsed_jobs = [job for job in jobs_of_target if not isinstance(job, StageError)]
+            for job in parsed_jobs:
+                job['errors'] = errors.get(job['name'], [])
+            check_knowledge_objects(parsed_jobs, target)
+            # The largest uploads of every target go first, or alternate with the smallest within an upload budget
+            order = mix_sizes if upload_budget.max_bytes else partial(sorted, reverse=True)
+            jobs_of_target[:] = order(jobs_of_target, key=lambda job: 0 if isinstance(job, StageError) else job['size'])
+
+        # The order the metadata files were started in, to put the results back in the order they are listed in
+        started = []
+
+        def schedule():
+            for job in interleave(target_jobs):
+                if http_client.circuit_breaker.error is not None:
+                    # The API did not come back, the metadata files not started yet would only fail one by one
+                    return
+                started.append(job.item['position'] if isinstance(job, StageError) else job['position'])
+                yield job
+
+        if max_workers <= 1:
+            results = [failed_result(job) if isinstance(job, StageError)
+                       else upload_metadata_file(job, dry_run, journal, resume, sync, metadata_only, allow_changed)
+                       for job in schedule()]
+        else:
+            stage_upload_workers = upload_workers or max_workers
+            stage_metadata_workers = metadata_workers or max_workers
+            # One pooled connection per worker that talks to the API
+            http_client.get_session(pool_size=stage_upload_workers + stage_metadata_workers)
+
+            pipeline = Pipeline([
+                Stage('read', partial(prepare_metadata_file, journal=journal, resume=resume, sync=sync,
+                                      metadata_only=metadata_only, allow_changed=allow_changed), read_workers),
+                Stage('upload', check_metadata_file_ko if metadata_only else upload_metadata_file_ko,
+                      stage_upload_workers),
+                Stage('metadata', partial(submit_metadata_file_metadata, dry_run=dry_run, journal=journal),
+                      stage_metadata_workers),
+            ])
+            results = [failed_result(result) if isinstance(result, StageError) else result
+                       for result in pipeline.run(schedule())]
+        results = [result for _, result in sorted(zip(started, results), key=lambda pair: pair[0])]
+    finally:
+        journal.close()
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+    write_run_report(results, dry_run, max_workers, uploaders, metadata_only)
+    if http_client.circuit_breaker.error is not None:
+        raise Exception(http_client.circuit_breaker.error)
+    return results
+
+
+def summarize_results(results: list):
     """
+    Counts the metadata files that succeeded, were skipped and failed. When syncing, it also counts the metadata
+    files that were unchanged or could not be compared, both skipped, and the ones that changed since they were uploaded
+    """
+    return {
+        'total': len(results),
+        'succeeded': sum(1 for result in results if result['status_code'] == 200),
+        'skipped': sum(1 for result in results if result['skipped']),
+        'unchanged': sum(1 for result in results if result['unchanged']),
+        'changed': sum(1 for result in results if result['changed']),
+        'unverified': sum(1 for result in results if result['unverified']),
+        'failed': sum(1 for result in results if not result['skipped'] and result['status_code'] != 200),
+    }
 
-    for file in os.listdir(metadata_folder_path):
-        if file.endswith(".xlsm"):
-            metadata_file_path = os.path.join(metadata_folder_path, file)
-
-            df = process_metadata(metadata_file_path=metadata_file_path)
-
-            for index, row in df.iterrows():
-                # Access the value of column 'A' for the current row
-                ko_file_name = row['file name (*)']
-                print(f"Attempting upload for {ko_file_name}")
-                ko_file_name, ko_content = get_knowledge_object(knowledge_object_file_name=ko_file_name)
-                print(f"Uploading knowledge object {ko_file_name}")
-                try:
-                    upload_ko = upload_ko_to_eufarmbook(ko_file_name, ko_content)
-                    database_id = upload_ko.json()['database_id']
-                    # Convert the current row to JSON with proper formatting
-                    metadata_json = row.to_json(orient='index', indent=4)
-                    metadata_json = metadata_json.replace("\\/", "/")
-                    # remove unnecessary columns
-                    metadata_json_dict = json.loads(metadata_json)
-                    del metadata_json_dict['file name (*)']
-
-                    response = upload_metadata_to_eufarmbook(database_id, metadata=metadata_json_dict, dry_run=dry_run)
-
-                    if response.status_code != 200:
-                        print(f"An error occured {response.status_code} - {response.json()}")
-                    else:
-                        print(f"Success: Uploaded metadata for {ko_file_name} and knowledge object {database_id}. "
-                              f"EU-FarmBook ID: {response.json()}")
-                except Exception as e:
-                    print(f"An error occurred uploading knowledge object {e}")
 
+def write_run_report(results: list, dry_run: bool, max_workers: int, uploaders: list, metadata_only: bool = False):
+    """
+    Writes the measurements of the run to run_report_path and prints where the time went
+    """
+    projects = {}
+    for result in results:
+        projects.setdefault(result['project_id'], []).append(result)
+    report = metrics.write_report(
+        run_report_path,
+        dry_run=dry_run,
+        metadata_only=metadata_only,
+        max_workers=max_workers,
+        upload_budget={
+            'max_mb': upload_budget_mb or None,
+            'bandwidth_mb_per_second': upload_bandwidth_mb or None,
+            'peak_mb': round(upload_budget.peak / 1e6, 1),
+            'waits': upload_budget.waits,
+        },
+        flow_control={
+            'throttled_requests': http_client.flow_controller.throttled,
+            'final_concurrency': int(http_client.flow_controller.limit),
+            'final_rate': http_client.flow_controller.bucket.rate,
+            'outages': http_client.circuit_breaker.outages,
+            'paused_seconds': round(http_client.circuit_breaker.paused_seconds, 1),
+        },
+        metadata_files=summarize_results(results),
+        projects={project: summarize_results(project_results) for project, project_results in projects.items()},
+        knowledge_objects={'uploaded': sum(uploader.uploaded for uploader in uploaders),
+                           'reused': sum(uploader.reused for uploader in uploaders)})
+
+    print(f"Run finished in {report['elapsed_seconds']}s: {report['metadata_files']}, {report['knowledge_objects']}, "
+          f"{report['throughput']['knowledge_objects_per_second']} KOs/s, "
+          f"{report['throughput']['upload_mb_per_second']} MB/s")
+    if len(projects) > 1:
+        for project, summary in report['projects'].items():
+            print(f"    Project {project}: {summary}")
+    for stage, summary in report['stages'].items():
+        print(f"    {stage}: {summary['count']} calls, {summary['total_seconds']:.2f}s in total, "
+              f"p50 {summary['p50_seconds'] * 1000:.0f}ms, p99 {summary['p99_seconds'] * 1000:.0f}ms")
+    if report['flow_control']['throttled_requests']:
+        print(f"The API throttled {report['flow_control']['throttled_requests']} requests, "
+              f"the run ended with {report['flow_control']['final_concurrency']} requests at a time")
+    if report['flow_control']['outages']:
+        print(f"The EU-FarmBook API was down {report['flow_control']['outages']} times, the run paused for "
+              f"{report['flow_control']['paused_seconds']}s until it was back")
+    if report['metadata_files']['changed']:
+        print(f"{report['metadata_files']['changed']} metadata files changed since they were uploaded and were not "
+              f"submitted again, see the warnings above")
+    if report['upload_budget']['waits']:
+        print(f"{report['upload_budget']['waits']} uploads waited for room in the {upload_budget_mb:g} MB "
+              f"upload budget")
+    print(f"Run report saved to {run_report_path}")
+    return report
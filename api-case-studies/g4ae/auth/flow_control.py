@@ -0,0 +1,277 @@
+import email.utils
+import threading
+import time
+from contextlib import contextmanager
+
+# Requests with a body larger than this have their latency compared per MB, so large uploads don't look slow
+LATENCY_UNIT_BYTES = 1024 * 1024
+
+
+def parse_retry_after(value: str):
+    """
+    Returns the number of seconds to wait from a Retry-After header, given in seconds or as an HTTP date,
+    or None if there is no valid header
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+
+class TokenBucket:
+    """
+    Limits the number of requests per second. Every request takes a token, and tokens are added at the given
+    rate up to burst tokens. A rate of None means no limit. The bucket can be paused, e.g. after a Retry-After.
+    It can also limit bytes per second, with every chunk sent taking as many tokens as it has bytes.
+    """
+
+    def __init__(self, rate: float = None, burst: int = None):
+        self.rate = rate
+        self.burst = burst or max(int(rate or 1), 1)
+        self.tokens = float(self.burst)
+        self.paused_until = 0.0
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """Waits until a request, or a chunk of tokens bytes, can be sent"""
+        # More tokens than fit in the bucket would never be available, take a full bucket instead
+        tokens = min(tokens, self.burst)
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                if wait <= 0 and self.rate is None:
+                    return
+                if wait <= 0:
+                    self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self.tokens >= tokens:
+                        self.tokens -= tokens
+                        return
+                    wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Sends no requests for the given number of seconds"""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def set_rate(self, rate: float):
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self.rate = rate
+
+
+class FlowController:
+    """
+    Adapts the number of requests in flight to what the API can handle, AIMD-style. Starting from
+    initial_concurrency, the limit goes up by one for every limit successful requests, up to max_concurrency.
+    Until the API first pushes back, it goes up by one for every successful request, doubling it every round.
+    The limit is halved when the API throttles (429/503), fails (5xx or connection errors) or gets much slower
+    than usual. After a decrease, it is not decreased again until the requests in flight have had time to return.
+    Throttled responses pause all requests for their Retry-After time. With a rate, requests also go through a
+    token bucket, whose rate is lowered the same way when the API throttles and grows back on success.
+    A single FlowController is shared by all threads.
+    """
+
+    def __init__(self, max_concurrency: int = 1, initial_concurrency: int = 2, rate: float = None,
+                 latency_factor: float = 3.0, decrease_factor: float = 0.5):
+        self.max_concurrency = max(max_concurrency, 1)
+        self.limit = float(min(max(initial_concurrency, 1), self.max_concurrency))
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+        self.latency_factor = latency_factor
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.slow_start = True
+        self.throttled = 0
+        self._latency = {}
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def set_max_concurrency(self, max_concurrency: int):
+        """Sets the highest number of requests in flight, e.g. the size of the connection pool"""
+        with self._condition:
+            self.max_concurrency = max(max_concurrency, 1)
+            self.limit = min(self.limit, self.max_concurrency)
+            self._condition.notify_all()
+
+    @contextmanager
+    def request(self, endpoint: str, size: int = 0):
+        """
+        Waits until a request can be sent, and yields a dictionary on which the with block sets the 'response'.
+        The outcome of the request adjusts the limit when the block ends.
+        """
+        self.bucket.acquire()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        outcome = {'response': None}
+        start = time.monotonic()
+        try:
+            yield outcome
+        except Exception:
+            self.record(endpoint, time.monotonic() - start, size, None, error=True)
+            raise
+        else:
+            response = outcome['response']
+            retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+            self.record(endpoint, time.monotonic() - start, size,
+                        response.status_code if response is not None else None, retry_after=retry_after)
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                self._condition.notify()
+
+    def record(self, endpoint: str, latency: float, size: int, status_code: int, error: bool = False,
+               retry_after: float = None):
+        """Adjusts the limit and rate to the outcome of a request"""
+        if status_code in (429, 503):
+            self.throttled += 1
+            if retry_after:
+                print(f"The EU-FarmBook API asked to slow down, waiting {retry_after:.1f}s")
+                self.bucket.pause(retry_after)
+            self.decrease()
+        elif error or (status_code is not None and status_code >= 500):
+            self.decrease()
+        elif self.is_slow(endpoint, latency, size):
+            self.decrease()
+        else:
+            self.increase()
+
+    def is_slow(self, endpoint: str, latency: float, size: int):
+        """Returns True if the request took much longer than the average of its endpoint"""
+        cost = latency / max(size / LATENCY_UNIT_BYTES, 1.0)
+        with self._condition:
+            average = self._latency.get(endpoint)
+            self._latency[endpoint] = cost if average is None else 0.9 * average + 0.1 * cost
+        return average is not None and cost > self.latency_factor * average
+
+    def increase(self):
+        with self._condition:
+            if self.slow_start:
+                self.limit = min(self.limit + 1, self.max_concurrency)
+            else:
+                self.limit = min(self.limit + 1 / self.limit, self.max_concurrency)
+            self._condition.notify_all()
+        if self.max_rate is not None and self.bucket.rate < self.max_rate:
+            self.bucket.set_rate(min(self.bucket.rate + 1 / max(self.bucket.rate, 1), self.max_rate))
+
+    def decrease(self):
+        with self._condition:
+            now = time.monotonic()
+            # Requests that were already in flight report the same congestion, count it only once
+            average = max(self._latency.values(), default=0.0)
+            if now - self._last_decrease < max(average, 0.1):
+                return
+            self._last_decrease = now
+            self.slow_start = False
+            self.limit = max(self.limit * self.decrease_factor, 1.0)
+        if self.max_rate is not None:
+            self.bucket.set_rate(max(self.bucket.rate * self.decrease_factor, 0.1))
+
+
+class CircuitBreaker:
+    """
+    Stops sending requests while the API is down, instead of letting every remaining request fail on its own.
+    After failure_threshold failed requests in a row (connection errors or 5xx responses, after their retries), the
+    circuit opens: new requests wait, while the thread whose request failed last calls check until it returns True,
+    first after initial_delay seconds and then twice as long every time, up to max_delay. The circuit then closes
+    and the waiting requests are sent. If the API is not back after max_wait seconds, the circuit breaker gives up:
+    the thread checking the API and every request waiting or sent after it raise an exception, so the run stops
+    instead of hanging. A max_wait of None waits forever. A failure_threshold of 0 turns the circuit breaker off.
+    A single CircuitBreaker is shared by all threads, and is reset at the start of every run, see reset.
+    """
+
+    def __init__(self, check, failure_threshold: int = 5, initial_delay: float = 1.0, max_delay: float = 60.0,
+                 max_wait: float = None):
+        self.check = check
+        self.failure_threshold = failure_threshold
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.max_wait = max_wait
+        self.failures = 0
+        self.is_open = False
+        self.error = None
+        self.outages = 0
+        self.paused_seconds = 0.0
+        self._condition = threading.Condition()
+
+    def reset(self):
+        """Closes the circuit, forgets an earlier give-up and starts counting failures, outages and pauses again"""
+        with self._condition:
+            self.failures = 0
+            self.is_open = False
+            self.error = None
+            self.outages = 0
+            self.paused_seconds = 0.0
+            self._condition.notify_all()
+
+    def wait(self):
+        """Waits until the circuit is closed. Raises an exception if the circuit breaker gave up on the API."""
+        with self._condition:
+            while self.is_open and self.error is None:
+                self._condition.wait()
+            if self.error is not None:
+                raise Exception(self.error)
+
+    def record(self, failed: bool):
+        """Counts a request that succeeded or failed. Opens the circuit, and waits until the API is back, if needed."""
+        with self._condition:
+            if not failed:
+                self.failures = 0
+                return
+            self.failures += 1
+            if not self.failure_threshold or self.is_open or self.failures < self.failure_threshold:
+                return
+            self.is_open = True
+            self.outages += 1
+        print(f"{self.failures} requests failed in a row, pausing until the EU-FarmBook API is back")
+        self.wait_for_recovery()
+
+    def wait_for_recovery(self):
+        """
+        Calls check with an exponential backoff until it returns True, then closes the circuit.
+        Raises an exception if it does not return True within max_wait seconds.
+        """
+        start = time.monotonic()
+        delay = self.initial_delay
+        while True:
+            remaining = None if self.max_wait is None else self.max_wait - (time.monotonic() - start)
+            if remaining is not None and remaining <= 0:
+                self.give_up(start)
+            time.sleep(delay if remaining is None else min(delay, remaining))
+            try:
+                recovered = self.check()
+            except Exception as e:
+                print(f"Could not get the status of the EU-FarmBook API: {e}")
+                recovered = False
+            if recovered:
+                break
+            delay = min(delay * 2, self.max_delay)
+            print(f"The EU-FarmBook API is not back yet, checking again in {delay:g}s")
+        with self._condition:
+            self.is_open = False
+            self.failures = 0
+            self.error = None
+            self.paused_seconds += time.monotonic() - start
+            self._condition.notify_all()
+        print(f"The EU-FarmBook API is back after {time.monotonic() - start:.0f}s, resuming")
+
+    def give_up(self, start: float):
+        """Stops waiting for the API, and makes every request waiting for it raise an exception"""
+        with self._condition:
+            self.error = f"The EU-FarmBook API was not back after {time.monotonic() - start:.0f}s, giving up"
+            self.paused_seconds += time.monotonic() - start
+            self._condition.notify_all()
+        raise Exception(self.error)
@@ -0,0 +1,50 @@
+"""
+Compares loading sets of synthetic g4ae metadata files with the Excel engines of load_excel_to_pandas:
+openpyxl, and calamine if python-calamine is installed (pip install python-calamine). Checks that every engine
+reads the same 'Fill Me' sheet as openpyxl.
+
+Run from the root of the g4ae project:
+    python benchmarks/benchmark_excel_engines.py 100 1000
+"""
+import os
+import sys
+import tempfile
+import time
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import create_metadata_files
+from metadata_processing.process_metadata import ExcelDataProcessor, dataframe_to_records, get_excel_engines
+
+
+def load_records(file_paths: list, engine: str):
+    """Loads the metadata files with one engine and returns the seconds it took and the sheet of every file"""
+    start = time.perf_counter()
+    sheets = [dataframe_to_records(ExcelDataProcessor(file_path, engine).df) for file_path in file_paths]
+    return time.perf_counter() - start, sheets
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [100, 1000]
+    # openpyxl goes first, the other engines are compared with it
+    engines = ['openpyxl'] + [engine for engine in get_excel_engines('auto') if engine != 'openpyxl']
+    if len(engines) == 1:
+        print("python-calamine is not installed, only openpyxl is measured. "
+              "Install it with: pip install python-calamine")
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            create_metadata_files(temp_dir, size)
+            file_paths = sorted(os.path.join(temp_dir, file) for file in os.listdir(temp_dir))
+            print(f"{size} metadata files")
+
+            openpyxl_seconds, expected = load_records(file_paths, 'openpyxl')
+            print(f"    {'openpyxl':<10} {openpyxl_seconds:8.2f}s  {size / openpyxl_seconds:8.1f} files/s")
+            for engine in engines[1:]:
+                seconds, sheets = load_records(file_paths, engine)
+                for file_path, expected_sheet, sheet in zip(file_paths, expected, sheets):
+                    if sheet != expected_sheet:
+                        raise AssertionError(f"{engine} reads {file_path} differently:\n{expected_sheet}\n{sheet}")
+                print(f"    {engine:<10} {seconds:8.2f}s  {size / seconds:8.1f} files/s, "
+                      f"{openpyxl_seconds / seconds:.1f}x faster, same sheets")
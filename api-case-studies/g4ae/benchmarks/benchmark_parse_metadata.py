@@ -0,0 +1,61 @@
+"""
+Compares reading g4ae metadata files with the ExcelDataProcessor (pandas) and with read_metadata_record,
+sequentially and in a process pool, and checks that both produce the same metadata records.
+
+Run from the root of the g4ae project:
+    python benchmarks/benchmark_parse_metadata.py 100 1000
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import create_metadata_files
+from metadata_processing.process_metadata import ExcelDataProcessor, read_metadata_record
+
+
+def pandas_record(metadata_file_path: str):
+    """The metadata record as the pandas processing and the upload produce it"""
+    processor = ExcelDataProcessor(metadata_file_path)
+    processor.pivot_table()
+    processor.rename_columns()
+    processor.remove_columns()
+    processor.convert_creators_columns()
+    processor.convert_list_properties()
+    return json.loads(processor.df.iloc[0].to_json(orient='index', indent=4).replace("\\/", "/"))
+
+
+def measure(name: str, function, paths: list):
+    start = time.perf_counter()
+    records = function(paths)
+    elapsed = time.perf_counter() - start
+    print(f"    {name:<40} {elapsed:8.2f}s  {len(paths) / elapsed:8.1f} files/s")
+    return records
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [100, 1000]
+    workers = os.cpu_count() or 2
+
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            create_metadata_files(temp_dir, size)
+            paths = sorted(os.path.join(temp_dir, file) for file in os.listdir(temp_dir))
+            print(f"{size} metadata files")
+
+            expected = measure("ExcelDataProcessor", lambda files: [pandas_record(file) for file in files], paths)
+            records = measure("read_metadata_record", lambda files: [read_metadata_record(file) for file in files],
+                              paths)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                pooled = measure(f"read_metadata_record, {workers} processes",
+                                 lambda files: list(pool.map(read_metadata_record, files, chunksize=8)), paths)
+
+            for path, expected_record, record, pooled_record in zip(paths, expected, records, pooled):
+                if record != expected_record or pooled_record != expected_record:
+                    raise AssertionError(f"Different metadata records for {path}:\n{expected_record}\n{record}")
+            print("    Records are identical")
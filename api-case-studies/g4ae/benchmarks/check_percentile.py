@@ -0,0 +1,55 @@
+"""
+Checks the nearest-rank percentile used in the run report and the benchmarks (instrumentation.percentile) on small
+lists, where rounding mistakes pick a neighbouring value. Exits with status 1 if any percentile is wrong.
+
+Run from the root of the g4ae project:
+    python benchmarks/check_percentile.py
+"""
+import os
+import sys
+
+# The check is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_interaction.instrumentation import percentile
+
+# (values, percent, expected nearest-rank percentile)
+CASES = [
+    ([], 50, None),
+    ([7], 0, 7),
+    ([7], 50, 7),
+    ([7], 100, 7),
+    ([1, 2], 50, 1),
+    ([1, 2], 51, 2),
+    ([1, 2], 99, 2),
+    ([1, 2, 3], 50, 2),
+    ([1, 2, 3, 4], 25, 1),
+    ([1, 2, 3, 4], 50, 2),
+    ([1, 2, 3, 4], 75, 3),
+    ([1, 2, 3, 4], 76, 4),
+    ([1, 2, 3, 4, 5], 50, 3),
+    ([1, 2, 3, 4, 5], 90, 5),
+    ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 90, 9),
+    ([1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 99, 10),
+    (list(range(1, 101)), 7, 7),
+    (list(range(1, 101)), 50, 50),
+    (list(range(1, 101)), 99, 99),
+]
+
+
+def check_percentile():
+    """Returns a description of every case where percentile does not return the nearest-rank percentile"""
+    problems = []
+    for values, percent, expected in CASES:
+        actual = percentile(values, percent)
+        if actual != expected:
+            problems.append(f"the {percent}th percentile of {len(values)} values is {actual} instead of {expected}")
+    return problems
+
+
+if __name__ == '__main__':
+    problems = check_percentile()
+    for problem in problems:
+        print(f"Problem: {problem}")
+    print(f"{len(CASES)} percentiles checked, {len(problems)} problems")
+    sys.exit(1 if problems else 0)
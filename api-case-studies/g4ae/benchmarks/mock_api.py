@@ -0,0 +1,196 @@
+"""
+A local stand-in for the EU-FarmBook API, to measure and test uploads without using the real API.
+It implements the endpoints used by auth/token_management.py and api_interaction/upload_knowledge_objects.py.
+Uploaded files are read and counted but not stored.
+
+Run from the root of the project and set API_ADDRESS=http://localhost:8000 in the .env file:
+    python benchmarks/mock_api.py --port 8000 --latency 0.05 --error-rate 0.01 --throttle-rate 0.05
+"""
+import argparse
+import base64
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lifetime of the tokens handed out by the mock API, in seconds
+ACCESS_TOKEN_LIFETIME = 300
+REFRESH_TOKEN_LIFETIME = 24 * 60 * 60
+PROJECTS = [{'project_id': '1', 'project_name': 'Mock project'}]
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def create_token(token_type: str, lifetime: int):
+    """Creates an unsigned JWT with an expiry time, which is all the client reads from a token"""
+
+    def encode(data: dict):
+        return base64.urlsafe_b64encode(json.dumps(data).encode('utf-8')).rstrip(b'=').decode('ascii')
+
+    payload = {'token_type': token_type, 'exp': int(time.time()) + lifetime, 'jti': uuid.uuid4().hex}
+    return f"{encode({'alg': 'none', 'typ': 'JWT'})}.{encode(payload)}."
+
+
+class MockAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def read_body(self):
+        """Reads the whole request body, counting its size without keeping file uploads in memory"""
+        keep = not self.path.startswith("/api/upload/knowledge_object_file")
+        chunks = []
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                chunk_size = int(self.rfile.readline().split(b';')[0], 16)
+                if chunk_size == 0:
+                    self.rfile.readline()
+                    break
+                chunk = self.rfile.read(chunk_size)
+                self.rfile.readline()
+                size += len(chunk)
+                if keep:
+                    chunks.append(chunk)
+        else:
+            remaining = int(self.headers.get('Content-Length', 0))
+            while remaining > 0:
+                chunk = self.rfile.read(min(READ_CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                size += len(chunk)
+                if keep:
+                    chunks.append(chunk)
+        return b''.join(chunks), size
+
+    def send_json(self, status_code: int, data, headers: dict = None):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method: str):
+        body, size = self.read_body()
+        endpoint = self.path.split('?')[0]
+        server = self.server
+        server.record_request(endpoint, size)
+
+        if server.latency or server.jitter:
+            time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        # Injected failures, the throttling first, like a rate limiter in front of the API would
+        if random.random() < server.throttle_rate:
+            return self.send_json(429, {'detail': 'Too many requests'},
+                                  headers={'Retry-After': str(server.retry_after)})
+        if random.random() < server.error_rate:
+            return self.send_json(500, {'detail': 'Injected error'})
+
+        route = (method, endpoint)
+        if route == ('GET', "/api/status/db_status"):
+            return self.send_json(200, {'status': 'OK'})
+        if route == ('POST', "/api/authentication/token/"):
+            return self.send_json(200, {'access': create_token('access', ACCESS_TOKEN_LIFETIME),
+                                        'refresh': create_token('refresh', REFRESH_TOKEN_LIFETIME),
+                                        'user_id': 1})
+        if route == ('POST', "/api/authentication/token/refresh/"):
+            return self.send_json(200, {'access': create_token('access', ACCESS_TOKEN_LIFETIME)})
+        if route == ('POST', "/api/authentication/projects/"):
+            return self.send_json(200, PROJECTS)
+        if route == ('POST', "/api/upload/knowledge_object_file"):
+            if size == 0:
+                return self.send_json(422, {'detail': 'No file uploaded'})
+            return self.send_json(200, {'database_id': uuid.uuid4().hex})
+        if route in [('POST', "/api/upload/knowledge_object_metadata"),
+                     ('POST', "/api/upload/validate_knowledge_object_metadata")]:
+            try:
+                metadata = json.loads(body)['metadata']
+            except (ValueError, KeyError, TypeError):
+                return self.send_json(422, {'detail': 'Invalid JSON body'})
+            if not metadata.get('knowledge_objects'):
+                return self.send_json(422, {'detail': 'No knowledge objects given'})
+            if endpoint.endswith("validate_knowledge_object_metadata"):
+                return self.send_json(200, {'detail': 'Metadata is valid'})
+            return self.send_json(200, {'id': uuid.uuid4().hex})
+        return self.send_json(404, {'detail': 'Not found'})
+
+
+class MockAPIServer(ThreadingHTTPServer):
+    """
+    The mock EU-FarmBook API. Every request waits latency seconds, plus a random jitter of up to jitter seconds.
+    A fraction throttle_rate of the requests is answered with 429 and a Retry-After header,
+    and a fraction error_rate with 500. Use port 0 to pick a free port, see address.
+    """
+    daemon_threads = True
+
+    def __init__(self, host: str = 'localhost', port: int = 0, latency: float = 0.0, jitter: float = 0.0,
+                 error_rate: float = 0.0, throttle_rate: float = 0.0, retry_after: int = 1, verbose: bool = False):
+        super().__init__((host, port), MockAPIHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.retry_after = retry_after
+        self.verbose = verbose
+        self.requests = {}
+        self.bytes_received = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def record_request(self, endpoint: str, size: int):
+        with self._lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.bytes_received += size
+
+    def start(self):
+        """Serves requests in a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name="mock-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a local mock of the EU-FarmBook API.')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds every request takes.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds per request, up to this.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429.')
+    args = parser.parse_args()
+
+    server = MockAPIServer(args.host, args.port, latency=args.latency, jitter=args.jitter,
+                           error_rate=args.error_rate, throttle_rate=args.throttle_rate,
+                           retry_after=args.retry_after, verbose=True)
+    print(f"Mock EU-FarmBook API running at {server.address}, press Ctrl+C to stop")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
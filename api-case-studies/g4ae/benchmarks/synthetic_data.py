@@ -0,0 +1,111 @@
+"""
+Creates synthetic g4ae metadata files and knowledge objects for the benchmarks.
+The metadata files have the layout of the EU-FarmBook metadata template: a 'Fill Me' sheet with the field names
+in column B and the values in column D, describing a single knowledge object.
+
+It can also be run from the root of the g4ae project to write metadata files to try the upload with, e.g.
+    python benchmarks/synthetic_data.py data/synthetic 1000 --ko-size 100000
+"""
+import argparse
+import os
+import random
+
+from openpyxl import Workbook
+
+LANGUAGES = ['English', 'German', 'French', 'Dutch', 'Irish', 'Italian']
+TOPICS = ['crop farming', 'economics', 'environment', 'forestry', 'livestock', 'society']
+SUBTOPICS = ['Agroecology', 'biodiversity and nature management', 'farm diversification', 'grassland management',
+             'soil management', 'water management', 'animal health and welfare', 'risk management']
+PURPOSES = ['decision-making support', 'education', 'practical application', 'policy making', 'research']
+LOCATIONS = ['Germany', 'Ireland', 'France', 'Netherlands', 'Belgium', 'Italy', 'Spain', 'Poland']
+
+
+def create_metadata_values(number: int, rng: random.Random):
+    """Returns the (field name, value) pairs of the 'Fill Me' sheet for one synthetic knowledge object"""
+
+    def semicolon_list(values, maximum):
+        return "; ".join(rng.sample(values, rng.randint(1, min(maximum, len(values)))))
+
+    creators = rng.sample(range(1, 500), rng.randint(1, 4))
+    return [
+        ('file name (*)', f"knowledge_object_{number}.pdf"),
+        ('title (*)', f"Grazing knowledge object {number}"),
+        ('description (*)', f"Synthetic description of knowledge object {number}. " * rng.randint(1, 10)),
+        ('keywords (*) ', "; ".join(f"keyword {rng.randint(1, 100)}" for _ in range(rng.randint(1, 6)))),
+        ('creator(s) (*)', "; ".join(f"Creator {creator}" for creator in creators)),
+        ('creator(s) contact(s) (*)', "; ".join(f"creator{creator}@example.eu" for creator in creators)),
+        ('language(s) (*) 6', rng.choice(LANGUAGES)),
+        ('date of completion (*)', f"{rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2023"),
+        ('intended purpose (*) 6', semicolon_list(PURPOSES, 2)),
+        ('geographic location(s) 6', semicolon_list(LOCATIONS, 3)),
+        ('Knowledge Object URL ', None),
+        ('category (*) 6', 'document'),
+        ('type (*) 6', 'deliverable report'),
+        ('subject - Level 1 (*) 6', semicolon_list(TOPICS, 2)),
+        ('subject - Level 2 (*) 6', semicolon_list(SUBTOPICS, 3)),
+        ('license (*)', 'CC BY'),
+        ('format (*) 6', 'pdf'),
+        ('file size (*)', '1 MB'),
+        ('project name (*) 6', 'European Network to promote grazing and to support grazing-based value chains'),
+        ('project acronym (*) ', 'Grazing4Agroecology'),
+        ('project URL (*) ', 'https://grazing4agroecology.eu/'),
+    ]
+
+
+def create_metadata_files(folder_path: str, count: int, seed: int = 0):
+    """
+    Writes count synthetic metadata files to folder_path and returns the file names of their knowledge objects
+    """
+    rng = random.Random(seed)
+    file_names = []
+    for number in range(1, count + 1):
+        workbook = Workbook()
+        sheet = workbook.active
+        sheet.title = 'Fill Me'
+        for row, (field, value) in enumerate(create_metadata_values(number, rng), start=2):
+            sheet.cell(row=row, column=2, value=field)
+            sheet.cell(row=row, column=4, value=value)
+            if field == 'file name (*)':
+                file_names.append(value)
+        workbook.save(os.path.join(folder_path, f"metadata_{number}.xlsm"))
+    return file_names
+
+
+def create_knowledge_objects(folder_path: str, file_names: list, size: int, seed: int = 0):
+    """Writes a knowledge object of size bytes for every file name, each with different content"""
+    rng = random.Random(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    for file_name in file_names:
+        with open(os.path.join(folder_path, file_name), 'wb') as f:
+            f.write(file_name.encode('utf-8'))
+            f.write(rng.randbytes(max(size - len(file_name), 0)))
+
+
+def create_processor(file_loc: str = None, df=None):
+    """
+    Creates an ExcelDataProcessor without reading the metadata file, so the benchmarks can time every step on
+    their own: load_excel_to_pandas reads file_loc, and the other steps run on a copy of df if one is given.
+    """
+    # Imported here, so the synthetic data can be written without the project packages on the path
+    from metadata_processing.process_metadata import ExcelDataProcessor
+    processor = ExcelDataProcessor.__new__(ExcelDataProcessor)
+    processor.file_loc = file_loc
+    processor.engine = None
+    if df is not None:
+        processor.df = df.copy()
+    return processor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic g4ae metadata files.')
+    parser.add_argument('folder', help='The folder to write the metadata files to.')
+    parser.add_argument('count', type=int, nargs='?', default=100, help='Number of metadata files.')
+    parser.add_argument('--ko-size', type=int, default=0,
+                        help='Also write the KOs of the metadata files to FOLDER/kos, of this many bytes each.')
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    ko_file_names = create_metadata_files(args.folder, args.count)
+    print(f"Wrote {args.count} metadata files to {args.folder}")
+    if args.ko_size:
+        create_knowledge_objects(os.path.join(args.folder, 'kos'), ko_file_names, args.ko_size)
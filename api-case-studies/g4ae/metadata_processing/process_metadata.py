@@ -1,9 +1,92 @@
-import pandas as pd
+import calendar
+import datetime
+import importlib.util
 import os
 
+# Version of the processing steps, increase it when they change so cached processed metadata is rebuilt
+PIPELINE_VERSION = 1
+
+# The sheet of the metadata template with the field names and their values
+SHEET_NAME = 'Fill Me'
+COLUMN_NAMES = {
+    'title (*)': 'title',
+    'description (*)': 'description',
+    'keywords (*) ': 'keywords',
+    'creator(s) (*)': 'creators_names',
+    'creator(s) contact(s) (*)': 'creators_emails',
+    'geographic location(s) 6': 'geographic_locations',
+    'date of completion (*)': 'date_of_completion',
+    'language(s) (*) 6': 'language',
+    'category (*) 6': 'type',
+    'type (*) 6': 'category',
+    'subject - Level 1 (*) 6': 'topics',
+    'subject - Level 2 (*) 6': 'subtopics',
+    'license (*)': 'license',
+    'intended purpose (*) 6': 'intended_purpose'
+}
+# Columns that are not sent to the EU-FarmBook
+REMOVED_COLUMNS = ['format (*) 6', 'file size (*)', 'project name (*) 6']
+# Semicolon separated properties that are converted to lists
+LIST_PROPERTIES = ['keywords', 'geographic_locations', 'intended_purpose', 'topics', 'subtopics', 'type']
+# Text that pd.read_excel reads as a missing value by default (its na_values), see read_vertical_sheet
+NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                       '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+
+def unique_ordered_list(value: str):
+    """Splits a semicolon separated string into a list of unique, stripped strings, preserving the order."""
+    seen = set()
+    return [item.strip() for item in value.split(';') if item.strip() not in seen and not seen.add(item.strip())]
+
+
+def split_creators(names: str, emails: str):
+    """Pairs the semicolon separated creator names with the semicolon separated emails"""
+    return [{'name': name.strip(), 'email': email.strip()} for name, email in zip(names.split(';'), emails.split(';'))]
+
+
+# The engines pandas can read the metadata files with. calamine (pip install python-calamine) is much faster than
+# openpyxl on large files, openpyxl is used when calamine is not installed or cannot read a file.
+EXCEL_ENGINES = ['calamine', 'openpyxl']
+
+
+def get_excel_engines(engine: str = None):
+    """
+    Returns the engines to try, in order, to read a metadata file: the given engine, or the one set with the
+    EXCEL_ENGINE environment variable. By default (auto) calamine is tried first if it is installed, then openpyxl.
+    """
+    engine = (engine or os.environ.get("EXCEL_ENGINE") or 'auto').lower()
+    if engine != 'auto':
+        if engine not in EXCEL_ENGINES:
+            raise ValueError(f"Unknown Excel engine {engine}, use one of {', '.join(EXCEL_ENGINES)} or auto")
+        return [engine]
+    if importlib.util.find_spec('python_calamine') is None:
+        return ['openpyxl']
+    return EXCEL_ENGINES
+
+
+def read_excel(f, engines: list, **kwargs):
+    """
+    Reads an open Excel file into a DataFrame with pandas, using the first of the engines that can read it.
+    The keyword arguments are passed on to pd.read_excel. Returns the DataFrame and the engine that read it.
+    """
+    import pandas as pd
+
+    for engine in engines:
+        try:
+            return pd.read_excel(f, engine=engine, **kwargs), engine
+        except Exception as e:
+            if engine == engines[-1]:
+                raise
+            print(f"Could not read {getattr(f, 'name', 'the metadata file')} with {engine}, trying the next engine: "
+                  f"{e}")
+            f.seek(0)
+
+
 class ExcelDataProcessor:
-    def __init__(self, file_loc: str):
+    def __init__(self, file_loc: str, engine: str = None):
         self.file_loc = file_loc
+        # The Excel engine to read the file with (see get_excel_engines), set to the engine that read it
+        self.engine = engine
         self.df = self.load_excel_to_pandas()  # Load data directly during initialization
 
 
@@ -14,8 +97,10 @@ class ExcelDataProcessor:
             raise FileNotFoundError(f"No file found at the specified path: {self.file_loc}")
 
         try:
+            # pandas is only imported by read_excel when it is needed, so the fast path and other commands start
+            # quickly
             with open(self.file_loc, 'rb') as f:
-                df = pd.read_excel(f, sheet_name='Fill Me')
+                df, self.engine = read_excel(f, get_excel_engines(self.engine), sheet_name=SHEET_NAME)
                 #
                 # # Drop empty columns and rows that could exist after skipping rows
                 df.dropna(axis=1, how='all', inplace=True)
@@ -37,35 +122,18 @@ class ExcelDataProcessor:
         values = values[:min_length]
 
         # Create the DataFrame using headers for column names and values for the row
+        import pandas as pd
         self.df = pd.DataFrame([values], columns=headers)
 
         return self.df
 
     def rename_columns(self):
         """Renames DataFrame columns according to a predefined schema."""
-        self.df.rename(columns={
-            'title (*)': 'title',
-            'description (*)': 'description',
-            'keywords (*) ': 'keywords',
-            'creator(s) (*)': 'creators_names',
-            'creator(s) contact(s) (*)': 'creators_emails',
-            'geographic location(s) 6': 'geographic_locations',
-            'date of completion (*)': 'date_of_completion',
-            'language(s) (*) 6': 'language',
-            'category (*) 6': 'type',
-            'type (*) 6': 'category',
-            'subject - Level 1 (*) 6': 'topics',
-            'subject - Level 2 (*) 6': 'subtopics',
-            'license (*)': 'license',
-            'intended purpose (*) 6': 'intended_purpose'
-        }, inplace=True)
+        self.df.rename(columns=COLUMN_NAMES, inplace=True)
 
     def remove_columns(self):
         """Renames DataFrame columns according to a predefined schema."""
-        self.df.drop(['format (*) 6',
-                      'file size (*)',
-                      'project name (*) 6'
-                      ], axis=1, inplace=True)
+        self.df.drop(REMOVED_COLUMNS, axis=1, inplace=True)
 
     def convert_creators_columns(self):
         """Converts creators columns to a single 'creators' column with name and email."""
@@ -84,15 +152,110 @@ class ExcelDataProcessor:
 
     def convert_semi_colon_separated_string_to_list(self, column_name):
         """Converts a comma-separated string in a DataFrame column to a list of unique strings, preserving the order."""
-
-        def unique_ordered_list(s):
-            seen = set()
-            return [item.strip() for item in s.split(';') if item.strip() not in seen and not seen.add(item.strip())]
-
         self.df[column_name] = self.df[column_name].apply(
             lambda x: unique_ordered_list(x) if isinstance(x, str) else [])
 
     def convert_list_properties(self):
 
-        for column in ['keywords', 'geographic_locations', 'intended_purpose', 'topics', 'subtopics', 'type']:
+        for column in LIST_PROPERTIES:
             self.convert_semi_colon_separated_string_to_list(column)
+
+
+def to_json_value(value):
+    """
+    Converts a cell value to the value it has in the metadata JSON, the same way pandas' to_json does:
+    missing values become None and dates become milliseconds since the epoch. Numbers are kept as they are, whole
+    numbers are already integers when they are read, see get_cell_value.
+    Lists and dictionaries, e.g. the creators, are converted item by item.
+    """
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    # NaT is a date that is not equal to itself, like NaN
+    if value is None or (isinstance(value, (float, datetime.date)) and value != value):
+        return None
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple()) * 1000
+    if isinstance(value, datetime.time):
+        return value.isoformat()
+    return value
+
+
+def get_cell_value(cell):
+    """
+    Returns the value of a cell read by openpyxl the way pd.read_excel reads it: error cells, e.g. #NAME?,
+    and the NA_VALUES text are missing values, and whole numbers are integers
+    """
+    if cell.data_type == 'e' or (isinstance(cell.value, str) and cell.value in NA_VALUES):
+        return None
+    if isinstance(cell.value, float) and cell.value.is_integer():
+        return int(cell.value)
+    return cell.value
+
+
+def read_vertical_sheet(file_loc: str, sheet_name: str = SHEET_NAME):
+    """
+    Reads a sheet with the field names in one column and their values in a later column into a dictionary,
+    without pandas. Like load_excel_to_pandas() and pivot_table(), the first row of the sheet is skipped as
+    header, empty rows and columns are ignored, and the first two remaining columns hold the names and values.
+    The cells are read the way pd.read_excel reads them, see get_cell_value.
+    """
+    if not os.path.exists(file_loc):
+        raise FileNotFoundError(f"No file found at the specified path: {file_loc}")
+
+    from openpyxl import load_workbook
+
+    try:
+        workbook = load_workbook(file_loc, read_only=True, data_only=True)
+    except Exception as e:
+        raise Exception(f"Failed to load Excel file: {e}")
+    try:
+        rows = [tuple(get_cell_value(cell) for cell in cells) for cells in workbook[sheet_name].iter_rows(min_row=2)]
+    finally:
+        workbook.close()
+
+    rows = [row for row in rows if any(value is not None for value in row)]
+    width = max((len(row) for row in rows), default=0)
+    columns = [column for column in range(width)
+               if any(column < len(row) and row[column] is not None for row in rows)]
+    if len(columns) < 2:
+        raise Exception(f"Failed to load Excel file: no field names and values found in the '{sheet_name}' sheet")
+
+    names, values = columns[:2]
+    return {row[names] if names < len(row) else None: row[values] if values < len(row) else None for row in rows}
+
+
+def dataframe_to_records(df):
+    """
+    Returns the rows of a processed metadata DataFrame as metadata records, in one pass over the DataFrame.
+    The records are the same as json.loads(row.to_json(orient='index')) of every row, without building
+    and parsing a JSON string per row.
+    """
+    return [to_json_value(record) for record in df.to_dict(orient='records')]
+
+
+def transform_record(fields: dict):
+    """
+    Applies the same steps as the ExcelDataProcessor to the fields of a metadata file, given as a dictionary
+    of field name to value, and returns the metadata record as it is sent to the EU-FarmBook
+    """
+    record = {COLUMN_NAMES.get(name, name): to_json_value(value) for name, value in fields.items()}
+    for column in REMOVED_COLUMNS:
+        del record[column]
+    record['creators'] = split_creators(record.pop('creators_names'), record.pop('creators_emails'))
+    for column in LIST_PROPERTIES:
+        value = record[column]
+        record[column] = unique_ordered_list(value) if isinstance(value, str) else []
+    return record
+
+
+def read_metadata_record(file_loc: str):
+    """
+    Reads a metadata file straight into its metadata record, without pandas. The record is the same as the
+    single row of the processed DataFrame, which makes this much faster for a folder with many metadata files.
+    Can be run in a separate process.
+    """
+    return transform_record(read_vertical_sheet(file_loc))
@@ -0,0 +1,85 @@
+import os
+import threading
+from concurrent.futures import Future
+from api_interaction.upload_journal import UploadJournal, hash_file
+
+
+class KnowledgeObjectUploader:
+    """
+    Uploads every distinct knowledge object file only once, based on the SHA-256 hash of its content.
+    Rows that reference a file with the same content as an earlier one (in this run, or in a previous run
+    recorded in the journal) get the database ID of that upload instead of uploading the bytes again.
+    Each file path is hashed only once per run, and not at all if its size and modification time are the same
+    as when the journal last hashed it. A single KnowledgeObjectUploader can be shared between threads.
+    """
+
+    def __init__(self, upload_file, journal: UploadJournal, project_id: str):
+        # upload_file(ko_file_name, ko_file_path) uploads a file and returns its database ID
+        self.upload_file = upload_file
+        self.journal = journal
+        self.project_id = project_id
+        self._hashes = {}
+        self._uploads = {}
+        # Number of knowledge objects uploaded, and reused from an earlier upload with the same content
+        self.uploaded = 0
+        self.reused = 0
+        self._lock = threading.Lock()
+
+    def get_file_hash(self, ko_file_path: str):
+        """Returns the size and SHA-256 hash of a file, hashing every path only once"""
+        with self._lock:
+            if ko_file_path in self._hashes:
+                return self._hashes[ko_file_path]
+        stat = os.stat(ko_file_path)
+        file_path = os.path.abspath(ko_file_path)
+        sha256 = self.journal.get_file_hash(file_path, stat.st_size, stat.st_mtime_ns)
+        if sha256 is None:
+            sha256 = hash_file(ko_file_path)
+            self.journal.record_file_hash(file_path, stat.st_size, stat.st_mtime_ns, sha256)
+        file_hash = (stat.st_size, sha256)
+        with self._lock:
+            self._hashes[ko_file_path] = file_hash
+        return file_hash
+
+    def upload(self, ko_file_name: str, ko_file_path: str):
+        """
+        Returns the database ID for the knowledge object, uploading it only if the same content has not been
+        uploaded before. If another thread is already uploading the same content, waits for that upload.
+        """
+        size, sha256 = self.get_file_hash(ko_file_path)
+
+        with self._lock:
+            upload = self._uploads.get(sha256)
+            first_reference = upload is None
+            if first_reference:
+                upload = Future()
+                self._uploads[sha256] = upload
+
+        if not first_reference:
+            database_id = upload.result()
+            with self._lock:
+                self.reused += 1
+            print(f"Skipping upload for {ko_file_name}, same content already uploaded in this run as {database_id}")
+            return database_id
+
+        try:
+            database_id = self.journal.get_database_id(self.project_id, sha256)
+            if database_id is not None:
+                print(f"Skipping upload for {ko_file_name}, same content already uploaded as {database_id}")
+                with self._lock:
+                    self.reused += 1
+            else:
+                print(f"Uploading knowledge object {ko_file_name}")
+                database_id = self.upload_file(ko_file_name, ko_file_path)
+                self.journal.record_knowledge_object(self.project_id, ko_file_name, size, sha256, database_id)
+                with self._lock:
+                    self.uploaded += 1
+        except Exception as e:
+            upload.set_exception(e)
+            # Let a later reference to the same content try again
+            with self._lock:
+                del self._uploads[sha256]
+            raise
+
+        upload.set_result(database_id)
+        return database_id
@@ -0,0 +1,137 @@
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds of the latency histogram buckets, in milliseconds. Slower calls go in the last, open bucket.
+HISTOGRAM_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000]
+
+
+def percentile(values: list, percent: float):
+    """
+    Returns the nearest-rank percentile of a sorted list of values: the smallest value that at least percent% of
+    the values are less than or equal to
+    """
+    if not values:
+        return None
+    # Multiplied before dividing, so e.g. the 7th percentile of 100 values is not rounded up to the 8th value
+    rank = max(math.ceil(percent * len(values) / 100) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def histogram(durations: list):
+    """Counts the durations (in seconds) per HISTOGRAM_BUCKETS_MS bucket"""
+    labels = [f"<={bound}ms" for bound in HISTOGRAM_BUCKETS_MS] + [f">{HISTOGRAM_BUCKETS_MS[-1]}ms"]
+    counts = [0] * len(labels)
+    for duration in durations:
+        milliseconds = duration * 1000
+        index = next((i for i, bound in enumerate(HISTOGRAM_BUCKETS_MS) if milliseconds <= bound), len(labels) - 1)
+        counts[index] += 1
+    return dict(zip(labels, counts))
+
+
+class RunMetrics:
+    """
+    Collects the duration, number of bytes and status code of every step of a run, per stage name,
+    e.g. 'process_metadata.rename_columns' or 'upload_ko_to_eufarmbook'.
+    A single RunMetrics can be shared between threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Forgets all measurements, and starts the clock of the run"""
+        with self._lock:
+            self.started_at = time.time()
+            self._start = time.perf_counter()
+            self.stages = {}
+
+    def record(self, stage: str, duration: float, size: int = 0, status_code: int = None, error: bool = False):
+        with self._lock:
+            measurements = self.stages.setdefault(stage, {'durations': [], 'bytes': 0, 'status_codes': {},
+                                                          'errors': 0})
+            measurements['durations'].append(duration)
+            measurements['bytes'] += size or 0
+            if status_code is not None:
+                measurements['status_codes'][status_code] = measurements['status_codes'].get(status_code, 0) + 1
+            if error:
+                measurements['errors'] += 1
+
+    @contextmanager
+    def measure(self, stage: str, size: int = 0):
+        """
+        Measures the duration of the code in the with block. The block can set 'bytes' and 'status_code'
+        on the yielded dictionary. An exception raised in the block is counted as an error of the stage.
+        """
+        event = {'bytes': size, 'status_code': None}
+        start = time.perf_counter()
+        error = False
+        try:
+            yield event
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record(stage, time.perf_counter() - start, event['bytes'], event['status_code'], error)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def summary(self):
+        """
+        Returns the measurements per stage: number of calls, total and p50/p90/p99/max duration in seconds,
+        a latency histogram, bytes and MB per second of the time spent in the stage, status codes and errors
+        """
+        with self._lock:
+            stages = {stage: dict(measurements, durations=sorted(measurements['durations']))
+                      for stage, measurements in self.stages.items()}
+
+        summary = {}
+        for stage, measurements in stages.items():
+            durations = measurements['durations']
+            total = sum(durations)
+            summary[stage] = {
+                'count': len(durations),
+                'errors': measurements['errors'],
+                'total_seconds': round(total, 6),
+                'p50_seconds': round(percentile(durations, 50), 6),
+                'p90_seconds': round(percentile(durations, 90), 6),
+                'p99_seconds': round(percentile(durations, 99), 6),
+                'max_seconds': round(durations[-1], 6),
+                'histogram': histogram(durations),
+                'bytes': measurements['bytes'],
+                'mb_per_second': round(measurements['bytes'] / 1e6 / total, 3) if total else None,
+                'status_codes': {str(code): count for code, count in sorted(measurements['status_codes'].items())},
+            }
+        return summary
+
+    def write_report(self, report_path: str, **run_details):
+        """
+        Writes the run details, the throughput of the whole run and the summary per stage to a JSON file
+        and returns the report
+        """
+        elapsed = self.elapsed()
+        stages = self.summary()
+        uploads = stages.get('upload_ko_to_eufarmbook', {})
+        uploaded = uploads.get('status_codes', {}).get('200', 0)
+        uploaded_bytes = uploads.get('bytes', 0)
+        report = {
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.started_at)),
+            'elapsed_seconds': round(elapsed, 3),
+            **run_details,
+            'throughput': {
+                'knowledge_objects_per_second': round(uploaded / elapsed, 3) if elapsed else None,
+                'upload_mb_per_second': round(uploaded_bytes / 1e6 / elapsed, 3) if elapsed else None,
+            },
+            'stages': stages,
+        }
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+        return report
+
+
+# Measurements of the current run, shared by all modules
+metrics = RunMetrics()
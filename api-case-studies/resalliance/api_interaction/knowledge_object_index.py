@@ -0,0 +1,37 @@
+import os
+
+
+class KnowledgeObjectIndex:
+    """
+    The knowledge object files in a folder, listed once with os.scandir: their path and size by file name.
+    Used to check that every file the metadata refers to is there before anything is uploaded, and to upload
+    the largest files first. Files added to the folder after the index is built are not in it.
+    """
+
+    def __init__(self, folder_path: str):
+        self.folder_path = folder_path
+        self.files = {}
+        if not os.path.isdir(folder_path):
+            return
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    self.files[entry.name] = {'path': entry.path, 'size': entry.stat().st_size}
+
+    def __contains__(self, file_name: str):
+        return file_name in self.files
+
+    def __len__(self):
+        return len(self.files)
+
+    def get(self, file_name: str):
+        """Returns the path and size of a knowledge object, or None if it is not in the folder"""
+        return self.files.get(file_name)
+
+    def missing(self, file_names: list):
+        """Returns the file names that are not in the folder, in the order given"""
+        return [file_name for file_name in file_names if file_name not in self.files]
+
+    def total_size(self, file_names: list):
+        """Returns the total size in bytes of the given knowledge objects, counting missing files as empty"""
+        return sum(self.files[file_name]['size'] for file_name in file_names if file_name in self.files)
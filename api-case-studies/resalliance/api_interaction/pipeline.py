@@ -0,0 +1,121 @@
+import queue
+import threading
+
+# Put on a queue to tell a worker there are no more items
+_DONE = object()
+
+
+class Stage:
+    """A step of the pipeline: function is called on each item, by the given number of worker threads"""
+
+    def __init__(self, name: str, function, workers: int = 1):
+        self.name = name
+        self.function = function
+        self.workers = max(workers, 1)
+
+
+class StageError:
+    """Takes the place of an item that failed in a stage. Later stages pass it on without processing it."""
+
+    def __init__(self, stage_name: str, item, exception: Exception):
+        self.stage_name = stage_name
+        self.item = item
+        self.exception = exception
+
+    def __repr__(self):
+        return f"StageError({self.stage_name!r}, {self.exception!r})"
+
+
+class Pipeline:
+    """
+    Runs items through a list of stages. Every stage has its own worker threads, and the stages are connected
+    by bounded queues, so a slow stage does not block the faster stages in front of it until its queue is full.
+    The queues also limit how many items are in memory at the same time: the items are only taken from the
+    input iterable when there is room for them.
+    """
+
+    def __init__(self, stages: list, queue_size: int = None):
+        self.stages = stages
+        self.queue_size = queue_size or 2 * max(stage.workers for stage in stages)
+
+    def run(self, items):
+        """
+        Runs all items through the stages and returns the results in the order of the items.
+        An item that raised an exception in one of the stages is returned as a StageError.
+        """
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        producer_errors = []
+        threads = []
+
+        def produce():
+            try:
+                for sequence, item in enumerate(items):
+                    queues[0].put((sequence, item))
+            except BaseException as e:
+                producer_errors.append(e)
+            finally:
+                for _ in range(self.stages[0].workers):
+                    queues[0].put(_DONE)
+
+        threads.append(threading.Thread(target=produce, name="pipeline-producer", daemon=True))
+
+        for position, stage in enumerate(self.stages):
+            next_workers = self.stages[position + 1].workers if position + 1 < len(self.stages) else 1
+            remaining_workers = [stage.workers]
+            lock = threading.Lock()
+
+            def work(stage=stage, in_queue=queues[position], out_queue=queues[position + 1],
+                     next_workers=next_workers, remaining_workers=remaining_workers, lock=lock):
+                while True:
+                    entry = in_queue.get()
+                    if entry is _DONE:
+                        break
+                    sequence, item = entry
+                    if not isinstance(item, StageError):
+                        try:
+                            item = stage.function(item)
+                        except Exception as e:
+                            item = StageError(stage.name, item, e)
+                    out_queue.put((sequence, item))
+                # The last worker of a stage to finish tells the next stage there is nothing more to come
+                with lock:
+                    remaining_workers[0] -= 1
+                    last_worker = remaining_workers[0] == 0
+                if last_worker:
+                    for _ in range(next_workers):
+                        out_queue.put(_DONE)
+
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=work, name=f"pipeline-{stage.name}-{worker}", daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        results = {}
+        while True:
+            entry = queues[-1].get()
+            if entry is _DONE:
+                break
+            sequence, item = entry
+            results[sequence] = item
+
+        for thread in threads:
+            thread.join()
+        if producer_errors:
+            raise producer_errors[0]
+
+        return [results[sequence] for sequence in sorted(results)]
+
+
+def interleave(iterables: list):
+    """
+    Yields one item of each iterable in turn, until all of them are exhausted. Used to share the workers of a
+    pipeline fairly between several sources of items, so one long source does not keep the others waiting.
+    """
+    iterators = [iter(iterable) for iterable in iterables]
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
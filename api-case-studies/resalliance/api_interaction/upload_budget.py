@@ -0,0 +1,69 @@
+import threading
+from contextlib import contextmanager
+
+
+class ByteBudget:
+    """
+    Limits the total size of the knowledge objects that are uploaded at the same time to max_bytes, on top of the
+    number of upload workers. An upload starts as soon as its file fits in what is left of the budget, so small
+    files keep flowing next to a few large ones instead of waiting behind them. A file at least as large as the
+    whole budget is uploaded on its own: while it waits for the uploads in flight to finish, no new uploads start.
+    A max_bytes of None means no limit. A single ByteBudget is shared by all upload threads.
+    """
+
+    def __init__(self, max_bytes: int = None):
+        self.max_bytes = max_bytes
+        self.in_flight = 0
+        self.peak = 0
+        self.waits = 0
+        self._oversized_waiting = 0
+        self._condition = threading.Condition()
+
+    def fits(self, size: int):
+        if size >= self.max_bytes:
+            return self.in_flight == 0
+        return self._oversized_waiting == 0 and self.in_flight + size <= self.max_bytes
+
+    @contextmanager
+    def reserve(self, size: int):
+        """Waits until a file of size bytes can be uploaded, and keeps its bytes in flight until the block ends"""
+        if self.max_bytes is None:
+            yield
+            return
+
+        size = min(size, self.max_bytes)
+        with self._condition:
+            if not self.fits(size):
+                self.waits += 1
+                oversized = size >= self.max_bytes
+                self._oversized_waiting += oversized
+                try:
+                    while not self.fits(size):
+                        self._condition.wait()
+                finally:
+                    self._oversized_waiting -= oversized
+            self.in_flight += size
+            self.peak = max(self.peak, self.in_flight)
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= size
+                self._condition.notify_all()
+
+
+def mix_sizes(items: list, key):
+    """
+    Orders the items largest, smallest, second largest, second smallest and so on, by their size as returned by key.
+    Uploads limited by a ByteBudget then always have small files to start next to the large ones, instead of all
+    upload workers waiting for room for the next large file.
+    """
+    ordered = sorted(items, key=key, reverse=True)
+    half = (len(ordered) + 1) // 2
+    large, small = ordered[:half], ordered[half:][::-1]
+    mixed = []
+    for position, item in enumerate(large):
+        mixed.append(item)
+        if position < len(small):
+            mixed.append(small[position])
+    return mixed
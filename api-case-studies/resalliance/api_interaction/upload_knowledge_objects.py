@@ -1,14 +1,43 @@
 import json
 import os
-import requests
-from metadata_processing.process_metadata import ExcelDataProcessor
-from auth.token_management import get_token
+from functools import partial
+from metadata_processing.metadata_cache import load_processed_metadata
+from metadata_processing.process_metadata import ExcelDataProcessor, dataframe_to_records, iter_metadata_records, \
+    PIPELINE_VERSION
+from metadata_processing.validate_metadata import MetadataValidator, load_vocabularies
+from api_interaction.streaming_upload import MultipartFileStream
+from api_interaction.deduplication import KnowledgeObjectUploader
+from api_interaction.instrumentation import metrics
+from api_interaction.knowledge_object_index import KnowledgeObjectIndex
+from api_interaction.pipeline import Pipeline, Stage, StageError, interleave
+from api_interaction.upload_budget import ByteBudget, mix_sizes
+from api_interaction.upload_journal import UploadJournal, hash_record
+from auth import http_client
+from auth.flow_control import TokenBucket
+from auth.token_management import get_token, renew_rejected_token
 from dotenv import load_dotenv
 
 # get environment variables
 load_dotenv()
-API_ADDRESS = os.environ.get("API_ADDRESS")
 project_id = os.environ.get("PROJECT_ID")
+# Maximum number of rows uploaded at the same time, 1 keeps the original sequential behaviour
+max_workers = int(os.environ.get("MAX_WORKERS", 1))
+# With MAX_WORKERS above 1, the upload runs as a pipeline and each stage can have its own number of workers:
+# reading and hashing the knowledge objects, uploading them, and submitting the metadata
+read_workers = int(os.environ.get("READ_WORKERS", 2))
+# The upload and metadata workers default to the max_workers of the run
+upload_workers = int(os.environ.get("UPLOAD_WORKERS", 0))
+metadata_workers = int(os.environ.get("METADATA_WORKERS", 0))
+# Most MB of knowledge objects uploaded at the same time and most MB per second sent by all uploads together,
+# on top of the number of upload workers. 0 means no limit.
+upload_budget_mb = float(os.environ.get("UPLOAD_BUDGET_MB", 0))
+upload_bandwidth_mb = float(os.environ.get("UPLOAD_BANDWIDTH_MB", 0))
+upload_budget = ByteBudget(int(upload_budget_mb * 1e6) or None)
+upload_bandwidth = TokenBucket(upload_bandwidth_mb * 1e6) if upload_bandwidth_mb else None
+# Read the metadata file row by row and start uploading straight away, instead of processing the whole file first
+stream_metadata = os.environ.get("STREAM_METADATA", "false").lower() in ['true', 't', 'yes', 'y']
+# Database ID sent in place of the real one on a metadata-only dry run, when the knowledge objects are not uploaded
+placeholder_database_id = os.environ.get("PLACEHOLDER_DATABASE_ID", "metadata-only-dry-run")
 
 metadata_folder_path = "data"
 # Add your metadata file name and .xlsx extension
@@ -16,62 +45,203 @@ metadata_file_name = "ENTER_FILE_NAME.xlsx"
 metadata_file_path = os.path.join(metadata_folder_path, metadata_file_name)
 ko_folder_path = "data/kos/"
 file_type = '.pdf'
+# Local record of everything that was uploaded, used to resume a run that stopped halfway
+journal_path = os.environ.get("UPLOAD_JOURNAL", os.path.join(metadata_folder_path, "upload_journal.sqlite"))
+# Processed metadata is kept here, so an unchanged metadata file is not processed again on the next run
+metadata_cache_dir = os.environ.get("METADATA_CACHE_DIR", os.path.join(metadata_folder_path, "cache"))
+# Controlled vocabularies used to validate the metadata locally on a dry run, see validate_metadata.py
+vocabulary_file = os.environ.get("VOCABULARY_FILE", os.path.join(metadata_folder_path, "vocabularies.json"))
+validation_report_path = os.path.join(metadata_folder_path, "validation_report.json")
+# Durations, bytes and status codes of every step of the last run, see instrumentation.py
+run_report_path = os.environ.get("RUN_REPORT", os.path.join(metadata_folder_path, "run_report.json"))
+
+
+def get_default_target():
+    """
+    Returns what a run uploads without a manifest: the metadata file at metadata_file_path, with its knowledge
+    objects in ko_folder_path, uploaded to the PROJECT_ID project
+    """
+    return {'project_id': project_id, 'metadata_file_path': metadata_file_path, 'ko_folder_path': ko_folder_path,
+            'name': None}
+
+
+def load_manifest(manifest_path: str):
+    """
+    Reads a run manifest: a JSON list of the metadata files to upload in one run, each to its own project and
+    optionally with its own knowledge object folder (the kos folder next to the metadata file by default), e.g.
+        [{"project_id": "...", "metadata_file": "data/catalog_a.xlsx"},
+         {"project_id": "...", "metadata_file": "data/catalog_b.xlsx", "ko_folder": "data/kos_b/"}]
+    Returns the upload targets, like get_default_target does for a single metadata file.
+    """
+    with open(manifest_path, encoding='utf-8') as f:
+        entries = json.load(f)
+    targets = []
+    for number, entry in enumerate(entries, start=1):
+        if not entry.get('project_id') or not entry.get('metadata_file'):
+            raise Exception(f"Entry {number} of {manifest_path} needs a project_id and a metadata_file")
+        default_ko_folder = os.path.join(os.path.dirname(entry['metadata_file']), 'kos')
+        targets.append({'project_id': entry['project_id'],
+                        'metadata_file_path': entry['metadata_file'],
+                        'ko_folder_path': entry.get('ko_folder', default_ko_folder),
+                        'name': entry['metadata_file']})
+    return targets
+
+
+def get_row_name(target: dict, index: int):
+    """
+    Returns the name of a row in messages and reports: 'Row 12', or 'data/catalog_a.xlsx Row 12' for a metadata
+    file from a manifest. The name of the file includes its folder, as metadata files with the same name in
+    different folders would otherwise get each other's validation errors.
+    """
+    return f"{target['name']} Row {index + 1}" if target['name'] else f"Row {index + 1}"
 
 
-def process_metadata():
+def process_metadata(file_path: str = None):
     """
-    Processes the metadata from the metadata_file_path variable set on the top of the script
+    Processes the metadata from the given metadata file, by default the metadata_file_path variable set on the top
+    of the script
     See process_metadata.py for more details
     """
-    processor = ExcelDataProcessor(metadata_file_path)
-    processor.rename_columns()
-    processor.convert_list_properties()
-    processor.convert_file_name_and_language()
-    processor.convert_creators_column()
-    processor.create_contributor_custom_metadata()
-    processor.remove_columns()
+    file_path = file_path or metadata_file_path
+    with metrics.measure('process_metadata.load_excel_to_pandas', os.path.getsize(file_path)):
+        processor = ExcelDataProcessor(file_path)
+    for step in [processor.rename_columns,
+                 processor.convert_list_properties,
+                 processor.convert_file_name_and_language,
+                 processor.convert_creators_column,
+                 processor.create_contributor_custom_metadata,
+                 processor.remove_columns]:
+        with metrics.measure(f"process_metadata.{step.__name__}"):
+            step()
 
     df = processor.df
     return df
 
 
-def get_knowledge_object(knowledge_object_file_name):
+def iter_processed_records(file_path: str = None):
     """
-    Imports the physical knowledge object from the data directory and returns the file name and content (Binary)
+    Yields the metadata records from process_metadata(), as they are sent to the EU-FarmBook
+    The processed metadata is loaded from the cache if the metadata file has not changed since the last run.
     """
+    file_path = file_path or metadata_file_path
+    with metrics.measure('load_processed_metadata'):
+        df = load_processed_metadata(file_path, partial(process_metadata, file_path), PIPELINE_VERSION,
+                                     metadata_cache_dir)
+    with metrics.measure('build_metadata_records'):
+        records = dataframe_to_records(df)
+    yield from records
 
-    file_path = f"{ko_folder_path}{knowledge_object_file_name}"
 
-    with open(file_path, 'rb') as file:
-        ko_content = file.read()
+def iter_records(stream: bool = stream_metadata, file_path: str = None):
+    """
+    Yields the metadata records of a metadata file (metadata_file_path by default),
+    read row by row from the metadata file if stream is True
+    """
+    if stream:
+        return measure_records(iter_metadata_records(file_path or metadata_file_path))
+    return iter_processed_records(file_path)
 
-    return knowledge_object_file_name, ko_content
+
+def measure_records(records):
+    """
+    Yields the records, measuring how long it takes to read each of them from the metadata file
+    """
+    while True:
+        with metrics.measure('read_metadata_record'):
+            record = next(records, None)
+        if record is None:
+            return
+        yield record
 
 
-def upload_ko_to_eufarmbook(ko_file_name, ko_content):
+def validate_metadata(stream: bool = stream_metadata, targets: list = None):
     """
-    Uploads the knowledge object to the EU-FarmBook (file only, not metadata)
+    Validates all metadata records locally, without calling the EU-FarmBook API, see MetadataValidator.
+    Prints a summary, saves the full error report to validation_report_path and returns the report.
+    The errors are listed per row of the metadata file, see get_row_name. With targets from a manifest,
+    the metadata files of all targets are validated.
     """
+    vocabularies = load_vocabularies(vocabulary_file)
+    validator = MetadataValidator(vocabularies)
+    if not vocabularies:
+        print(f"No vocabulary tables found at {vocabulary_file}, only the license is checked against a controlled "
+              f"vocabulary")
 
-    url = f"{API_ADDRESS}/api/upload/knowledge_object_file"
+    def records():
+        for target in targets or [get_default_target()]:
+            for index, record in enumerate(iter_records(stream, target['metadata_file_path'])):
+                yield get_row_name(target, index), record
 
-    token = get_token()
+    report = validator.validate_records(records())
+
+    with open(validation_report_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=4, ensure_ascii=False)
+    for row, errors in report['errors'].items():
+        print(f"{row}: {'; '.join(errors)}")
+    print(f"Validated {report['records']} metadata records locally, {report['invalid_records']} invalid. "
+          f"Full report saved to {validation_report_path}")
+    return report
 
-    headers = {
-        'accept': 'application/json'
-    }
+
+def get_knowledge_object(knowledge_object_file_name, ko_index: KnowledgeObjectIndex = None):
+    """
+    Finds the physical knowledge object in the data directory and returns the file name and path.
+    With a ko_index, the file is looked up in the index of its folder instead of on disk.
+    The file itself is read while it is uploaded, see upload_ko_to_eufarmbook
+    """
+
+    folder_path = ko_index.folder_path if ko_index is not None else ko_folder_path
+    file_path = os.path.join(folder_path, knowledge_object_file_name)
+
+    with metrics.measure('get_knowledge_object') as event:
+        if ko_index is not None:
+            ko_file = ko_index.get(knowledge_object_file_name)
+            if ko_file is None:
+                raise FileNotFoundError(f"No knowledge object found at the specified path: {file_path}")
+            file_path = ko_file['path']
+            event['bytes'] = ko_file['size']
+        else:
+            if not os.path.isfile(file_path):
+                raise FileNotFoundError(f"No knowledge object found at the specified path: {file_path}")
+            event['bytes'] = os.path.getsize(file_path)
+
+    return knowledge_object_file_name, file_path
+
+
+def upload_ko_to_eufarmbook(ko_file_name, ko_file_path, project: str = None):
+    """
+    Uploads the knowledge object to the EU-FarmBook (file only, not metadata),
+    to the given project ID or PROJECT_ID by default.
+    The file is streamed from disk in small chunks, so it is never loaded into memory as a whole.
+    The upload waits until the file fits in the upload_budget, and is sent no faster than the upload_bandwidth
+    allows, both shared by all uploads.
+    """
+
+    with metrics.measure('get_token'):
+        token = get_token()
 
     # Set the query parameters
     query_params = {
         'user_tokens': json.dumps(token),
-        'project_id': project_id
+        'project_id': project or project_id
     }
-
     # Set the file to upload
-    files = {
-        'ufile': (ko_file_name, ko_content)
-    }
-    response = requests.post(url, headers=headers, params=query_params, files=files)
+    with upload_budget.reserve(os.path.getsize(ko_file_path)), \
+            MultipartFileStream('ufile', ko_file_name, ko_file_path, bandwidth=upload_bandwidth) as body, \
+            metrics.measure('upload_ko_to_eufarmbook', body.len) as event:
+        headers = {
+            'accept': 'application/json',
+            'Content-Type': body.content_type
+        }
+        response = http_client.post("/api/upload/knowledge_object_file",
+                                    headers=headers, params=query_params, data=body)
+        if response.status_code == 401:
+            # The access token was revoked before it expired, send the file once more with a new one
+            query_params['user_tokens'] = json.dumps(renew_rejected_token(token))
+            body.seek(0)
+            response = http_client.post("/api/upload/knowledge_object_file",
+                                        headers=headers, params=query_params, data=body)
+        event['status_code'] = response.status_code
 
     if response.status_code != 200:
         raise Exception(f"An error occurred uploading knowledge object {response.status_code} - {response.json()}")
@@ -80,25 +250,26 @@ def upload_ko_to_eufarmbook(ko_file_name, ko_content):
         return response
 
 
-def upload_metadata_to_eufarmbook(knowledge_objects: list, metadata: dict, dry_run: bool):
+def upload_metadata_to_eufarmbook(knowledge_objects: list, metadata: dict, dry_run: bool, project: str = None):
     """
-    Uploads the knowledge object metadata.
+    Uploads the knowledge object metadata, to the given project ID or PROJECT_ID by default.
     If dry_run is set to True, it will only validate the metadata and not actually upload it.
     It is suggested you run this with dry_run set to True first to ensure the metadata is correct.
     """
     if dry_run is True:
-        url = f"{API_ADDRESS}/api/upload/validate_knowledge_object_metadata"
+        endpoint = "/api/upload/validate_knowledge_object_metadata"
     else:
-        url = f"{API_ADDRESS}/api/upload/knowledge_object_metadata"
+        endpoint = "/api/upload/knowledge_object_metadata"
 
-    token = get_token()
+    with metrics.measure('get_token'):
+        token = get_token()
 
     headers = {
         'accept': 'application/json'
     }
 
     query_params = {
-        'project_id': project_id
+        'project_id': project or project_id
     }
 
     metadata['knowledge_objects'] = knowledge_objects
@@ -108,48 +279,456 @@ def upload_metadata_to_eufarmbook(knowledge_objects: list, metadata: dict, dry_r
         'metadata': metadata
     }
 
-    response = requests.post(url, headers=headers, params=query_params, json=json)
+    with metrics.measure('upload_metadata_to_eufarmbook') as event:
+        response = http_client.post(endpoint, headers=headers, params=query_params, json=json)
+        if response.status_code == 401:
+            # The access token was revoked before it expired, send the metadata once more with a new one
+            json['user_tokens'] = renew_rejected_token(token)
+            response = http_client.post(endpoint, headers=headers, params=query_params, json=json)
+        event['status_code'] = response.status_code
+        event['bytes'] = len(response.request.body or b'')
 
     return response
 
 
-def upload_knowledge_objects_and_metadata(dry_run: bool):
+def upload_ko_file(ko_file_name, ko_file_path, project: str = None):
     """
-    This is the main runner for the script
+    Uploads the knowledge object file and returns the database ID given to it by the EU-FarmBook
     """
-    df = process_metadata()
+    upload_ko = upload_ko_to_eufarmbook(ko_file_name, ko_file_path, project)
+    return upload_ko.json()['database_id']
 
-    for index, row in df.iterrows():
 
-        filename_lang = row['file_name_lang']
-        print(f"Processing metadata for {filename_lang}")
+def get_ko_file_names(record: dict):
+    """Returns the file names of the knowledge objects a metadata record refers to"""
+    return [f"{file['filename']}{file_type}" for file in record.get('file_name_lang') or []]
 
-        doc_id_lang = []
 
-        for file in filename_lang:
-            filename = file['filename']
-            ko_file_name = f"{filename}{file_type}"
-            print(f"Attempting upload for {ko_file_name}")
-            ko_file_name, ko_content = get_knowledge_object(knowledge_object_file_name=ko_file_name)
-            print(f"Uploading knowledge object {ko_file_name}")
-            try:
-                upload_ko = upload_ko_to_eufarmbook(ko_file_name, ko_content)
-                database_id = upload_ko.json()['database_id']
-                doc_id_lang.append({"database_id": database_id, "language": file['language']})
-            except Exception as e:
-                print(f"An error occurred uploading knowledge object {e}")
+def get_record_key(target: dict, ko_file_names: list):
+    """
+    Returns the key of a metadata record in the upload journal: the full paths of the knowledge objects it describes.
+    Unlike the position of the record, it stays the same when records are added, removed or moved in the metadata,
+    and it differs for metadata with the same file name in different folders.
+    """
+    folder_path = os.path.abspath(target['ko_folder_path'])
+    return ";".join(sorted(os.path.join(folder_path, name) for name in ko_file_names))
+
 
-        # Convert the current row to JSON with proper formatting
-        metadata_json = row.to_json(orient='index', indent=4)
-        metadata_json = metadata_json.replace("\\/", "/")
-        metadata_json_dict = json.loads(metadata_json)
+def check_knowledge_objects(job: dict):
+    """
+    Checks that the knowledge objects of a row are in the knowledge object folder of its target, and keeps their
+    total size. A missing file is added to the errors of the row, so none of its files are uploaded and its metadata
+    is not sent.
+    """
+    ko_index = job['target']['ko_index']
+    missing = ko_index.missing(get_ko_file_names(job['record']))
+    if missing:
+        job['errors'] = job['errors'] + [f"No knowledge object found at the specified path: "
+                                         f"{os.path.join(ko_index.folder_path, name)}" for name in missing]
+    job['size'] = ko_index.total_size(get_ko_file_names(job['record']))
+    return job
 
+
+def check_all_knowledge_objects(jobs: list, target: dict):
+    """
+    Checks the knowledge objects of all rows of a target before anything is uploaded, see check_knowledge_objects,
+    and prints the missing files
+    """
+    missing = 0
+    for job in jobs:
+        errors = len(job['errors'])
+        check_knowledge_objects(job)
+        for error in job['errors'][errors:]:
+            print(f"{job['name']}: {error}")
+            missing += 1
+    size = sum(job['size'] for job in jobs)
+    print(f"Found {len(target['ko_index'])} knowledge objects in {target['ko_folder_path']}, {size / 1e6:.1f} MB to "
+          f"upload for {len(jobs)} rows. {missing} knowledge objects are missing, their rows are not uploaded.")
+
+
+def create_jobs(target: dict, errors: dict, stream: bool):
+    """
+    Returns the jobs to upload the rows of the metadata file of a target, with the validation errors of each row.
+    The knowledge objects of all rows are checked first, and the rows with the largest knowledge objects come first,
+    so a few big files do not hold up the end of the run. With an upload_budget, they alternate with the rows with
+    the smallest knowledge objects instead, so small files keep uploading while large ones wait for room.
+    With stream set to True, the rows are read and checked one by one instead, in the order of the metadata file.
+    """
+    jobs = ({'index': index, 'name': get_row_name(target, index), 'record': record, 'target': target,
+             'errors': errors.get(get_row_name(target, index), [])}
+            for index, record in enumerate(iter_records(stream, target['metadata_file_path'])))
+    if stream:
+        return (check_knowledge_objects(job) for job in jobs)
+    jobs = list(jobs)
+    check_all_knowledge_objects(jobs, target)
+    if upload_budget.max_bytes:
+        return mix_sizes(jobs, key=lambda job: job['size'])
+    return sorted(jobs, key=lambda job: job['size'], reverse=True)
+
+
+def get_row_result(job: dict, status_code: int = None, response=None, knowledge_objects: list = None,
+                   skipped: bool = False):
+    """Returns the result of a row, so it can be reported once all rows are processed"""
+    target = job['target']
+    return {
+        'project_id': target['project_id'],
+        'metadata_file': os.path.basename(target['metadata_file_path']),
+        'row': job['index'] + 1,
+        'knowledge_objects': knowledge_objects or [],
+        'status_code': status_code,
+        'response': response,
+        'skipped': skipped,
+        'unchanged': job.get('sync_state') == 'unchanged',
+        'changed': job.get('sync_state') == 'changed',
+        'unverified': job.get('sync_state') == 'unverified',
+        'previous_response': job.get('previous_response'),
+    }
+
+
+def prepare_row(job: dict, journal: UploadJournal, resume: bool, sync: bool = False, metadata_only: bool = False,
+                allow_changed: bool = False):
+    """
+    First step of uploading a metadata row: finds the knowledge objects of the row on disk and hashes them.
+    When resuming, rows whose metadata was already uploaded are marked as skipped.
+    When syncing, rows whose metadata and knowledge objects are the same as a record already uploaded are marked
+    as skipped and unchanged. The API has no way to update a record, so a row that changed since it was uploaded
+    would create a second record next to the first one: it fails, with the response the API gave for the first
+    record, unless allow_changed is set, in which case it is submitted as a new record.
+    See UploadJournal.get_record_state.
+    On a metadata-only dry run the knowledge objects are not uploaded, so they are only hashed when syncing.
+    """
+    target = job['target']
+    uploader = target['uploader']
+    job['record_key'] = get_record_key(target, get_ko_file_names(job['record']))
+    job['skipped'] = resume and journal.is_metadata_submitted(target['project_id'], job['record_key'])
+    if job['skipped']:
+        print(f"Skipping {job['name']}, metadata already uploaded")
+        return job
+    if job['errors']:
+        print(f"Skipping {job['name']}: {'; '.join(job['errors'])}")
+        return job
+
+    filename_lang = job['record']['file_name_lang']
+    print(f"Processing metadata for {filename_lang}")
+
+    job['files'] = []
+    for file in filename_lang:
+        filename = file['filename']
+        ko_file_name = f"{filename}{file_type}"
+        print(f"Attempting upload for {ko_file_name}")
+        ko_file_name, ko_file_path = get_knowledge_object(knowledge_object_file_name=ko_file_name,
+                                                          ko_index=target['ko_index'])
+        job['files'].append({'name': ko_file_name, 'path': ko_file_path, 'language': file['language']})
+
+    if metadata_only and not sync:
+        # Nothing is uploaded or recorded in the journal, so the knowledge objects are not read
+        return job
+
+    for file in job['files']:
+        with metrics.measure('hash_knowledge_object') as event:
+            event['bytes'] = uploader.get_file_hash(file['path'])[0]
+    file_hashes = [{'sha256': uploader.get_file_hash(file['path'])[1], 'language': file['language']}
+                   for file in job['files']]
+    job['record_hash'] = hash_record(job['record'], file_hashes)
+    if not sync:
+        return job
+    job['sync_state'], job['previous_response'] = journal.get_record_state(
+        target['project_id'], job['record_key'], job['record_hash'], [file['sha256'] for file in file_hashes])
+    if job['sync_state'] == 'unchanged':
+        print(f"Skipping {job['name']}, unchanged since it was uploaded")
+    elif job['sync_state'] == 'changed' and allow_changed:
+        print(f"Warning: {job['name']} changed since it was uploaded as {job['previous_response']}. It is "
+              f"submitted again as a new record")
+    elif job['sync_state'] == 'changed':
+        job['errors'] = job['errors'] + [
+            f"changed since it was uploaded as {job['previous_response']}; not submitted again as that would create "
+            f"a second record, sync with --allow-changed to submit it as a new record"]
+        print(f"Skipping {job['name']}: {job['errors'][-1]}")
+    elif job['sync_state'] == 'unverified':
+        print(f"Warning: {job['name']} was uploaded as {job['previous_response']} before the journal kept record "
+              f"hashes. Its knowledge objects are the same, its metadata could not be compared")
+    job['skipped'] = job['sync_state'] in ('unchanged', 'unverified')
+    return job
+
+
+def upload_row_files(job: dict):
+    """
+    Second step of uploading a metadata row: uploads its knowledge objects and collects their database IDs.
+    If a knowledge object fails to upload, the error is kept so the metadata of the row is not submitted without it.
+    The other knowledge objects are still uploaded, so they are not uploaded again when the row is resumed.
+    """
+    job['error'] = None
+    if job['skipped'] or job['errors']:
+        return job
+
+    job['knowledge_objects'] = []
+    for file in job['files']:
+        try:
+            database_id = job['target']['uploader'].upload(file['name'], file['path'])
+            job['knowledge_objects'].append({"database_id": database_id, "language": file['language']})
+        except Exception as e:
+            error = f"Could not upload knowledge object {file['name']}: {e}"
+            job['error'] = error if job['error'] is None else f"{job['error']}; {error}"
+            print(f"An error occurred uploading knowledge object {e}")
+    return job
+
+
+def check_knowledge_object(file_path: str):
+    """
+    Checks that a knowledge object can be opened and read, without reading the whole file.
+    Raises an OSError if it cannot.
+    """
+    with open(file_path, 'rb') as f:
+        f.read(1)
+
+
+def check_row_files(job: dict):
+    """
+    Second step of a metadata-only dry run, instead of upload_row_files: checks that the knowledge objects of the
+    row can be read and gives each of them the placeholder_database_id, so only the metadata is sent to the
+    validation endpoint. A knowledge object that cannot be read is added to the errors of the row.
+    """
+    job['error'] = None
+    if job['skipped'] or job['errors']:
+        return job
+
+    job['knowledge_objects'] = []
+    for file in job['files']:
+        try:
+            with metrics.measure('check_knowledge_object'):
+                check_knowledge_object(file['path'])
+            job['knowledge_objects'].append({"database_id": placeholder_database_id, "language": file['language']})
+        except OSError as e:
+            job['errors'] = job['errors'] + [f"Cannot read knowledge object {file['path']}: {e}"]
+            print(f"{job['name']}: cannot read knowledge object {file['path']}: {e}")
+    return job
+
+
+def submit_row_metadata(job: dict, dry_run: bool, journal: UploadJournal):
+    """
+    Last step of uploading a metadata row: submits the metadata with the database IDs of its knowledge objects.
+    A row whose knowledge objects did not all upload is not submitted and not recorded in the upload journal,
+    so it is uploaded again when the run is resumed.
+    Returns a dictionary with the result for the row so it can be reported once all rows are processed.
+    """
+    if job['skipped']:
+        return get_row_result(job, skipped=True)
+    if job['errors']:
+        return get_row_result(job, response=job['errors'])
+    if job['error'] is not None:
+        print(f"Not uploading the metadata for {job['name']}: {job['error']}")
+        return get_row_result(job, response=job['error'], knowledge_objects=job['knowledge_objects'])
+
+    target = job['target']
+    doc_id_lang = job['knowledge_objects']
+    try:
         response = upload_metadata_to_eufarmbook(knowledge_objects=doc_id_lang,
-                                                 metadata=metadata_json_dict,
-                                                 dry_run=dry_run)
+                                                 metadata=job['record'],
+                                                 dry_run=dry_run,
+                                                 project=target['project_id'])
         if response.status_code != 200:
             print(f"An error occurred {response.status_code} - {response.json()}")
         else:
-            print(f"Success: Uploaded metadata for Row {index + 1}: knowledge objects {doc_id_lang}. "
+            print(f"Success: Uploaded metadata for {job['name']}: knowledge objects {doc_id_lang}. "
                   f"EU-FarmBook ID: {response.json()}")
 
+        if not dry_run:
+            journal.record_metadata(target['project_id'], job['record_key'], doc_id_lang, response.status_code,
+                                    response.json(), job['record_hash'])
+    except Exception as e:
+        print(f"An error occurred uploading the metadata for {job['name']}: {e}")
+        return get_row_result(job, response=str(e), knowledge_objects=doc_id_lang)
+
+    return get_row_result(job, response.status_code, response.json(), doc_id_lang)
+
+
+def upload_row(job: dict, dry_run: bool, journal: UploadJournal, resume: bool = False, sync: bool = False,
+               metadata_only: bool = False, allow_changed: bool = False):
+    """
+    Uploads the knowledge objects of a single metadata row followed by the metadata itself, one step after the other.
+    An error in any of the steps fails the row only, like it does in the pipeline.
+    """
+    try:
+        job = prepare_row(job, journal, resume, sync, metadata_only, allow_changed)
+        job = check_row_files(job) if metadata_only else upload_row_files(job)
+        return submit_row_metadata(job, dry_run, journal)
+    except Exception as e:
+        print(f"An error occurred processing {job['name']}: {e}")
+        return get_row_result(job, response=str(e))
+
+
+def upload_knowledge_objects_and_metadata(dry_run: bool, max_workers: int = max_workers, resume: bool = False,
+                                          stream: bool = stream_metadata, sync: bool = False, targets: list = None,
+                                          metadata_only: bool = False, allow_changed: bool = False):
+    """
+    This is the main runner for the script
+    With max_workers above 1, the rows go through a pipeline: the knowledge objects of the next rows are read and
+    hashed while earlier ones are uploaded, and metadata is submitted while later files are still uploading.
+    Each stage has its own number of workers (read_workers, upload_workers and metadata_workers) and the stages
+    are connected by bounded queues, so only a limited number of rows is in memory at a time. Each row still
+    uploads its own knowledge objects before submitting its metadata, so the database IDs always end up on the
+    right record.
+    Before anything is uploaded, the knowledge object folder is listed once and every file the metadata refers to
+    is looked up in it. Rows with missing files are reported straight away and not uploaded, see create_jobs.
+    Knowledge objects are uploaded once per distinct file content, also across runs, see KnowledgeObjectUploader.
+    Besides the number of upload workers, the uploads are limited by the MB in flight and MB per second set with
+    UPLOAD_BUDGET_MB and UPLOAD_BANDWIDTH_MB, see upload_ko_to_eufarmbook.
+    With resume set to True, rows whose metadata is recorded in the upload journal are not uploaded again.
+    With sync set to True, only new rows are submitted: a row is skipped if a record with the same metadata and
+    knowledge object contents was already uploaded, in any row. Unchanged files are not hashed again. A row that
+    changed since it was uploaded fails, unless allow_changed is set to submit it as a new record, see prepare_row.
+    With stream set to True, the metadata file is read row by row and each row is uploaded as soon as it is read,
+    instead of processing the whole file first. Memory use then stays flat for very large files.
+    With targets from a manifest (see load_manifest), several metadata files are uploaded in the same run, each to
+    its own project. They share the login, the connection pool, the journal and the workers, and take turns:
+    one row of each metadata file goes into the pipeline in turn, so a very large file does not keep the others
+    waiting. Without targets, the metadata file set on the top of the script is uploaded, see get_default_target.
+    On a dry run, the metadata is first validated locally, see validate_metadata. Rows with errors are reported
+    without uploading their knowledge objects or sending their metadata to the validation endpoint, so the API only
+    checks them on a dry run after their errors are fixed.
+    With metadata_only set to True on a dry run, the knowledge objects are not uploaded at all: they are only checked
+    to be readable and the metadata is validated with the placeholder_database_id, see check_row_files. Checking a
+    catalog then sends kilobytes of metadata instead of all of its knowledge objects.
+    The duration, bytes and status code of every step are written to run_report_path, see write_run_report.
+    If the API stays down for longer than CIRCUIT_BREAKER_MAX_WAIT, no further rows are started and, once the
+    run report is written, an exception is raised, see http_client.circuit_breaker.
+    Returns the per-row results in the order of the targets and their metadata files.
+    """
+    if metadata_only and not dry_run:
+        raise Exception("Only a dry run can skip uploading the knowledge objects")
+    metrics.reset()
+    http_client.circuit_breaker.reset()
+    targets = targets or [get_default_target()]
+    errors = validate_metadata(stream, targets)['errors'] if dry_run else {}
+    if errors:
+        print(f"{len(errors)} rows with errors are not sent to the validation endpoint. Fix them and run the dry run "
+              f"again to have the EU-FarmBook API check them as well")
+
+    journal = UploadJournal(journal_path)
+    ko_indexes = {}
+    uploaders = []
+    try:
+        target_jobs = []
+        for number, target in enumerate(targets):
+            folder_path = target['ko_folder_path']
+            if folder_path not in ko_indexes:
+                with metrics.measure('index_knowledge_objects'):
+                    ko_indexes[folder_path] = KnowledgeObjectIndex(folder_path)
+            uploader = KnowledgeObjectUploader(partial(upload_ko_file, project=target['project_id']), journal,
+                                               target['project_id'])
+            uploaders.append(uploader)
+            target = dict(target, number=number, ko_index=ko_indexes[folder_path], uploader=uploader)
+            target_jobs.append(create_jobs(target, errors, stream))
+
+        # The order the rows were started in, to put the results back in the order of the metadata files
+        started = []
+
+        def schedule():
+            for job in interleave(target_jobs):
+                if http_client.circuit_breaker.error is not None:
+                    # The API did not come back, the rows not started yet would only fail one by one
+                    return
+                started.append((job['target']['number'], job['index']))
+                yield job
+
+        if max_workers <= 1:
+            results = [upload_row(job, dry_run, journal, resume, sync, metadata_only, allow_changed)
+                       for job in schedule()]
+        else:
+            stage_upload_workers = upload_workers or max_workers
+            stage_metadata_workers = metadata_workers or max_workers
+            # One pooled connection per worker that talks to the API
+            http_client.get_session(pool_size=stage_upload_workers + stage_metadata_workers)
+
+            pipeline = Pipeline([
+                Stage('read', partial(prepare_row, journal=journal, resume=resume, sync=sync,
+                                      metadata_only=metadata_only, allow_changed=allow_changed), read_workers),
+                Stage('upload', check_row_files if metadata_only else upload_row_files, stage_upload_workers),
+                Stage('metadata', partial(submit_row_metadata, dry_run=dry_run, journal=journal),
+                      stage_metadata_workers),
+            ])
+            results = []
+            for result in pipeline.run(schedule()):
+                if isinstance(result, StageError):
+                    print(f"An error occurred processing {result.item['name']}: {result.exception}")
+                    result = get_row_result(result.item, response=str(result.exception))
+                results.append(result)
+        results = [result for _, result in sorted(zip(started, results), key=lambda pair: pair[0])]
+    finally:
+        journal.close()
+
+    write_run_report(results, dry_run, max_workers, uploaders, metadata_only)
+    if http_client.circuit_breaker.error is not None:
+        raise Exception(http_client.circuit_breaker.error)
+    return results
+
+
+def summarize_results(results: list):
+    """
+    Counts the rows that succeeded, were skipped and failed. When syncing, it also counts the rows that were
+    unchanged or could not be compared, both skipped, and the rows that changed since they were uploaded
+    """
+    return {
+        'total': len(results),
+        'succeeded': sum(1 for result in results if result['status_code'] == 200),
+        'skipped': sum(1 for result in results if result['skipped']),
+        'unchanged': sum(1 for result in results if result['unchanged']),
+        'changed': sum(1 for result in results if result['changed']),
+        'unverified': sum(1 for result in results if result['unverified']),
+        'failed': sum(1 for result in results if not result['skipped'] and result['status_code'] != 200),
+    }
+
+
+def write_run_report(results: list, dry_run: bool, max_workers: int, uploaders: list, metadata_only: bool = False):
+    """
+    Writes the measurements of the run to run_report_path and prints where the time went
+    """
+    projects = {}
+    for result in results:
+        projects.setdefault(result['project_id'], []).append(result)
+    report = metrics.write_report(
+        run_report_path,
+        dry_run=dry_run,
+        metadata_only=metadata_only,
+        max_workers=max_workers,
+        upload_budget={
+            'max_mb': upload_budget_mb or None,
+            'bandwidth_mb_per_second': upload_bandwidth_mb or None,
+            'peak_mb': round(upload_budget.peak / 1e6, 1),
+            'waits': upload_budget.waits,
+        },
+        flow_control={
+            'throttled_requests': http_client.flow_controller.throttled,
+            'final_concurrency': int(http_client.flow_controller.limit),
+            'final_rate': http_client.flow_controller.bucket.rate,
+            'outages': http_client.circuit_breaker.outages,
+            'paused_seconds': round(http_client.circuit_breaker.paused_seconds, 1),
+        },
+        rows=summarize_results(results),
+        projects={project: summarize_results(project_results) for project, project_results in projects.items()},
+        knowledge_objects={'uploaded': sum(uploader.uploaded for uploader in uploaders),
+                           'reused': sum(uploader.reused for uploader in uploaders)})
+
+    print(f"Run finished in {report['elapsed_seconds']}s: {report['rows']}, {report['knowledge_objects']}, "
+          f"{report['throughput']['knowledge_objects_per_second']} KOs/s, "
+          f"{report['throughput']['upload_mb_per_second']} MB/s")
+    if len(projects) > 1:
+        for project, summary in report['projects'].items():
+            print(f"    Project {project}: {summary}")
+    for stage, summary in report['stages'].items():
+        print(f"    {stage}: {summary['count']} calls, {summary['total_seconds']:.2f}s in total, "
+              f"p50 {summary['p50_seconds'] * 1000:.0f}ms, p99 {summary['p99_seconds'] * 1000:.0f}ms")
+    if report['flow_control']['throttled_requests']:
+        print(f"The API throttled {report['flow_control']['throttled_requests']} requests, "
+              f"the run ended with {report['flow_control']['final_concurrency']} requests at a time")
+    if report['flow_control']['outages']:
+        print(f"The EU-FarmBook API was down {report['flow_control']['outages']} times, the run paused for "
+              f"{report['flow_control']['paused_seconds']}s until it was back")
+    if report['rows']['changed']:
+        print(f"{report['rows']['changed']} rows changed since they were uploaded and were not submitted again, "
+              f"see the warnings above")
+    if report['upload_budget']['waits']:
+        print(f"{report['upload_budget']['waits']} uploads waited for room in the {upload_budget_mb:g} MB "
+              f"upload budget")
+    print(f"Run report saved to {run_report_path}")
+    return report
@@ -1,5 +1,11 @@
-import token_management as token_management
 import argparse
+import os
+import sys
+
+# admin.py is run as a script from the project root (python auth/admin.py), so make the auth package importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from auth import token_management
 
 # Create the parser
 parser = argparse.ArgumentParser(description='Process some commands.')
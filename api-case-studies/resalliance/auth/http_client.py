@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import requests
+from auth.flow_control import CircuitBreaker, FlowController
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+
+# get environment variables
+load_dotenv()
+API_ADDRESS = os.environ.get("API_ADDRESS")
+# The connection pool holds one connection per upload worker
+POOL_SIZE = int(os.environ.get("MAX_WORKERS", 1))
+# Optional maximum number of requests per second to the API, e.g. RATE_LIMIT=10
+RATE_LIMIT = float(os.environ["RATE_LIMIT"]) if os.environ.get("RATE_LIMIT") else None
+# Failed requests in a row after which the requests wait until the API is back, 0 to turn this off,
+# the longest time in seconds between two checks of the API status while waiting,
+# and the longest time in seconds to wait for the API before the run stops, 0 to wait forever
+CIRCUIT_BREAKER_FAILURES = int(os.environ.get("CIRCUIT_BREAKER_FAILURES", 5))
+CIRCUIT_BREAKER_MAX_DELAY = float(os.environ.get("CIRCUIT_BREAKER_MAX_DELAY", 60))
+CIRCUIT_BREAKER_MAX_WAIT = float(os.environ.get("CIRCUIT_BREAKER_MAX_WAIT", 3600))
+
+# Number of retries and the backoff between them: 0.5s, 1s, 2s, 4s, ...
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 0.5
+RETRY_STATUS_CODES = (500, 502, 504)
+# Status codes where the API did not process the request, so even uploads can safely be sent again.
+# These are retried by request(), after waiting for the Retry-After time, see FlowController.
+REFUSED_STATUS_CODES = (429, 503)
+
+# Timeouts (connect, read) in seconds and whether the call can safely be repeated.
+# Uploading a file or storing metadata creates a new record, so these are only retried when the request
+# never reached the API or the API explicitly refused it.
+ENDPOINTS = {
+    "/api/status/db_status": {'timeout': (5, 10), 'safe_to_retry': True},
+    "/api/authentication/token/": {'timeout': (5, 30), 'safe_to_retry': True},
+    "/api/authentication/token/refresh/": {'timeout': (5, 30), 'safe_to_retry': True},
+    "/api/authentication/projects/": {'timeout': (5, 30), 'safe_to_retry': True},
+    "/api/upload/validate_knowledge_object_metadata": {'timeout': (5, 60), 'safe_to_retry': True},
+    "/api/upload/knowledge_object_file": {'timeout': (10, 600), 'safe_to_retry': False},
+    "/api/upload/knowledge_object_metadata": {'timeout': (5, 60), 'safe_to_retry': False},
+}
+DEFAULT_TIMEOUT = (5, 60)
+# Checked while the API is down, so requests to it do not wait for the circuit breaker. The circuit breaker checks
+# it on its own backoff, so it is not retried: a retried check would keep the run waiting past CIRCUIT_BREAKER_MAX_WAIT
+STATUS_ENDPOINT = "/api/status/db_status"
+
+_session = None
+_session_pool_size = 0
+_session_lock = threading.Lock()
+# Adapts the number of requests in flight, and their rate, to what the API can handle
+flow_controller = FlowController(POOL_SIZE, rate=RATE_LIMIT)
+
+
+def check_api_status():
+    """
+    Returns True if the API reports its status as OK, see token_management.get_api_status.
+    The status is accepted both as "OK" and as {"status": "OK"}.
+    """
+    # token_management sends its own requests through this module, so it is only imported when it is needed
+    from auth.token_management import get_api_status
+    status = get_api_status()
+    if isinstance(status, dict):
+        status = status.get('status')
+    return status == 'OK'
+
+
+# Pauses all requests while the API is down, until check_api_status returns True again
+circuit_breaker = CircuitBreaker(check_api_status, CIRCUIT_BREAKER_FAILURES, max_delay=CIRCUIT_BREAKER_MAX_DELAY,
+                                 max_wait=CIRCUIT_BREAKER_MAX_WAIT or None)
+
+
+def get_retry(safe_to_retry: bool):
+    """
+    Returns the retry policy for an endpoint.
+    Safe calls are retried on connection errors, read errors and the RETRY_STATUS_CODES.
+    Other calls are only retried on connection errors.
+    urllib3 would also retry 429 and 503 responses with a Retry-After header on its own. These are left to
+    request() instead, so the flow_controller sees them and slows down, see REFUSED_STATUS_CODES.
+    """
+    if safe_to_retry:
+        return Retry(total=MAX_RETRIES,
+                     backoff_factor=BACKOFF_FACTOR,
+                     status_forcelist=RETRY_STATUS_CODES,
+                     allowed_methods=None,
+                     respect_retry_after_header=False,
+                     raise_on_status=False)
+    return Retry(total=MAX_RETRIES,
+                 read=0,
+                 backoff_factor=BACKOFF_FACTOR,
+                 status_forcelist=(),
+                 allowed_methods=None,
+                 respect_retry_after_header=False,
+                 raise_on_status=False)
+
+
+def create_session(pool_size: int):
+    """
+    Creates a requests session that keeps connections to the API open between calls,
+    with a retry policy per endpoint
+    """
+    session = requests.Session()
+    session.headers.update({'accept': 'application/json'})
+    session.mount(f"{API_ADDRESS}",
+                  HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=get_retry(True)))
+    # Adapters are matched on the longest URL prefix, so these override the default policy for their endpoint
+    for endpoint, settings in ENDPOINTS.items():
+        if not settings['safe_to_retry']:
+            session.mount(f"{API_ADDRESS}{endpoint}",
+                          HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=get_retry(False)))
+    session.mount(f"{API_ADDRESS}{STATUS_ENDPOINT}",
+                  HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0))
+    return session
+
+
+def get_session(pool_size: int = None):
+    """
+    Returns the session shared by all API calls.
+    The session is created again if a larger connection pool is needed than the current one has.
+    """
+    global _session, _session_pool_size
+    pool_size = max(pool_size or POOL_SIZE, 1)
+    with _session_lock:
+        if _session is None or pool_size > _session_pool_size:
+            if _session is not None:
+                _session.close()
+            _session = create_session(pool_size)
+            _session_pool_size = pool_size
+            flow_controller.set_max_concurrency(pool_size)
+        return _session
+
+
+def reset():
+    """
+    Closes the pooled session and starts the flow_controller and circuit_breaker over, as if the module was just
+    imported, so runs in the same process do not share what the API did in an earlier run, see benchmark_upload.py
+    """
+    global _session, _session_pool_size, flow_controller
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+        _session_pool_size = 0
+        flow_controller = FlowController(POOL_SIZE, rate=RATE_LIMIT)
+    circuit_breaker.reset()
+
+
+def request(method: str, endpoint: str, **kwargs):
+    """
+    Sends a request to an API endpoint (e.g. "/api/status/db_status") through the shared session,
+    using the timeout configured for that endpoint unless a timeout is given.
+    The flow_controller decides when the request can be sent. If the API refuses it (429/503), the request is
+    sent again after the Retry-After time, or after a backoff if the API gives none.
+    While the API is down, the request waits for the circuit_breaker before it is sent. A request that fails with
+    a connection error or a 5xx response counts towards opening the circuit breaker.
+    Requests to the STATUS_ENDPOINT skip the circuit_breaker and are sent only once.
+    A json body is sent as compact UTF-8 JSON, without the spaces requests puts after every separator.
+    """
+    kwargs.setdefault('timeout', ENDPOINTS.get(endpoint, {}).get('timeout', DEFAULT_TIMEOUT))
+    if kwargs.get('json') is not None:
+        kwargs['data'] = json.dumps(kwargs.pop('json'), separators=(',', ':'), ensure_ascii=False,
+                                    allow_nan=False).encode('utf-8')
+        kwargs['headers'] = {**(kwargs.get('headers') or {}), 'Content-Type': 'application/json'}
+    body = kwargs.get('data')
+    size = getattr(body, 'len', 0)
+    gated = endpoint != STATUS_ENDPOINT
+    retries = MAX_RETRIES if gated else 0
+    for attempt in range(retries + 1):
+        if attempt > 0 and hasattr(body, 'seek'):
+            # Send a streamed body again from the start
+            body.seek(0)
+        if gated:
+            circuit_breaker.wait()
+        try:
+            with flow_controller.request(endpoint, size) as outcome:
+                response = get_session().request(method, f"{API_ADDRESS}{endpoint}", **kwargs)
+                outcome['response'] = response
+        except requests.RequestException:
+            if gated:
+                circuit_breaker.record(failed=True)
+            raise
+        if response.status_code not in REFUSED_STATUS_CODES or attempt == retries:
+            if gated:
+                circuit_breaker.record(failed=response.status_code >= 500)
+            return response
+        if 'Retry-After' not in response.headers:
+            flow_controller.bucket.pause(BACKOFF_FACTOR * 2 ** attempt)
+        response.close()
+
+
+def get(endpoint: str, **kwargs):
+    """Sends a GET request to an API endpoint, see request()"""
+    return request('GET', endpoint, **kwargs)
+
+
+def post(endpoint: str, **kwargs):
+    """Sends a POST request to an API endpoint, see request()"""
+    return request('POST', endpoint, **kwargs)
@@ -1,33 +1,39 @@
+import base64
+import json
 import os
-import requests
+import threading
+import time
 from dotenv import load_dotenv
+from auth import http_client
 
 
 # get environment variables
 load_dotenv()
-API_ADDRESS = os.environ.get("API_ADDRESS")
 EMAIL = os.environ.get("EMAIL")
 PASSWORD = os.environ.get("PASSWORD")
+# Optional file to keep the tokens between runs, e.g. TOKEN_CACHE_FILE=.token_cache.json
+TOKEN_CACHE_FILE = os.environ.get("TOKEN_CACHE_FILE")
+
+# Renew the access token this many seconds before it expires
+TOKEN_REFRESH_MARGIN = 60
+# Lifetime assumed for tokens whose expiry cannot be read from the token itself
+DEFAULT_TOKEN_LIFETIME = 300
 
 
 def get_api_status():
     """
     Get the status of the API. Should return "OK"
     """
-    url = f"{API_ADDRESS}/api/status/db_status"
-    response = requests.get(
-        url
-    )
+    response = http_client.get("/api/status/db_status")
     return response.json()
 
 
-def get_token():
+def login():
     """
     Gets the access, refresh and user ID for the user based on the e-mail and password
     """
-    url = f"{API_ADDRESS}/api/authentication/token/"
-    response = requests.post(
-        url,
+    response = http_client.post(
+        "/api/authentication/token/",
         json={"email": EMAIL, "password": PASSWORD}
     )
     if response.status_code != 200:
@@ -36,20 +42,146 @@ def get_token():
         return response.json()
 
 
+def refresh_access_token(refresh_token: str):
+    """
+    Uses the refresh token to get a new access token without sending the e-mail and password again
+    """
+    response = http_client.post(
+        "/api/authentication/token/refresh/",
+        json={"refresh": refresh_token}
+    )
+    if response.status_code != 200:
+        raise Exception(f"Could not refresh token: Status code: {response.status_code}: {response.json()}")
+    else:
+        return response.json()
+
+
+def get_token_expiry(token: str):
+    """
+    Reads the expiry time (unix timestamp) from the payload of a JWT token.
+    The signature is not checked, the API does that. Falls back to DEFAULT_TOKEN_LIFETIME if it can't be read.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return time.time() + DEFAULT_TOKEN_LIFETIME
+
+
+class TokenManager:
+    """
+    Keeps the user tokens in memory, and optionally in a local cache file, so the API is only asked for a new
+    token when the current one is about to expire. The access token is renewed with the refresh token, and a
+    full login is only done when there is no valid refresh token left.
+    A single TokenManager can be shared between threads.
+    """
+
+    def __init__(self, email: str, cache_file: str = None, refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        self.email = email
+        self.cache_file = cache_file
+        self.refresh_margin = refresh_margin
+        self.tokens = None
+        self.access_expiry = 0
+        self.refresh_expiry = 0
+        self._lock = threading.Lock()
+        self.load_cache()
+
+    def get_token(self):
+        """Returns valid user tokens, renewing them first if they are (about to be) expired."""
+        with self._lock:
+            now = time.time()
+            if self.tokens is not None and now < self.access_expiry - self.refresh_margin:
+                return self.tokens
+
+            tokens = None
+            if self.tokens is not None and now < self.refresh_expiry - self.refresh_margin:
+                try:
+                    refreshed = refresh_access_token(self.tokens['refresh'])
+                    tokens = {**self.tokens, **refreshed}
+                except Exception as e:
+                    print(f"Could not refresh token, logging in again: {e}")
+            if tokens is None:
+                tokens = login()
+
+            self.set_tokens(tokens)
+            return self.tokens
+
+    def set_tokens(self, tokens: dict):
+        """Stores new tokens and their expiry times, and writes them to the cache file if one is set."""
+        self.tokens = tokens
+        self.access_expiry = get_token_expiry(tokens.get('access'))
+        self.refresh_expiry = get_token_expiry(tokens.get('refresh'))
+        self.save_cache()
+
+    def invalidate(self, tokens: dict = None):
+        """
+        Forgets the current access token, e.g. after the API rejected it. The refresh token is kept.
+        With tokens, they are only forgotten if they are still the current ones, so when several threads are
+        rejected with the same token it is renewed once.
+        """
+        with self._lock:
+            if tokens is None or self.tokens is None or tokens.get('access') == self.tokens.get('access'):
+                self.access_expiry = 0
+
+    def load_cache(self):
+        """Loads the tokens from the cache file if it exists and belongs to the same user."""
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return
+        if cache.get('email') == self.email and cache.get('tokens'):
+            self.tokens = cache['tokens']
+            self.access_expiry = get_token_expiry(self.tokens.get('access'))
+            self.refresh_expiry = get_token_expiry(self.tokens.get('refresh'))
+
+    def save_cache(self):
+        """Writes the tokens to the cache file, readable by the current user only."""
+        if not self.cache_file:
+            return
+        temp_file = f"{self.cache_file}.tmp"
+        with open(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            json.dump({'email': self.email, 'tokens': self.tokens}, f)
+        os.replace(temp_file, self.cache_file)
+
+
+token_manager = TokenManager(EMAIL, cache_file=TOKEN_CACHE_FILE)
+
+
+def get_token():
+    """
+    Gets the access, refresh and user ID for the user.
+    The tokens are cached, so the API is only contacted again when the access token is about to expire.
+    """
+    return token_manager.get_token()
+
+
+def renew_rejected_token(tokens: dict):
+    """
+    Returns new user tokens after the API rejected the given ones with a 401, e.g. because the access token was
+    revoked before it expired. The request can then be sent once more with the new tokens.
+    """
+    print("The EU-FarmBook API rejected the access token, renewing it")
+    token_manager.invalidate(tokens)
+    return get_token()
+
+
 def get_projects():
     """
     Uses the token to get the projects that the user is registered for
     """
-    url = f"{API_ADDRESS}/api/authentication/projects/"
-
     token = get_token()
-    response = requests.post(
-        url,
+    response = http_client.post(
+        "/api/authentication/projects/",
         json=token
     )
+    if response.status_code == 401:
+        response = http_client.post("/api/authentication/projects/", json=renew_rejected_token(token))
 
     if response.status_code != 200:
         raise Exception(f"Could not access projects: Status code: {response.status_code}: {response.json()}")
     else:
         return response.json()
-
@@ -0,0 +1,51 @@
+"""
+Compares loading large synthetic ResAlliance metadata files with the Excel engines of load_excel_to_pandas:
+openpyxl, and calamine if python-calamine is installed (pip install python-calamine). Checks that every engine
+reads the same metadata as openpyxl.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/benchmark_excel_engines.py 10000 100000
+"""
+import os
+import sys
+import tempfile
+import time
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import create_metadata_file
+from metadata_processing.process_metadata import ExcelDataProcessor, dataframe_to_records, get_excel_engines
+
+
+def load_records(file_path: str, engine: str):
+    """Loads a metadata file with one engine and returns the seconds it took and the rows as records"""
+    start = time.perf_counter()
+    processor = ExcelDataProcessor(file_path, engine)
+    return time.perf_counter() - start, dataframe_to_records(processor.df)
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 100000]
+    # openpyxl goes first, the other engines are compared with it
+    engines = ['openpyxl'] + [engine for engine in get_excel_engines('auto') if engine != 'openpyxl']
+    if len(engines) == 1:
+        print("python-calamine is not installed, only openpyxl is measured. "
+              "Install it with: pip install python-calamine")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in sizes:
+            file_path = os.path.join(temp_dir, f"catalog_{size}.xlsx")
+            create_metadata_file(file_path, size)
+            print(f"{size} rows, {os.path.getsize(file_path) / 1e6:.1f} MB metadata file")
+
+            openpyxl_seconds, expected = load_records(file_path, 'openpyxl')
+            print(f"    {'openpyxl':<10} {openpyxl_seconds:8.2f}s")
+            for engine in engines[1:]:
+                seconds, records = load_records(file_path, engine)
+                if len(records) != len(expected):
+                    raise AssertionError(f"{engine} reads {len(records)} rows instead of {len(expected)}")
+                for row, (expected_record, record) in enumerate(zip(expected, records), start=1):
+                    if record != expected_record:
+                        raise AssertionError(f"{engine} reads row {row} differently:\n{expected_record}\n{record}")
+                print(f"    {engine:<10} {seconds:8.2f}s  {openpyxl_seconds / seconds:6.1f}x faster, same records")
@@ -0,0 +1,88 @@
+"""
+Compares the column transforms of ExcelDataProcessor with the original row-by-row (iterrows) implementation
+on a synthetic ResAlliance catalog, and checks that both produce the same output.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/benchmark_process_metadata.py 1000 10000 50000
+"""
+import os
+import sys
+import time
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import create_processor, create_renamed_catalog
+from metadata_processing.process_metadata import CUSTOM_PROPERTIES, LIST_PROPERTIES
+
+
+def legacy_transforms(df):
+    """The original iterrows/apply implementation of the transforms, kept here as the reference"""
+    df = df.copy()
+
+    def unique_ordered_list(s):
+        seen = set()
+        return [item.strip() for item in s.split(';') if item.strip() not in seen and not seen.add(item.strip())]
+
+    for column in LIST_PROPERTIES:
+        df[column] = df[column].apply(lambda x: unique_ordered_list(x) if isinstance(x, str) else [])
+
+    df['file_name_lang'] = [[] for _ in range(len(df))]
+    for index, row in df.iterrows():
+        for filename, language in zip(row['file_name'].split(";"), row['language'].split(";")):
+            if (filename.strip(), language.strip()) not in df.at[index, 'file_name_lang']:
+                df.at[index, 'file_name_lang'].append((filename.strip(), language.strip()))
+    df['file_name_lang'] = df['file_name_lang'].apply(
+        lambda lst: [{"filename": fn, "language": lang} for fn, lang in lst])
+    df.drop(['file_name', 'language'], axis=1, inplace=True)
+
+    df['creators'] = [set() for _ in range(len(df))]
+    for index, row in df.iterrows():
+        for pair in row['creators_preprocessing'].split(", "):
+            parts = pair.split(";") if ';' in pair else [pair, ""]
+            df.at[index, 'creators'].add((parts[0].strip(), parts[1].strip() if len(parts) > 1 else ""))
+    df['creators'] = df['creators'].apply(lambda s: [{"name": name, "email": email} for name, email in s])
+    df.drop(['creators_preprocessing'], axis=1, inplace=True)
+
+    df['contributor_custom_metadata'] = df[CUSTOM_PROPERTIES].apply(
+        lambda x: dict(zip(CUSTOM_PROPERTIES, x)), axis=1)
+    return df
+
+
+def current_transforms(df):
+    """The transforms as they are run by process_metadata()"""
+    processor = create_processor(df=df)
+    processor.convert_list_properties()
+    processor.convert_file_name_and_language()
+    processor.convert_creators_column()
+    processor.create_contributor_custom_metadata()
+    return processor.df
+
+
+def assert_same_output(legacy, current):
+    """Checks both outputs are identical. The legacy creators come from a set, so their order is not compared."""
+    assert list(legacy.columns) == list(current.columns), "Columns differ"
+    for column in legacy.columns:
+        legacy_values = legacy[column].to_list()
+        current_values = current[column].to_list()
+        if column == 'creators':
+            legacy_values = [sorted((c['name'], c['email']) for c in creators) for creators in legacy_values]
+            current_values = [sorted((c['name'], c['email']) for c in creators) for creators in current_values]
+        assert legacy_values == current_values, f"Column {column} differs"
+
+
+def time_function(function, df):
+    start = time.perf_counter()
+    result = function(df)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000, 50000]
+    print(f"{'rows':>8} {'iterrows (s)':>14} {'current (s)':>12} {'speedup':>8}")
+    for size in sizes:
+        catalog = create_renamed_catalog(size)
+        legacy_seconds, legacy_df = time_function(legacy_transforms, catalog)
+        current_seconds, current_df = time_function(current_transforms, catalog)
+        assert_same_output(legacy_df, current_df)
+        print(f"{size:>8} {legacy_seconds:>14.3f} {current_seconds:>12.3f} {legacy_seconds / current_seconds:>7.1f}x")
@@ -0,0 +1,145 @@
+"""
+Times every step of the ExcelDataProcessor on synthetic ResAlliance metadata files and measures the peak memory
+each step allocates with tracemalloc, so preprocessing that gets slower or uses more memory shows up.
+The steps are timed without tracemalloc, which slows Python code down, and traced in a separate run.
+With --save the measurements are written to a JSON file. With --baseline they are compared to an earlier file,
+and the script exits with status 1 if a step got slower or used more memory by more than --tolerance.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/benchmark_processor_steps.py 1000 10000 100000 --save data/processor_steps.json
+    python benchmarks/benchmark_processor_steps.py 1000 10000 100000 --baseline data/processor_steps.json
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic_data import create_metadata_file, create_processor
+from metadata_processing.process_metadata import ExcelDataProcessor
+
+# The steps of process_metadata(), in the order they are run after load_excel_to_pandas
+STEPS = ['rename_columns', 'convert_list_properties', 'convert_file_name_and_language', 'convert_creators_column',
+         'create_contributor_custom_metadata', 'remove_columns']
+# Steps faster than this are not compared with the baseline on time, their timings are mostly noise
+MIN_SECONDS = 0.01
+
+
+def run_step(processor: ExcelDataProcessor, step: str):
+    """Runs one step of the processor. load_excel_to_pandas returns the DataFrame, the other steps change it."""
+    if step == 'load_excel_to_pandas':
+        processor.df = processor.load_excel_to_pandas()
+    else:
+        getattr(processor, step)()
+
+
+def time_steps(file_paths: list, repeat: int):
+    """
+    Returns the seconds every step takes for all metadata files. The metadata files are read once, the other steps
+    are run repeat times on a copy of the DataFrames read and the fastest run is kept.
+    """
+    seconds = {'load_excel_to_pandas': 0.0}
+    loaded = []
+    for file_path in file_paths:
+        processor = create_processor(file_path)
+        start = time.perf_counter()
+        run_step(processor, 'load_excel_to_pandas')
+        seconds['load_excel_to_pandas'] += time.perf_counter() - start
+        loaded.append(processor.df)
+
+    for step in STEPS:
+        seconds[step] = math.inf
+    for _ in range(repeat):
+        totals = dict.fromkeys(STEPS, 0.0)
+        for file_path, df in zip(file_paths, loaded):
+            processor = create_processor(file_path, df)
+            for step in STEPS:
+                start = time.perf_counter()
+                run_step(processor, step)
+                totals[step] += time.perf_counter() - start
+        for step in STEPS:
+            seconds[step] = min(seconds[step], totals[step])
+    return seconds
+
+
+def trace_steps(file_paths: list):
+    """Returns the largest amount of memory in bytes every step allocates on top of what was already in use"""
+    peaks = dict.fromkeys(['load_excel_to_pandas'] + STEPS, 0)
+    tracemalloc.start()
+    try:
+        for file_path in file_paths:
+            processor = create_processor(file_path)
+            for step in ['load_excel_to_pandas'] + STEPS:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                run_step(processor, step)
+                peaks[step] = max(peaks[step], tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+def measure_steps(file_paths: list, repeat: int):
+    """Returns the seconds and peak memory of every step"""
+    seconds = time_steps(file_paths, repeat)
+    peaks = trace_steps(file_paths)
+    return {step: {'seconds': seconds[step], 'peak_bytes': peaks[step]} for step in seconds}
+
+
+def find_regressions(results: dict, baseline: dict, tolerance: float):
+    """Returns a description of every step that got slower or uses more memory than in the baseline"""
+    regressions = []
+    for size, steps in results.items():
+        for step, measurement in steps.items():
+            previous = baseline.get(size, {}).get(step)
+            if previous is None:
+                continue
+            if max(measurement['seconds'], previous['seconds']) >= MIN_SECONDS and \
+                    measurement['seconds'] > previous['seconds'] * (1 + tolerance):
+                regressions.append(f"{size} rows, {step}: {previous['seconds']:.3f}s -> {measurement['seconds']:.3f}s")
+            if measurement['peak_bytes'] > previous['peak_bytes'] * (1 + tolerance):
+                regressions.append(f"{size} rows, {step}: {previous['peak_bytes'] / 1e6:.1f} MB -> "
+                                   f"{measurement['peak_bytes'] / 1e6:.1f} MB")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time every ExcelDataProcessor step and measure its peak memory.')
+    parser.add_argument('sizes', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='Numbers of rows of the synthetic metadata files.')
+    parser.add_argument('--max-languages', type=int, default=3, help='Maximum number of languages per factsheet.')
+    parser.add_argument('--repeat', type=int, default=3, help='How often to run the steps after loading the file.')
+    parser.add_argument('--save', metavar='FILE', help='Save the measurements to a JSON file.')
+    parser.add_argument('--baseline', metavar='FILE', help='Compare the measurements with a saved JSON file.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='How much slower or larger a step may get before it counts as a regression.')
+    args = parser.parse_args()
+
+    results = {}
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for size in args.sizes:
+            file_path = os.path.join(temp_dir, f"catalog_{size}.xlsx")
+            create_metadata_file(file_path, size, max_languages=args.max_languages)
+            results[str(size)] = measure_steps([file_path], args.repeat)
+
+            print(f"{size} rows, {os.path.getsize(file_path) / 1e6:.1f} MB metadata file")
+            for step, measurement in results[str(size)].items():
+                print(f"    {step:<40} {measurement['seconds']:8.3f}s  {measurement['peak_bytes'] / 1e6:8.1f} MB peak")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4)
+        print(f"Measurements saved to {args.save}")
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        print(f"{len(regressions)} regressions compared with {args.baseline}")
+        sys.exit(1 if regressions else 0)
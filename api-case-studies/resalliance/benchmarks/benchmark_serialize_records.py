@@ -0,0 +1,80 @@
+"""
+Compares turning a processed ResAlliance catalog into metadata records with the original per-row
+to_json/replace/json.loads round trip and with dataframe_to_records, checks that both produce the same records,
+and compares the size of the request bodies sent with requests' json= and as compact JSON.
+Some cells are left empty, so missing values and missing dates are included.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/benchmark_serialize_records.py 1000 10000 50000
+"""
+import json
+import os
+import random
+import sys
+import time
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+from benchmarks.synthetic_data import create_catalog, create_processor
+from metadata_processing.process_metadata import dataframe_to_records
+
+# Fraction of the cells of these columns that are left empty
+EMPTY_CELLS = 0.1
+EMPTY_COLUMNS = ['Description', 'Date of completion', 'Grant ID', 'Good Practice(s)']
+
+
+def create_processed_catalog(rows: int, seed: int = 0):
+    """Creates a synthetic catalog with some empty cells and applies the steps of process_metadata() to it"""
+    rng = random.Random(seed)
+    catalog = create_catalog(rows, seed)
+    for column in EMPTY_COLUMNS:
+        empty = [rng.random() < EMPTY_CELLS for _ in range(rows)]
+        catalog[column] = catalog[column].mask(pd.Series(empty, index=catalog.index))
+
+    processor = create_processor(df=catalog)
+    processor.rename_columns()
+    processor.convert_list_properties()
+    processor.convert_file_name_and_language()
+    processor.convert_creators_column()
+    processor.create_contributor_custom_metadata()
+    processor.remove_columns()
+    return processor.df
+
+
+def round_trip_records(df):
+    """The original implementation: every row is written to indented JSON and parsed again"""
+    records = []
+    for index, row in df.iterrows():
+        metadata_json = row.to_json(orient='index', indent=4)
+        metadata_json = metadata_json.replace("\\/", "/")
+        records.append(json.loads(metadata_json))
+    return records
+
+
+def time_function(function, df):
+    start = time.perf_counter()
+    result = function(df)
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 10000, 50000]
+    print(f"{'rows':>8} {'round trip (s)':>15} {'records (s)':>12} {'speedup':>8} "
+          f"{'json= (MB)':>11} {'compact (MB)':>13}")
+    for size in sizes:
+        df = create_processed_catalog(size)
+        round_trip_seconds, expected = time_function(round_trip_records, df)
+        records_seconds, records = time_function(dataframe_to_records, df)
+        for row, (expected_record, record) in enumerate(zip(expected, records), start=1):
+            if record != expected_record:
+                raise AssertionError(f"Different metadata records for row {row}:\n{expected_record}\n{record}")
+
+        # requests serialises json= with the default separators and escapes non-ASCII characters
+        default_bytes = sum(len(json.dumps(record).encode('utf-8')) for record in records)
+        compact_bytes = sum(len(json.dumps(record, separators=(',', ':'), ensure_ascii=False).encode('utf-8'))
+                            for record in records)
+        print(f"{size:>8} {round_trip_seconds:>15.3f} {records_seconds:>12.3f} "
+              f"{round_trip_seconds / records_seconds:>7.1f}x "
+              f"{default_bytes / 1e6:>11.2f} {compact_bytes / 1e6:>13.2f}")
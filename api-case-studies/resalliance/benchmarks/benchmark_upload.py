@@ -0,0 +1,130 @@
+"""
+Runs the full upload of a synthetic ResAlliance catalog against the local mock EU-FarmBook API (see mock_api.py)
+and reports the throughput in knowledge objects and MB per second, and the p50/p99 latency of the API requests.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/benchmark_upload.py --rows 200 --ko-size 1000000 --workers 1 4 8 --latency 0.05
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# The benchmark is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from api_interaction.instrumentation import percentile
+from api_interaction.upload_budget import ByteBudget
+from benchmarks.mock_api import MockAPIServer
+from benchmarks.synthetic_data import create_metadata_file, create_knowledge_objects, get_knowledge_object_names
+
+
+class RequestTimer:
+    """Wraps http_client.request to record the latency and status code of every API request"""
+
+    def __init__(self, http_client):
+        self.http_client = http_client
+        self.original_request = http_client.request
+        self.latencies = {}
+        self.status_codes = {}
+        self._lock = threading.Lock()
+
+    def request(self, method: str, endpoint: str, **kwargs):
+        start = time.perf_counter()
+        response = self.original_request(method, endpoint, **kwargs)
+        elapsed = time.perf_counter() - start
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            codes = self.status_codes.setdefault(endpoint, {})
+            codes[response.status_code] = codes.get(response.status_code, 0) + 1
+        return response
+
+    def __enter__(self):
+        self.http_client.request = self.request
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.http_client.request = self.original_request
+
+
+def run_benchmark(upload_module, http_client, workers: int, journal_path: str, dry_run: bool, verbose: bool):
+    """Uploads the catalog once with the given number of workers and returns the measurements"""
+    upload_module.upload_workers = workers
+    upload_module.metadata_workers = workers
+    upload_module.journal_path = journal_path
+    # Every run starts with a new connection pool, flow control, circuit breaker and upload budget, so a run is not
+    # slowed down or sped up by what the API did in the runs before it
+    http_client.reset()
+    upload_module.upload_budget = ByteBudget(upload_module.upload_budget.max_bytes)
+
+    output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+    with RequestTimer(http_client) as timer, output:
+        start = time.perf_counter()
+        results = upload_module.upload_knowledge_objects_and_metadata(dry_run=dry_run, max_workers=workers)
+        elapsed = time.perf_counter() - start
+
+    return {'workers': workers, 'elapsed': elapsed, 'results': results,
+            'latencies': timer.latencies, 'status_codes': timer.status_codes}
+
+
+def print_report(run: dict, ko_size: int):
+    file_endpoint = "/api/upload/knowledge_object_file"
+    uploaded = run['status_codes'].get(file_endpoint, {}).get(200, 0)
+    failed_rows = sum(1 for result in run['results'] if result['status_code'] != 200)
+    elapsed = run['elapsed']
+    print(f"\nworkers={run['workers']}: {elapsed:.2f}s, {uploaded / elapsed:.1f} KOs/s, "
+          f"{uploaded * ko_size / 1e6 / elapsed:.2f} MB/s, {len(run['results'])} rows, {failed_rows} failed")
+    print(f"    {'endpoint':<50} {'requests':>8} {'p50 ms':>8} {'p99 ms':>8}  status codes")
+    for endpoint, latencies in sorted(run['latencies'].items()):
+        latencies = sorted(latencies)
+        print(f"    {endpoint:<50} {len(latencies):>8} {percentile(latencies, 50) * 1000:>8.1f} "
+              f"{percentile(latencies, 99) * 1000:>8.1f}  {run['status_codes'][endpoint]}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the upload against a local mock EU-FarmBook API.')
+    parser.add_argument('--rows', type=int, default=100, help='Number of rows in the synthetic catalog.')
+    parser.add_argument('--max-languages', type=int, default=2, help='Maximum number of KOs per row.')
+    parser.add_argument('--ko-size', type=int, default=1_000_000, help='Size of every KO in bytes.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8], help='MAX_WORKERS values to compare.')
+    parser.add_argument('--latency', type=float, default=0.05, help='Seconds every mock API request takes.')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Random extra seconds per request, up to this.')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 500.')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='Fraction of requests answered with 429.')
+    parser.add_argument('--dry-run', action='store_true', help='Send the metadata to the validation endpoint.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the upload.')
+    args = parser.parse_args()
+
+    server = MockAPIServer(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate).start()
+    # The project modules read their settings when they are imported, so point them at the mock API first
+    os.environ.update({'API_ADDRESS': server.address, 'EMAIL': 'benchmark@example.eu', 'PASSWORD': 'benchmark',
+                       'PROJECT_ID': '1', 'TOKEN_CACHE_FILE': '', 'METADATA_CACHE_DIR': ''})
+    from auth import http_client
+    from api_interaction import upload_knowledge_objects
+
+    project_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as temp_dir:
+        os.chdir(temp_dir)
+        os.makedirs("data/kos")
+        upload_knowledge_objects.metadata_file_name = "benchmark.xlsx"
+        upload_knowledge_objects.metadata_file_path = os.path.join("data", "benchmark.xlsx")
+
+        print(f"Creating a catalog of {args.rows} rows with KOs of {args.ko_size} bytes in {temp_dir}")
+        catalog = create_metadata_file(upload_knowledge_objects.metadata_file_path, args.rows,
+                                       max_languages=args.max_languages)
+        create_knowledge_objects("data/kos", get_knowledge_object_names(catalog), args.ko_size)
+
+        try:
+            for run_workers in args.workers:
+                # A new upload journal for every run, so no KO is skipped as already uploaded
+                run = run_benchmark(upload_knowledge_objects, http_client, run_workers,
+                                    os.path.join("data", f"journal-{run_workers}.sqlite"), args.dry_run, args.verbose)
+                print_report(run, args.ko_size)
+        finally:
+            os.chdir(project_dir)
+            server.stop()
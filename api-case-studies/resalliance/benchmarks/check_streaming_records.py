@@ -0,0 +1,49 @@
+"""
+Checks that reading a metadata file row by row (iter_metadata_records, used with STREAM_METADATA) gives the same
+metadata records as processing it with pandas (process_metadata). Prints every field that differs and exits with
+status 1 if any does.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/check_streaming_records.py metadata_processing/example_metadata/example.xlsx
+"""
+import argparse
+import os
+import sys
+
+# The check is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metadata_processing.process_metadata import dataframe_to_records, iter_metadata_records
+
+EXAMPLE_METADATA = os.path.join('metadata_processing', 'example_metadata', 'example.xlsx')
+
+
+def compare_records(file_path: str):
+    """Returns a description of every field of every record that differs between the two ways of reading"""
+    # The upload script reads its settings when it is imported, so it is only imported when the check runs
+    from api_interaction.upload_knowledge_objects import process_metadata
+
+    processed = dataframe_to_records(process_metadata(file_path))
+    streamed = list(iter_metadata_records(file_path))
+    problems = []
+    if len(processed) != len(streamed):
+        problems.append(f"pandas read {len(processed)} records, the row by row reader {len(streamed)}")
+    for row, (expected, actual) in enumerate(zip(processed, streamed), start=1):
+        for field in sorted(set(expected) | set(actual)):
+            if expected.get(field, 'missing') != actual.get(field, 'missing'):
+                problems.append(f"record {row}, {field}: pandas read {expected.get(field, 'missing')!r}, "
+                                f"the row by row reader {actual.get(field, 'missing')!r}")
+    return problems, len(processed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that streaming a metadata file gives the same records as '
+                                                 'processing it with pandas.')
+    parser.add_argument('file', nargs='?', default=EXAMPLE_METADATA, help='The metadata file to read.')
+    args = parser.parse_args()
+
+    problems, count = compare_records(args.file)
+    for problem in problems:
+        print(f"Problem: {problem}")
+    print(f"{count} records compared, {len(problems)} problems")
+    sys.exit(1 if problems else 0)
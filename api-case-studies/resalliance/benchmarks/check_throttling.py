@@ -0,0 +1,123 @@
+"""
+Checks against the local mock EU-FarmBook API (see mock_api.py) that the client slows down when the API throttles
+it. A 429 response with a Retry-After header has to reach http_client.request instead of being retried by urllib3,
+so the flow controller counts it, waits for the Retry-After time before sending the request again and lowers its
+rate. It also checks that the circuit breaker gives up on an API that stays down within its max wait, and that a
+new run starts with a closed circuit breaker. Exits with status 1 if any of this does not hold.
+
+Run from the root of the ResAlliance project:
+    python benchmarks/check_throttling.py --rate 10 --retry-after 1 --max-wait 3
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+# The check is run as a script from the project root, so make the project packages importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.mock_api import MockAPIServer
+
+
+def check_throttling(http_client, server: MockAPIServer, rate: float, retry_after: int):
+    """Returns a description of every way the client did not slow down when all its requests were throttled"""
+    # The status endpoint is not retried at all, see http_client.STATUS_ENDPOINT
+    endpoint = "/api/authentication/projects/"
+    flow_controller = http_client.flow_controller
+    attempts = http_client.MAX_RETRIES + 1
+    problems = []
+
+    server.throttle_rate = 1.0
+    start = time.monotonic()
+    response = http_client.post(endpoint)
+    elapsed = time.monotonic() - start
+    server.throttle_rate = 0.0
+
+    if response.status_code != 429:
+        problems.append(f"the throttled request returned {response.status_code} instead of 429")
+    if server.requests.get(endpoint, 0) != attempts:
+        problems.append(f"the API received {server.requests.get(endpoint, 0)} requests instead of {attempts}, "
+                        f"so the 429 responses were retried outside of http_client.request")
+    if flow_controller.throttled != attempts:
+        problems.append(f"the flow controller counted {flow_controller.throttled} throttled responses "
+                        f"instead of {attempts}")
+    if elapsed < http_client.MAX_RETRIES * retry_after:
+        problems.append(f"the retries took {elapsed:.1f}s, less than {http_client.MAX_RETRIES} times the "
+                        f"Retry-After of {retry_after}s")
+    if flow_controller.bucket.rate >= rate:
+        problems.append(f"the rate stayed at {flow_controller.bucket.rate:g} requests per second")
+
+    response = http_client.post(endpoint)
+    if response.status_code != 200:
+        problems.append(f"the request after the throttling returned {response.status_code} instead of 200")
+    return problems
+
+
+def check_circuit_breaker(http_client, server: MockAPIServer, max_wait: float):
+    """
+    Returns a description of every way the circuit breaker did not give up in time on an API that answers every
+    request with a 500, or did not start over once reset
+    """
+    # Storing metadata is not retried on a 500, so every request counts as one failure straight away
+    endpoint = "/api/upload/knowledge_object_metadata"
+    circuit_breaker = http_client.circuit_breaker
+    circuit_breaker.reset()
+    circuit_breaker.failure_threshold = 2
+    circuit_breaker.max_wait = max_wait
+    problems = []
+
+    server.error_rate = 1.0
+    http_client.post(endpoint, json={})
+    start = time.monotonic()
+    try:
+        http_client.post(endpoint, json={})
+        problems.append("the circuit breaker did not give up on the API")
+    except Exception:
+        pass
+    elapsed = time.monotonic() - start
+    # Allow for one status check that was already sent when the max wait ran out
+    if elapsed > max_wait + 1:
+        problems.append(f"the circuit breaker gave up after {elapsed:.1f}s instead of {max_wait:g}s")
+    try:
+        http_client.post(endpoint, json={})
+        problems.append("a request was sent after the circuit breaker gave up")
+    except Exception:
+        pass
+    server.error_rate = 0.0
+
+    circuit_breaker.reset()
+    if circuit_breaker.error is not None or circuit_breaker.outages or circuit_breaker.paused_seconds:
+        problems.append("the reset circuit breaker still has the error or the outages of the earlier run")
+    response = http_client.post(endpoint, json={'metadata': {'knowledge_objects': ['id']}})
+    if response.status_code != 200:
+        problems.append(f"the request after the reset returned {response.status_code} instead of 200")
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check that the client slows down when the mock API throttles it.')
+    parser.add_argument('--rate', type=float, default=10, help='RATE_LIMIT of the client, in requests per second.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with a 429.')
+    parser.add_argument('--max-wait', type=float, default=3, help='CIRCUIT_BREAKER_MAX_WAIT of the client.')
+    parser.add_argument('--verbose', action='store_true', help='Show the output of the client.')
+    args = parser.parse_args()
+
+    server = MockAPIServer(retry_after=args.retry_after).start()
+    # The project modules read their settings when they are imported, so point them at the mock API first
+    os.environ.update({'API_ADDRESS': server.address, 'RATE_LIMIT': str(args.rate)})
+    from auth import http_client
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            problems = check_throttling(http_client, server, args.rate, args.retry_after)
+            problems += check_circuit_breaker(http_client, server, args.max_wait)
+    finally:
+        server.stop()
+    for problem in problems:
+        print(f"Problem: {problem}")
+    print(f"{http_client.flow_controller.throttled} throttled responses, rate lowered to "
+          f"{http_client.flow_controller.bucket.rate:g} requests per second, {len(problems)} problems")
+    sys.exit(1 if problems else 0)
@@ -0,0 +1,127 @@
+"""
+Creates synthetic ResAlliance metadata files and knowledge objects for the benchmarks.
+The metadata files have the same columns as a ResAlliance catalog, before process_metadata() is applied.
+
+It can also be run from the root of the ResAlliance project to write metadata files to try the upload with, e.g.
+    python benchmarks/synthetic_data.py data/synthetic 1000 10000 100000 --ko-size 100000
+"""
+import argparse
+import datetime
+import os
+import random
+
+import pandas as pd
+
+LANGUAGES = ['en', 'es', 'fr', 'it', 'de', 'pt']
+TOPICS = ['crop farming', 'economics', 'environment', 'forestry', 'livestock', 'society']
+SUBTOPICS = ['agroecology', 'biodiversity and nature management', 'climate change', 'farm diversification',
+             'soil management', 'water management', 'fire prevention', 'risk management']
+PURPOSES = ['decision-making support', 'education', 'practical application', 'policy making', 'research']
+LOCATIONS = ['Spain', 'France', 'Italy', 'Portugal', 'Greece', 'Germany', 'Belgium', 'Netherlands']
+PARTNERS = ['Partner A', 'Partner B', 'Partner C', 'Partner D']
+HAZARDS = ['drought', 'flood', 'heatwave', 'wildfire', 'storm']
+
+
+def create_catalog(rows: int, seed: int = 0, max_languages: int = 3):
+    """
+    Creates a DataFrame with the columns of a ResAlliance metadata file. Every row has one factsheet
+    in one to max_languages languages, stored as '{factsheet}_{language}.pdf' in the knowledge object folder.
+    """
+    rng = random.Random(seed)
+
+    def semicolon_list(values, maximum):
+        return "; ".join(rng.sample(values, rng.randint(1, min(maximum, len(values)))))
+
+    records = []
+    for row in range(rows):
+        factsheet = f"factsheet_{row + 1}"
+        row_languages = rng.sample(LANGUAGES, rng.randint(1, max_languages))
+        creators = [f"Creator {number};creator{number}@example.eu"
+                    for number in rng.sample(range(1, 500), rng.randint(1, 4))]
+        records.append({
+            'Factsheet': ";".join(f"{factsheet}_{language}" for language in row_languages),
+            'Title': f"Resilience factsheet {row + 1}",
+            'Description': f"Synthetic description of factsheet {row + 1}. " * rng.randint(1, 10),
+            'keywords': "; ".join(f"keyword {rng.randint(1, 100)}" for _ in range(rng.randint(1, 6))),
+            'Creators': ", ".join(creators),
+            'Geographic location(s)': semicolon_list(LOCATIONS, 3),
+            'Date of completion': datetime.datetime(2023, 1, 1) + datetime.timedelta(days=rng.randint(0, 365)),
+            'Language': ";".join(row_languages),
+            'Category': 'document',
+            'Type': 'factsheet',
+            'Topics': semicolon_list(TOPICS, 2),
+            'Subtopics': semicolon_list(SUBTOPICS, 3),
+            'Licence': 'CC BY',
+            'Intended Purpose': semicolon_list(PURPOSES, 2),
+            'Grant ID': '101086600',
+            'Type of Solution': rng.choice(['technical', 'organisational', 'financial']),
+            'Sector': rng.choice(['agriculture', 'forestry', 'livestock']),
+            'ResAlliance Partner': rng.choice(PARTNERS),
+            'Climate hazard': semicolon_list(HAZARDS, 2),
+            'Good Practice(s)': f"Good practice {rng.randint(1, 50)}",
+        })
+    return pd.DataFrame(records)
+
+
+def create_renamed_catalog(rows: int, seed: int = 0, max_languages: int = 3):
+    """Creates a catalog with the column names of rename_columns(), the input of the other processing steps"""
+    processor = create_processor(df=create_catalog(rows, seed, max_languages))
+    processor.rename_columns()
+    return processor.df
+
+
+def get_knowledge_object_names(catalog, file_type: str = '.pdf'):
+    """Returns the file names of all knowledge objects referred to by a catalog"""
+    return [f"{name.strip()}{file_type}" for names in catalog['Factsheet'] for name in names.split(";")]
+
+
+def create_metadata_file(file_path: str, rows: int, seed: int = 0, max_languages: int = 3):
+    """Writes a synthetic ResAlliance metadata file and returns its catalog"""
+    catalog = create_catalog(rows, seed, max_languages)
+    catalog.to_excel(file_path, index=False)
+    return catalog
+
+
+def create_knowledge_objects(folder_path: str, file_names: list, size: int, seed: int = 0):
+    """Writes a knowledge object of size bytes for every file name, each with different content"""
+    rng = random.Random(seed)
+    os.makedirs(folder_path, exist_ok=True)
+    for file_name in file_names:
+        with open(os.path.join(folder_path, file_name), 'wb') as f:
+            f.write(file_name.encode('utf-8'))
+            f.write(rng.randbytes(max(size - len(file_name), 0)))
+
+
+def create_processor(file_loc: str = None, df=None):
+    """
+    Creates an ExcelDataProcessor without reading the metadata file, so the benchmarks can time every step on
+    their own: load_excel_to_pandas reads file_loc, and the other steps run on a copy of df if one is given.
+    """
+    # Imported here, so the synthetic data can be written without the project packages on the path
+    from metadata_processing.process_metadata import ExcelDataProcessor
+    processor = ExcelDataProcessor.__new__(ExcelDataProcessor)
+    processor.file_loc = file_loc
+    processor.engine = None
+    if df is not None:
+        processor.df = df.copy()
+    return processor
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic ResAlliance metadata files.')
+    parser.add_argument('folder', help='The folder to write the metadata files to.')
+    parser.add_argument('sizes', type=int, nargs='*', default=[1000, 10000, 100000],
+                        help='Numbers of rows, one metadata file is written for each.')
+    parser.add_argument('--max-languages', type=int, default=3, help='Maximum number of languages per factsheet.')
+    parser.add_argument('--ko-size', type=int, default=0,
+                        help='Also write the KOs of the metadata files to FOLDER/kos, of this many bytes each.')
+    args = parser.parse_args()
+
+    os.makedirs(args.folder, exist_ok=True)
+    for size in args.sizes:
+        file_path = os.path.join(args.folder, f"catalog_{size}.xlsx")
+        catalog = create_metadata_file(file_path, size, max_languages=args.max_languages)
+        print(f"Wrote {file_path}")
+        if args.ko_size:
+            create_knowledge_objects(os.path.join(args.folder, 'kos'), get_knowledge_object_names(catalog),
+                                     args.ko_size)
@@ -1,4 +1,12 @@
-from api_interaction.upload_knowledge_objects import upload_knowledge_objects_and_metadata
+import argparse
+import os
+import sys
+
+# Where the profile is saved with --profile if no file is given
+PROFILE_FILE = os.path.join("data", "profile.prof")
+# The commands of create_parser
+COMMANDS = ['status', 'projects', 'validate', 'upload', 'resume', 'sync']
+
 
 def input_boolean(prompt):
     while True:
@@ -10,13 +18,155 @@ def input_boolean(prompt):
         else:
             print("Invalid input. Please enter True or False.")
 
-if __name__ == '__main__':
+
+def set_metadata_file(metadata_file_path: str):
+    """
+    Uploads the given metadata file instead of the metadata_file_name set in upload_knowledge_objects.py
+    """
+    from api_interaction import upload_knowledge_objects
+    upload_knowledge_objects.metadata_file_path = metadata_file_path
+    upload_knowledge_objects.metadata_file_name = os.path.basename(metadata_file_path)
+
+
+def load_manifest(manifest_path: str):
+    """
+    Reads the metadata files and projects to upload from a run manifest, see upload_knowledge_objects.load_manifest
+    """
+    from api_interaction.upload_knowledge_objects import load_manifest
+    return load_manifest(manifest_path)
+
+
+def run_upload(dry_run: bool, resume: bool, workers: int = None, stream: bool = None, profile: str = None,
+               sync: bool = False, targets: list = None,
+               metadata_only: bool = False, allow_changed: bool = False):
+    """
+    Uploads the knowledge objects and metadata, see upload_knowledge_objects_and_metadata.
+    Returns 0 if all rows were uploaded (or validated on a dry run) or skipped, and 1 if any row failed.
+    """
+    # The upload modules are only imported by the commands that need them, so the other commands start quickly
+    from api_interaction.upload_knowledge_objects import upload_knowledge_objects_and_metadata
+
+    options = {'dry_run': dry_run, 'resume': resume, 'sync': sync, 'targets': targets, 'metadata_only': metadata_only,
+               'allow_changed': allow_changed}
+    if workers is not None:
+        options['max_workers'] = workers
+    if stream is not None:
+        options['stream'] = stream
+
+    if profile:
+        import cProfile
+        import pstats
+
+        # cProfile only sees the main thread, so the uploads run one after the other while profiling
+        profiler = cProfile.Profile()
+        results = profiler.runcall(upload_knowledge_objects_and_metadata, **{**options, 'max_workers': 1})
+        profiler.dump_stats(profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+        print(f"Profile saved to {profile}, open it with: python -m pstats {profile}")
+    else:
+        results = upload_knowledge_objects_and_metadata(**options)
+
+    failed = [result for result in results if not result['skipped'] and result['status_code'] != 200]
+    return 1 if failed else 0
+
+
+def run_interactive(profile: str = None):
+    """
+    Asks whether this is a dry run and whether to resume, then runs the upload
+    """
     print("Starting the process...")
     dry_run = input_boolean("Is this a dry run? (True/False): ")
+    metadata_only = dry_run and input_boolean("Only check the metadata, without uploading the KOs? (True/False): ")
     if dry_run:
         print("Dry run to check metadata validity in progress...")
     else:
         print("Actual API run in progress...")
-    upload_knowledge_objects_and_metadata(dry_run=dry_run)
-
+    resume = input_boolean("Resume the previous run, skipping everything that was already uploaded? (True/False): ")
+    exit_code = run_upload(dry_run=dry_run, resume=resume, profile=profile, metadata_only=metadata_only)
     print("Process finished")
+    return exit_code
+
+
+def create_parser():
+    parser = argparse.ArgumentParser(
+        description='Upload knowledge objects and metadata to the EU-FarmBook. '
+                    'Without a command, you are asked whether to do a dry run and whether to resume.')
+    # Without a command the next argument could be taken for the FILE, e.g. in "--profile upload", so it is required
+    # here and checked not to be a command in main(). The commands take their own --profile, where FILE is optional.
+    parser.add_argument('--profile', default=None, metavar='FILE',
+                        help=f'Profile the interactive run with cProfile and save the stats to FILE, '
+                             f'e.g. {PROFILE_FILE}.')
+    commands = parser.add_subparsers(dest='command', metavar='command')
+
+    commands.add_parser('status', help='Show the status of the EU-FarmBook API.')
+    commands.add_parser('projects', help='Show the projects you can upload knowledge objects to.')
+
+    input_options = argparse.ArgumentParser(add_help=False)
+    inputs = input_options.add_mutually_exclusive_group()
+    inputs.add_argument('--input', metavar='FILE',
+                        help='The metadata file, instead of the one set in upload_knowledge_objects.py.')
+    inputs.add_argument('--manifest', metavar='FILE',
+                        help='A JSON file listing several metadata files to upload, each to its own project.')
+    input_options.add_argument('--stream', action=argparse.BooleanOptionalAction, default=None,
+                               help='Read the metadata file row by row, see STREAM_METADATA.')
+
+    commands.add_parser('validate', parents=[input_options],
+                        help='Check the metadata locally, without calling the EU-FarmBook API.')
+
+    upload_options = argparse.ArgumentParser(add_help=False, parents=[input_options])
+    upload_options.add_argument('--dry-run', action='store_true',
+                                help='Upload the knowledge objects but only validate the metadata.')
+    upload_options.add_argument('--metadata-only', action='store_true',
+                                help='With --dry-run, only check that the knowledge objects can be read instead of '
+                                     'uploading them.')
+    upload_options.add_argument('--workers', type=int, metavar='N',
+                                help='How many uploads to run at the same time, instead of MAX_WORKERS.')
+    upload_options.add_argument('--profile', nargs='?', const=PROFILE_FILE, default=argparse.SUPPRESS,
+                                metavar='FILE', help=f'Profile the run with cProfile (default {PROFILE_FILE}).')
+    commands.add_parser('upload', parents=[upload_options], help='Upload the knowledge objects and metadata.')
+    commands.add_parser('resume', parents=[upload_options],
+                        help='Upload the knowledge objects and metadata, skipping everything already uploaded.')
+    sync_parser = commands.add_parser('sync', parents=[upload_options],
+                                      help='Upload only new knowledge objects and new metadata since the last run. '
+                                           'Metadata that changed since it was uploaded fails the run.')
+    sync_parser.add_argument('--allow-changed', action='store_true',
+                             help='Submit metadata that changed since it was uploaded as a new record.')
+    return parser
+
+
+def main(argv=None):
+    parser = create_parser()
+    args = parser.parse_args(argv)
+    if getattr(args, 'metadata_only', False) and not args.dry_run:
+        parser.error('--metadata-only can only be used with --dry-run')
+
+    if args.command in ['status', 'projects']:
+        from auth import token_management
+        if args.command == 'status':
+            print(token_management.get_api_status())
+        else:
+            print(token_management.get_projects())
+        return 0
+
+    if args.command is None and args.profile in COMMANDS:
+        parser.error(f'--profile needs a FILE before the command, or use "{args.profile} --profile"')
+    if args.command is None:
+        return run_interactive(profile=args.profile)
+
+    if args.input:
+        set_metadata_file(args.input)
+    targets = load_manifest(args.manifest) if args.manifest else None
+
+    if args.command == 'validate':
+        from api_interaction.upload_knowledge_objects import stream_metadata, validate_metadata
+        stream = stream_metadata if args.stream is None else args.stream
+        report = validate_metadata(stream, targets)
+        return 1 if report['invalid_records'] else 0
+
+    return run_upload(dry_run=args.dry_run, resume=args.command == 'resume', workers=args.workers,
+                      stream=args.stream, profile=args.profile, sync=args.command == 'sync', targets=targets,
+                      metadata_only=args.metadata_only, allow_changed=getattr(args, 'allow_changed', False))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,64 @@
+import glob
+import hashlib
+import json
+import os
+
+# Size of the buffer used to hash the metadata file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def get_workbook_fingerprint(file_loc: str, pipeline_version: int):
+    """
+    Returns a key that changes whenever the metadata file or the processing steps change:
+    a hash of the file's path, size, modification time and content, and the version of the processing steps
+    """
+    stat = os.stat(file_loc)
+    content_hash = hashlib.sha256()
+    with open(file_loc, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            content_hash.update(chunk)
+    fingerprint = [os.path.abspath(file_loc), stat.st_size, stat.st_mtime_ns, content_hash.hexdigest(),
+                   pipeline_version]
+    return hashlib.sha256(json.dumps(fingerprint).encode('utf-8')).hexdigest()
+
+
+def load_processed_metadata(file_loc: str, process, pipeline_version: int, cache_dir: str):
+    """
+    Returns the processed metadata DataFrame for a metadata file, from the cache if the file was processed before.
+    Otherwise process() is called to build it, and the result is stored in cache_dir for the next run.
+    Older cache entries for the same file are removed. The entries of a file are named after its file name and a hash
+    of its full path, so files with the same name in different folders keep their own entries.
+    No cache is used if cache_dir is empty.
+    """
+    if not cache_dir:
+        return process()
+
+    if not os.path.exists(file_loc):
+        raise FileNotFoundError(f"No file found at the specified path: {file_loc}")
+
+    fingerprint = get_workbook_fingerprint(file_loc, pipeline_version)
+    file_name = os.path.basename(file_loc)
+    path_hash = hashlib.sha256(os.path.abspath(file_loc).encode('utf-8')).hexdigest()[:8]
+    cache_prefix = os.path.join(cache_dir, f"{file_name}-{path_hash}-")
+    cache_file = f"{cache_prefix}{fingerprint[:16]}.pkl"
+
+    if os.path.exists(cache_file):
+        # pandas is only imported when it is needed, so commands that do not read metadata start quickly
+        import pandas as pd
+        try:
+            return pd.read_pickle(cache_file)
+        except Exception as e:
+            print(f"Could not read cached metadata {cache_file}, processing the metadata again: {e}")
+
+    df = process()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    # Entries from before the path hash was part of their name could belong to any file with the same name
+    legacy_prefix = os.path.join(cache_dir, f"{file_name}-")
+    for old_cache_file in glob.glob(f"{glob.escape(cache_prefix)}{'[0-9a-f]' * 16}.pkl") + \
+            glob.glob(f"{glob.escape(legacy_prefix)}{'[0-9a-f]' * 16}.pkl"):
+        os.remove(old_cache_file)
+    temp_file = f"{cache_file}.tmp"
+    df.to_pickle(temp_file)
+    os.replace(temp_file, cache_file)
+    return df
@@ -1,9 +1,120 @@
-import pandas as pd
+import calendar
+import datetime
+import importlib.util
 import os
 
+# Version of the processing steps, increase it when they change so cached processed metadata is rebuilt
+PIPELINE_VERSION = 1
+
+# Column names in the ResAlliance metadata file and their name in the EU-FarmBook metadata
+COLUMN_NAMES = {
+    'Factsheet': 'file_name',
+    'Title': 'title',
+    'Description': 'description',
+    'keywords': 'keywords',
+    'Creators': 'creators_preprocessing',
+    'Geographic location(s)': 'geographic_locations',
+    'Date of completion': 'date_of_completion',
+    'Language': 'language',
+    'Category': 'type',
+    'Type': 'category',
+    'Topics': 'topics',
+    'Subtopics': 'subtopics',
+    'Licence': 'license',
+    'Intended Purpose': 'intended_purpose'
+}
+# ResAlliance specific properties, sent as contributor custom metadata
+CUSTOM_PROPERTIES = ['Type of Solution', 'Sector', 'ResAlliance Partner', 'Climate hazard', 'Good Practice(s)']
+# Semicolon separated properties that are converted to lists
+LIST_PROPERTIES = ['keywords', 'geographic_locations', 'intended_purpose', 'topics', 'subtopics', 'type'] + \
+    CUSTOM_PROPERTIES
+# Columns that are not sent to the EU-FarmBook
+REMOVED_COLUMNS = ['Grant ID'] + CUSTOM_PROPERTIES
+# Text that pd.read_excel reads as a missing value by default (its na_values), see iter_metadata_records
+NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                       '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+
+def unique_ordered_list(value: str):
+    """Splits a semicolon separated string into a list of unique, stripped strings, preserving the order."""
+    seen = set()
+    return [item.strip() for item in value.split(';') if item.strip() not in seen and not seen.add(item.strip())]
+
+
+def split_creators(value: str):
+    """
+    Splits a 'name;email, name;email' string into a list of unique dictionaries with 'name' and 'email',
+    in the order they first appear. The email is left empty for creators without one.
+    """
+    creators = []
+    seen = set()
+    for pair in value.split(", "):
+        parts = pair.split(";")
+        name_email_tuple = (parts[0].strip(), parts[1].strip() if len(parts) > 1 else "")
+        if name_email_tuple not in seen:
+            seen.add(name_email_tuple)
+            creators.append({"name": name_email_tuple[0], "email": name_email_tuple[1]})
+    return creators
+
+
+def split_file_names_and_languages(file_names: str, languages: str):
+    """
+    Pairs the semicolon separated file names with the semicolon separated languages into a list of unique
+    dictionaries with 'filename' and 'language', preserving the order
+    """
+    file_name_lang = []
+    seen = set()
+    for filename, language in zip(file_names.split(";"), languages.split(";")):
+        filename_language_tuple = (filename.strip(), language.strip())
+        if filename_language_tuple not in seen:
+            seen.add(filename_language_tuple)
+            file_name_lang.append({"filename": filename_language_tuple[0], "language": filename_language_tuple[1]})
+    return file_name_lang
+
+
+# The engines pandas can read the metadata files with. calamine (pip install python-calamine) is much faster than
+# openpyxl on large files, openpyxl is used when calamine is not installed or cannot read a file.
+EXCEL_ENGINES = ['calamine', 'openpyxl']
+
+
+def get_excel_engines(engine: str = None):
+    """
+    Returns the engines to try, in order, to read a metadata file: the given engine, or the one set with the
+    EXCEL_ENGINE environment variable. By default (auto) calamine is tried first if it is installed, then openpyxl.
+    """
+    engine = (engine or os.environ.get("EXCEL_ENGINE") or 'auto').lower()
+    if engine != 'auto':
+        if engine not in EXCEL_ENGINES:
+            raise ValueError(f"Unknown Excel engine {engine}, use one of {', '.join(EXCEL_ENGINES)} or auto")
+        return [engine]
+    if importlib.util.find_spec('python_calamine') is None:
+        return ['openpyxl']
+    return EXCEL_ENGINES
+
+
+def read_excel(f, engines: list, **kwargs):
+    """
+    Reads an open Excel file into a DataFrame with pandas, using the first of the engines that can read it.
+    The keyword arguments are passed on to pd.read_excel. Returns the DataFrame and the engine that read it.
+    """
+    import pandas as pd
+
+    for engine in engines:
+        try:
+            return pd.read_excel(f, engine=engine, **kwargs), engine
+        except Exception as e:
+            if engine == engines[-1]:
+                raise
+            print(f"Could not read {getattr(f, 'name', 'the metadata file')} with {engine}, trying the next engine: "
+                  f"{e}")
+            f.seek(0)
+
+
 class ExcelDataProcessor:
-    def __init__(self, file_loc: str):
+    def __init__(self, file_loc: str, engine: str = None):
         self.file_loc = file_loc
+        # The Excel engine to read the file with (see get_excel_engines), set to the engine that read it
+        self.engine = engine
         self.df = self.load_excel_to_pandas()
 
     def load_excel_to_pandas(self):
@@ -13,112 +124,174 @@ class ExcelDataProcessor:
             raise FileNotFoundError(f"No file found at the specified path: {self.file_loc}")
 
         try:
-            # Attempt to load the Excel file into a DataFrame
+            # Attempt to load the Excel file into a DataFrame. pandas is only imported by read_excel, so commands
+            # that do not read metadata start quickly
             with open(self.file_loc, 'rb') as f:
-                return pd.read_excel(f, dtype={'Factsheet': str})
+                df, self.engine = read_excel(f, get_excel_engines(self.engine), dtype={'Factsheet': str})
+                return df
         except Exception as e:
             # Handle other potential exceptions that could arise during file reading
             raise Exception(f"Failed to load Excel file: {e}")
 
     def rename_columns(self):
         """Renames DataFrame columns according to a predefined schema."""
-        self.df.rename(columns={
-            'Factsheet': 'file_name',
-            'Title': 'title',
-            'Description': 'description',
-            'keywords': 'keywords',
-            'Creators': 'creators_preprocessing',
-            'Geographic location(s)': 'geographic_locations',
-            'Date of completion': 'date_of_completion',
-            'Language': 'language',
-            'Category': 'type',
-            'Type': 'category',
-            'Topics': 'topics',
-            'Subtopics': 'subtopics',
-            'Licence': 'license',
-            'Intended Purpose': 'intended_purpose'
-        }, inplace=True)
+        self.df.rename(columns=COLUMN_NAMES, inplace=True)
 
     def remove_columns(self):
         """Renames DataFrame columns according to a predefined schema."""
-        self.df.drop(['Grant ID',
-                      'Type of Solution',
-                      'Sector',
-                      'ResAlliance Partner',
-                      'Climate hazard', 'Good Practice(s)'
-                      ], axis=1, inplace=True)
+        self.df.drop(REMOVED_COLUMNS, axis=1, inplace=True)
 
     def convert_creators_column(self):
         """Convert 'creators_preprocessing' column to a list of unique dictionaries with 'name' and 'email'."""
         if 'creators_preprocessing' not in self.df.columns:
             raise ValueError("The 'creators_preprocessing' column does not exist in the DataFrame.")
 
-        # Create a new column with empty lists for all rows
-        self.df['creators'] = [set() for _ in range(len(self.df))]
-
-        for index, row in self.df.iterrows():
-            column_data = row['creators_preprocessing']
-            pairs = column_data.split(", ")
-            for pair in pairs:
-                parts = pair.split(";") if ';' in pair else [pair, ""]
-                name_email_tuple = (parts[0].strip(), parts[1].strip() if len(parts) > 1 else "")
-                # Add the tuple to the set for this row
-                self.df.at[index, 'creators'].add(name_email_tuple)
-
-        # Convert each set to a list of dictionaries and update the DataFrame
-        self.df['creators'] = self.df['creators'].apply(lambda s: [{"name": name, "email": email} for name, email in s])
+        # Split the whole column in one pass, rows without creators get an empty list
+        self.df['creators'] = [split_creators(value) if isinstance(value, str) else []
+                               for value in self.df['creators_preprocessing'].to_list()]
 
         # Optionally, drop the 'creators_preprocessing' column
         self.df.drop(['creators_preprocessing'], axis=1, inplace=True)
 
     def convert_file_name_and_language(self):
         """Create a new column 'file_name_lang' where each row is a list of dictionaries containing filename-language pairs."""
-        # Initialize the new column with empty lists instead of sets
-        self.df['file_name_lang'] = [[] for _ in range(len(self.df))]
-
-        # Iterate through each row of the DataFrame
-        for index, row in self.df.iterrows():
-            # Extract filenames and languages, ensuring they are lists
-            filenames = row['file_name'].split(";")  # Split the filenames string by semicolon
-            languages = row['language'].split(";")  # Split the languages string by semicolon
-
-            # Iterate through paired filenames and languages
-            for filename, language in zip(filenames, languages):
-                # Trim whitespace and add the filename-language tuple to the list for this row
-                filename = filename.strip()
-                language = language.strip()
-                # Ensure no duplicates are added
-                if (filename, language) not in self.df.at[index, 'file_name_lang']:
-                    self.df.at[index, 'file_name_lang'].append((filename, language))
-
-        # Convert each list to a list of dictionaries and update the DataFrame
-        self.df['file_name_lang'] = self.df['file_name_lang'].apply(
-            lambda lst: [{"filename": fn, "language": lang} for fn, lang in lst])
+        # Pair the filenames and languages of all rows in one pass over both columns
+        self.df['file_name_lang'] = [split_file_names_and_languages(file_names, languages)
+                                     for file_names, languages in zip(self.df['file_name'].to_list(),
+                                                                      self.df['language'].to_list())]
 
         # Optionally drop the 'file_name' and 'language' columns if they are no longer needed
         self.df.drop(['file_name', 'language'], axis=1, inplace=True)
 
     def convert_semi_colon_separated_string_to_list(self, column_name):
         """Converts a comma-separated string in a DataFrame column to a list of unique strings, preserving the order."""
-
-        def unique_ordered_list(s):
-            seen = set()
-            return [item.strip() for item in s.split(';') if item.strip() not in seen and not seen.add(item.strip())]
-
-        self.df[column_name] = self.df[column_name].apply(
-            lambda x: unique_ordered_list(x) if isinstance(x, str) else [])
+        self.df[column_name] = [unique_ordered_list(x) if isinstance(x, str) else []
+                                for x in self.df[column_name].to_list()]
 
     def convert_list_properties(self):
 
-        for column in ['keywords', 'geographic_locations', 'intended_purpose', 'topics', 'subtopics',
-                       'type', 'Type of Solution', 'Sector', 'ResAlliance Partner', 'Climate hazard',
-                       'Good Practice(s)']:
+        for column in LIST_PROPERTIES:
             self.convert_semi_colon_separated_string_to_list(column)
 
     def create_contributor_custom_metadata(self):
 
         """Creates a custom metadata dictionary from the DataFrame"""
-        custom_properties = ['Type of Solution', 'Sector', 'ResAlliance Partner', 'Climate hazard', 'Good Practice(s)']
-
         self.df['contributor_custom_metadata'] = \
-            self.df[custom_properties].apply(lambda x: dict(zip(custom_properties, x)), axis=1)
+            [dict(zip(CUSTOM_PROPERTIES, values))
+             for values in zip(*(self.df[column].to_list() for column in CUSTOM_PROPERTIES))]
+
+
+def to_json_value(value):
+    """
+    Converts a cell value to the value it has in the metadata JSON, the same way pandas' to_json does:
+    missing values become None and dates become milliseconds since the epoch. Numbers are kept as they are, whole
+    numbers are already integers when they are read, see get_cell_value.
+    Lists and dictionaries, e.g. the creators, are converted item by item.
+    """
+    if isinstance(value, dict):
+        return {key: to_json_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_json_value(item) for item in value]
+    # NaT is a date that is not equal to itself, like NaN
+    if value is None or (isinstance(value, (float, datetime.date)) and value != value):
+        return None
+    if isinstance(value, datetime.datetime):
+        return calendar.timegm(value.utctimetuple()) * 1000 + value.microsecond // 1000
+    if isinstance(value, datetime.date):
+        return calendar.timegm(value.timetuple()) * 1000
+    if isinstance(value, datetime.time):
+        return value.isoformat()
+    return value
+
+
+def dataframe_to_records(df):
+    """
+    Returns the rows of a processed metadata DataFrame as metadata records, in one pass over the DataFrame.
+    The records are the same as json.loads(row.to_json(orient='index')) of every row, without building
+    and parsing a JSON string per row.
+    """
+    return [to_json_value(record) for record in df.to_dict(orient='records')]
+
+
+def transform_record(row: dict):
+    """
+    Applies the same steps as process_metadata() to a single row of the metadata file,
+    given as a dictionary of column name to cell value, and returns the metadata record
+    """
+    record = {COLUMN_NAMES.get(column, column): to_json_value(value) for column, value in row.items()}
+    for column in LIST_PROPERTIES:
+        value = record[column]
+        record[column] = unique_ordered_list(value) if isinstance(value, str) else []
+    record['file_name_lang'] = split_file_names_and_languages(record.pop('file_name'), record.pop('language'))
+    creators = record.pop('creators_preprocessing')
+    record['creators'] = split_creators(creators) if isinstance(creators, str) else []
+    record['contributor_custom_metadata'] = {column: record[column] for column in CUSTOM_PROPERTIES}
+    for column in REMOVED_COLUMNS:
+        del record[column]
+    return record
+
+
+def get_cell_value(cell):
+    """
+    Returns the value of a cell read by openpyxl the way pd.read_excel reads it: error cells, e.g. #NAME?,
+    and the NA_VALUES text are missing values, and whole numbers are integers
+    """
+    if cell.data_type == 'e' or (isinstance(cell.value, str) and cell.value in NA_VALUES):
+        return None
+    if isinstance(cell.value, float) and cell.value.is_integer():
+        return int(cell.value)
+    return cell.value
+
+
+def get_column_names(header: list):
+    """
+    Returns the column names of a header row the way pd.read_excel names them: an empty header cell is named
+    "Unnamed: <index>", and a name that is used more than once gets ".1", ".2", ... from its second column on,
+    skipping the suffixes that are the name of another column. The named columns get their names first.
+    """
+    columns = [column if column is not None else f"Unnamed: {index}" for index, column in enumerate(header)]
+    unnamed = [index for index, column in enumerate(header) if column is None]
+    counts = {}
+    for index in [index for index in range(len(columns)) if index not in unnamed] + unnamed:
+        name = column = columns[index]
+        count = counts.get(column, 0)
+        while count > 0:
+            counts[name] = count + 1
+            column = f"{name}.{count}"
+            count = count + 1 if column in columns else counts.get(column, 0)
+        columns[index] = column
+        counts[column] = count + 1
+    return columns
+
+
+def iter_metadata_records(file_loc: str):
+    """
+    Reads the metadata file row by row and yields each transformed metadata record as soon as it is read,
+    without loading the whole file into memory. The records are the same as the rows of process_metadata():
+    the cells and column names are read the way pd.read_excel reads them, see get_cell_value and get_column_names.
+    """
+    if not os.path.exists(file_loc):
+        raise FileNotFoundError(f"No file found at the specified path: {file_loc}")
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_loc, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows()
+        # Empty rows are skipped, like pd.read_excel does, also above the header
+        rows = (cells for cells in rows if any(cell.value is not None for cell in cells))
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = get_column_names([cell.value for cell in header])
+
+        for cells in rows:
+            values = [get_cell_value(cell) for cell in cells[:len(columns)]]
+            values += [None] * (len(columns) - len(values))
+            row = dict(zip(columns, values))
+            # The factsheet names are always read as text, like dtype={'Factsheet': str} does
+            if row.get('Factsheet') is not None:
+                row['Factsheet'] = str(row['Factsheet'])
+            yield transform_record(row)
+    finally:
+        workbook.close()
@@ -0,0 +1,203 @@
+import argparse
+import datetime
+import json
+import os
+import re
+
+# Fields every metadata record needs, marked with (*) in the EU-FarmBook metadata template
+REQUIRED_FIELDS = ['title', 'description', 'keywords', 'creators', 'date_of_completion', 'type', 'category',
+                   'topics', 'subtopics', 'license', 'intended_purpose']
+# Fields whose values must come from a controlled vocabulary, if a vocabulary table is available for them.
+# The license is always checked, against LICENSES unless the vocabulary tables have a license list of their own.
+VOCABULARY_FIELDS = ['topics', 'subtopics', 'type', 'category', 'intended_purpose', 'geographic_locations',
+                     'license']
+# Accepted formats for dates given as text, the metadata template uses dd/mm/yyyy.
+# Dates read from Excel date cells are sent as epoch milliseconds.
+DATE_FORMATS = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%d/%m/%Y']
+EMAIL_PATTERN = re.compile(r"^[^@\s]+@[^@\s]+\.[^@\s]+$")
+
+# Named lists in the 'Lists' sheet of the EU-FarmBook metadata template (see the g4ae example .xlsm)
+# that hold the controlled vocabulary of each field
+TEMPLATE_VOCABULARIES = {
+    'type': ['Category'],
+    'category': ['document', 'slideshowpresentation', 'dataset', 'video', 'audio', 'image', 'softwareapplication'],
+    'topics': ['Subject'],
+    'subtopics': ['cropfarming', 'livestock', 'forestry', 'environment', 'society', 'economics', 'subject2'],
+    'intended_purpose': ['Purpose'],
+    'geographic_locations': ['Geolocations'],
+}
+
+# The licenses the EU-FarmBook metadata template recommends (see the note on its license field), by their short
+# name, with their full name. A license can be given by its short name, with or without its version, by its full
+# name, as "full name (short name version)" or by the URL of its Creative Commons page.
+LICENSE_VERSION = '4.0'
+LICENSES = {
+    'CC BY': 'Attribution 4.0 International',
+    'CC BY-SA': 'Attribution-ShareAlike 4.0 International',
+    'CC BY-NC': 'Attribution-NonCommercial 4.0 International',
+    'CC BY-NC-SA': 'Attribution-NonCommercial-ShareAlike 4.0 International',
+    'CC BY-ND': 'Attribution-NoDerivs 4.0 International',
+    'CC BY-NC-ND': 'Attribution-NonCommercial-NoDerivs 4.0 International',
+}
+
+
+def normalise(value):
+    """Vocabulary values are compared without surrounding whitespace and case"""
+    return str(value).strip().casefold()
+
+
+def load_vocabularies(vocabulary_file: str):
+    """
+    Loads the cached vocabulary tables, a JSON file mapping a field name to its list of allowed values.
+    Returns an empty dictionary if the file does not exist, in which case no vocabularies are checked.
+    """
+    if not vocabulary_file or not os.path.exists(vocabulary_file):
+        return {}
+    with open(vocabulary_file, 'r', encoding='utf-8') as f:
+        vocabularies = json.load(f)
+    return {field: {normalise(value) for value in values} for field, values in vocabularies.items()}
+
+
+def get_license_vocabulary():
+    """Returns every accepted way of writing the LICENSES, normalised"""
+    values = set()
+    for name, full_name in LICENSES.items():
+        url = f"creativecommons.org/licenses/{name[3:].lower()}/{LICENSE_VERSION}"
+        values.update([name, f"{name} {LICENSE_VERSION}", full_name, f"{full_name} ({name} {LICENSE_VERSION})"])
+        values.update(f"{scheme}{url}{end}" for scheme in ['https://', 'http://'] for end in ['', '/'])
+    return {normalise(value) for value in values}
+
+
+def build_vocabularies_from_template(template_file: str, vocabulary_file: str):
+    """
+    Reads the controlled vocabularies from the 'Lists' sheet of an EU-FarmBook metadata template
+    and stores them as the vocabulary tables used by the MetadataValidator
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(template_file, data_only=True)
+    try:
+        vocabularies = {}
+        for field, names in TEMPLATE_VOCABULARIES.items():
+            values = []
+            for name in names:
+                if name not in workbook.defined_names:
+                    continue
+                for sheet_name, cell_range in workbook.defined_names[name].destinations:
+                    cells = workbook[sheet_name][cell_range]
+                    rows = cells if isinstance(cells, tuple) else ((cells,),)
+                    for row in rows:
+                        for cell in row if isinstance(row, tuple) else (row,):
+                            if cell.value is not None and str(cell.value).strip() not in values:
+                                values.append(str(cell.value).strip())
+            vocabularies[field] = values
+    finally:
+        workbook.close()
+
+    with open(vocabulary_file, 'w', encoding='utf-8') as f:
+        json.dump(vocabularies, f, indent=4, ensure_ascii=False)
+    return vocabularies
+
+
+def is_empty(value):
+    return value is None or (isinstance(value, (str, list, dict)) and len(value) == 0) or \
+        (isinstance(value, str) and not value.strip())
+
+
+def is_valid_date(value):
+    if isinstance(value, bool):
+        return False
+    if isinstance(value, (int, float, datetime.date)):
+        return True
+    if isinstance(value, str):
+        for date_format in DATE_FORMATS:
+            try:
+                datetime.datetime.strptime(value.strip(), date_format)
+                return True
+            except ValueError:
+                pass
+    return False
+
+
+class MetadataValidator:
+    """
+    Checks metadata records locally, before anything is sent to the EU-FarmBook API: required fields,
+    date formats, creators and knowledge object languages, and the values of the controlled vocabulary fields.
+    This catches most mistakes without a call to the validation endpoint for every record.
+    """
+
+    def __init__(self, vocabularies: dict = None, required_fields: list = None):
+        self.vocabularies = {'license': get_license_vocabulary(), **(vocabularies or {})}
+        self.required_fields = required_fields or REQUIRED_FIELDS
+
+    def validate_record(self, record: dict):
+        """Returns the list of problems found in a metadata record, empty if the record is valid"""
+        errors = []
+
+        for field in self.required_fields:
+            if is_empty(record.get(field)):
+                errors.append(f"'{field}' is required")
+
+        date_of_completion = record.get('date_of_completion')
+        if not is_empty(date_of_completion) and not is_valid_date(date_of_completion):
+            errors.append(f"'date_of_completion' has an invalid date: {date_of_completion!r}, "
+                          f"expected one of {', '.join(DATE_FORMATS)}")
+
+        creators = record.get('creators') or []
+        for creator in creators if isinstance(creators, list) else []:
+            if is_empty(creator.get('name')):
+                errors.append(f"creator {creator} has no name")
+            email = creator.get('email')
+            if not is_empty(email) and not EMAIL_PATTERN.match(email):
+                errors.append(f"creator {creator.get('name')} has an invalid email: {email!r}")
+
+        # ResAlliance records list their files and languages, g4ae records have a single language
+        if 'file_name_lang' in record:
+            if is_empty(record['file_name_lang']):
+                errors.append("'file_name_lang' has no knowledge objects")
+            for file in record['file_name_lang'] or []:
+                if is_empty(file.get('filename')):
+                    errors.append(f"knowledge object {file} has no file name")
+                if is_empty(file.get('language')):
+                    errors.append(f"knowledge object {file.get('filename')} has no language")
+        elif is_empty(record.get('language')):
+            errors.append("'language' is required")
+
+        for field in VOCABULARY_FIELDS:
+            vocabulary = self.vocabularies.get(field)
+            value = record.get(field)
+            if not vocabulary or is_empty(value):
+                continue
+            for item in value if isinstance(value, list) else [value]:
+                if normalise(item) not in vocabulary:
+                    errors.append(f"'{field}' has a value that is not in the vocabulary: {item!r}")
+
+        return errors
+
+    def validate_records(self, records):
+        """
+        Validates (record_id, record) pairs and returns a report with the number of records checked,
+        the number of invalid records and the problems found per record
+        """
+        report = {'records': 0, 'invalid_records': 0, 'vocabularies_checked': sorted(self.vocabularies),
+                  'errors': {}}
+        for record_id, record in records:
+            report['records'] += 1
+            errors = self.validate_record(record)
+            if errors:
+                report['invalid_records'] += 1
+                report['errors'][str(record_id)] = errors
+        return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the vocabulary tables used to validate metadata locally.')
+    parser.add_argument('template', help='An EU-FarmBook metadata template (.xlsx/.xlsm) with a Lists sheet.')
+    parser.add_argument('vocabulary_file', nargs='?', default=os.path.join('data', 'vocabularies.json'),
+                        help='Where to store the vocabulary tables.')
+    args = parser.parse_args()
+
+    tables = build_vocabularies_from_template(args.template, args.vocabulary_file)
+    for table, table_values in tables.items():
+        print(f"{table}: {len(table_values)} values")
+    print(f"Vocabulary tables saved to {args.vocabulary_file}")